@@ -7,20 +7,34 @@ import sqlite3
 import random
 import string
 import shutil
+import time
+import queue
+import zlib
+import fcntl
+import hashlib
+import re
+import stat
+import mimetypes
 from datetime import datetime, timezone, timedelta
-from PIL import Image, ImageOps
-from threading import Thread 
+from PIL import Image, ImageOps, features
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+import multiprocessing
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
+import obrazy
+import wycena_lokalna
+import klient_ai
  
 # Importy Flask
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify, send_from_directory, send_file, make_response, session
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify, send_from_directory, send_file, make_response, session, stream_with_context
 # Importy Bazy i Logowania
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, tuple_
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 # Importy Bezpieczeństwa
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from itsdangerous import URLSafeTimedSerializer as Serializer
 # Importy AI i Maila
 import google.generativeai as genai
@@ -109,23 +123,63 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # --- KONFIGURACJA GEMINI AI ---
-if GEMINI_KEY:
+# model_ai to klient_ai.KlientAI: limit czasu, ponowienia, bezpiecznik i metryki dla każdego wywołania.
+# GEMINI_BACKEND=atrapa -> deterministyczna atrapa bez sieci (testy, benchmarki obciążeniowe)
+GEMINI_BACKEND = os.environ.get('GEMINI_BACKEND', '').lower()
+AI_TIMEOUT_SKAN = 20   # sekund - skan zdjęcia i opis czekają w żądaniu HTTP (sync worker gunicorna)
+AI_TIMEOUT_OPIS = 25
+AI_TIMEOUT_WYCENA = 60 # wyceny liczą się w tle, mogą poczekać dłużej
+if GEMINI_BACKEND == 'atrapa':
+    model_ai = klient_ai.KlientAI(klient_ai.AtrapaAI())
+elif GEMINI_KEY:
     genai.configure(api_key=GEMINI_KEY)
-    try: model_ai = genai.GenerativeModel('gemini-3-flash-preview') # Lub 'gemini-pro' zależnie od dostępności
+    try: model_ai = klient_ai.KlientAI(genai.GenerativeModel('gemini-3-flash-preview')) # Lub 'gemini-pro' zależnie od dostępności
     except:
         model_ai = None
 else:
     model_ai = None
 
 # --- ŚLEDZENIE AKTYWNOŚCI ---
+# last_seen zapisujemy najwyżej raz na LAST_SEEN_MINUTES na użytkownika, zbiorczo co
+# LAST_SEEN_FLUSH_SECONDS. Okno "online teraz" w profilu musi być dłuższe niż suma obu.
+LAST_SEEN_MINUTES = 2
+LAST_SEEN_FLUSH_SECONDS = 30
+ONLINE_WINDOW_MINUTES = 5
+_last_seen_pending = {}
+_last_seen_lock = Lock()
+
 @app.before_request
 def update_last_seen():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        try:
+    if request.endpoint == 'static' or not current_user.is_authenticated:
+        return
+    now = datetime.utcnow()
+    # Wartość z bazy (załadowana i tak przez user_loader) - throttling działa też między workerami
+    if current_user.last_seen and now - current_user.last_seen < timedelta(minutes=LAST_SEEN_MINUTES):
+        return
+    with _last_seen_lock:
+        _last_seen_pending[current_user.id] = now
+
+def flush_last_seen():
+    with _last_seen_lock:
+        if not _last_seen_pending:
+            return 0
+        batch = list(_last_seen_pending.items())
+        _last_seen_pending.clear()
+
+    try:
+        with app.app_context():
+            db.session.execute(
+                db.text("UPDATE user SET last_seen = :ts WHERE id = :uid").bindparams(db.bindparam('ts', type_=db.DateTime)),
+                [{'uid': uid, 'ts': ts} for uid, ts in batch]
+            )
             db.session.commit()
-        except:
-            db.session.rollback()
+        return len(batch)
+    except Exception as e:
+        with _last_seen_lock:
+            for uid, ts in batch:
+                _last_seen_pending.setdefault(uid, ts)
+        print(f"Błąd zapisu last_seen: {e}")
+        return 0
 
 # --- TŁUMACZENIA (Słownik Rozbudowany) ---
 TRANSLATIONS = {
@@ -379,7 +433,28 @@ class Car(db.Model):
     is_promoted = db.Column(db.Boolean, default=False)
     ai_label = db.Column(db.String(500), nullable=True)
     ai_valuation_data = db.Column(db.String(50), nullable=True)
+    # Wycena AI rozbita na kolumny przy zapisie (apply_valuation) - karty i filtry nie parsują JSON-a
+    ai_ocena = db.Column(db.String(10), nullable=True) # SUPER / DOBRA / UCZCIWA / DROGO (filtr w szukaj)
+    ai_score = db.Column(db.Integer, nullable=True)
+    ai_werdykt = db.Column(db.String(50), nullable=True) # np. "SUPER OKAZJA"
+    ai_kolor = db.Column(db.String(10), nullable=True)
+    ai_pl_min = db.Column(db.Float, nullable=True)
+    ai_pl_avg = db.Column(db.Float, nullable=True)
+    ai_pl_max = db.Column(db.Float, nullable=True)
+    ai_paint_score = db.Column(db.Integer, nullable=True)
+    ai_paint_status = db.Column(db.String(200), nullable=True)
+    ai_klasa = db.Column(db.String(1), nullable=True)
+    ai_spalanie_miasto = db.Column(db.Float, nullable=True)
+    ai_spalanie_trasa = db.Column(db.Float, nullable=True)
+    ai_spalanie_mieszany = db.Column(db.Float, nullable=True)
+    ai_price_comment = db.Column(db.Text, nullable=True)
+    ai_engine_comment = db.Column(db.Text, nullable=True)
+    wycena_od = db.Column(db.String(19), nullable=True) # UTC; wycena w toku (rezerwacja workera), patrz _claim_valuation
     views = db.Column(db.Integer, default=0)
+    zdjecia_status = db.Column(db.String(10), nullable=True) # None = gotowe, 'w_toku' / 'blad' w trybie odroczonym
+    zdjecia_od = db.Column(db.String(19), nullable=True) # UTC; od kiedy 'w_toku' (sweep_stale_images)
+    img_lqip = db.Column(db.Text, nullable=True) # placeholder zdjęcia głównego (karty na listach)
+    img_color = db.Column(db.String(7), nullable=True)
     wyswietlenia = db.Column(db.Integer, default=0) # Legacy field
     
     data_dodania = db.Column(db.DateTime, default=datetime.utcnow)
@@ -390,8 +465,57 @@ class CarImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image_path = db.Column(db.String(200), nullable=False)
     thumb_path = db.Column(db.String(200), nullable=True) # NOWA KOLUMNA DLA MINIATUR
+    lqip = db.Column(db.Text, nullable=True) # podgląd 16px jako data URI (obrazy.placeholder)
+    dominant_color = db.Column(db.String(7), nullable=True)
     car_id = db.Column(db.Integer, db.ForeignKey('car.id'), nullable=False)
-    
+
+class UploadFile(db.Model):
+    # Magazyn zdjęć adresowany treścią: jeden plik na sha256 wgranych bajtów, niezależnie od tego,
+    # ile ogłoszeń/awatarów go używa. refcount liczą triggery (init_uploads), pliki kasuje purge_uploads().
+    __tablename__ = 'upload_file'
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(80), unique=True, nullable=False) # sha256 albo 'plik:<nazwa>' dla starych uploadów
+    image_path = db.Column(db.String(200), unique=True, nullable=False)
+    thumb_path = db.Column(db.String(200), nullable=True)
+    lqip = db.Column(db.Text, nullable=True)
+    dominant_color = db.Column(db.String(7), nullable=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.String(19), nullable=True) # 'YYYY-MM-DD HH:MM:SS' UTC, jak datetime('now') w SQLite
+
+class ScanToken(db.Model):
+    # Zdjęcie ze skanu AI (obrabiane w tle, w magazynie) czeka na /dodaj pod krótkim tokenem - formularz
+    # odsyła token zamiast drugi raz całego pliku. Wpis trzyma referencję do pliku (trigger upload_ref_*);
+    # lqip i kolor bierzemy z upload_file, bo w chwili wydania tokenu obróbka jeszcze trwa.
+    __tablename__ = 'scan_token'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    image_path = db.Column(db.String(500), nullable=False)
+    thumb_path = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.String(19), nullable=False) # UTC, jak upload_file.updated_at
+
+class SpecValuation(db.Model):
+    # Część wyceny AI zależna tylko od specyfikacji (widełki rynkowe, spalanie, klasa, opinia o silniku) -
+    # liczona raz i współdzielona przez wszystkie ogłoszenia o tym samym spec_key (spec_key_for()).
+    __tablename__ = 'spec_valuation'
+    id = db.Column(db.Integer, primary_key=True)
+    spec_key = db.Column(db.String(300), unique=True, nullable=False)
+    dane = db.Column(db.Text, nullable=False) # JSON: pl_min/pl_avg/pl_max, klasa_energetyczna, spalanie, engine_comment
+    data = db.Column(db.String(10), nullable=False) # 'YYYY-MM-DD', jak car.ai_valuation_data
+    uzycia = db.Column(db.Integer, nullable=False, default=0) # ile wycen aut skorzystało z wpisu
+
+class FacetCount(db.Model):
+    # Licznik ogłoszeń dla każdej kombinacji filtrów (typ, paliwo, skrzynia, nadwozie).
+    # Aktualizowany triggerami przy INSERT/UPDATE/DELETE na car, korygowany przez reconcile_facets().
+    __tablename__ = 'facet_count'
+    id = db.Column(db.Integer, primary_key=True)
+    typ = db.Column(db.String(20), nullable=False, default='')
+    paliwo = db.Column(db.String(20), nullable=False, default='')
+    skrzynia = db.Column(db.String(20), nullable=False, default='')
+    nadwozie = db.Column(db.String(30), nullable=False, default='')
+    ilosc = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('typ', 'paliwo', 'skrzynia', 'nadwozie', name='uq_facet_count'),)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -401,98 +525,685 @@ def load_user(user_id):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def watermark_path():
+    return os.path.join(app.root_path, 'static', 'watermark.png')
+
+def upload_url(filename):
+    # Jak url_for('static', filename='uploads/...'), ale działa też w wątku bez kontekstu żądania
+    return f"{app.static_url_path}/uploads/{filename}"
+
 def save_optimized_image(file, is_car_image=False):
     if not file or not allowed_file(file.filename):
         return None
-    
-    try:
-        ext = 'webp' 
-        filename = f"{uuid.uuid4().hex}.{ext}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Otwieranie obrazu przez PIL i poprawa rotacji
-        image = Image.open(file)
-        image = ImageOps.exif_transpose(image)
-        
-        # Konwersja do RGBA, jeśli oryginalny obraz to wymaga (np. PNG z przezroczystością)
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
 
-        # Skalowanie głównego obrazu
-        image.thumbnail((1920, 1920), Image.Resampling.LANCZOS)
-        
-        # --- NAKŁADANIE ZNAKU WODNEGO ---
-        watermark_path = os.path.join(app.root_path, 'static', 'watermark.png')
-        if os.path.exists(watermark_path):
-            watermark = Image.open(watermark_path).convert("RGBA")
-            
-            # Dostosowanie rozmiaru znaku wodnego (np. 20% szerokości obrazu)
-            wm_width = int(image.width * 0.20)
-            wm_ratio = wm_width / float(watermark.width)
-            wm_height = int(float(watermark.height) * float(wm_ratio))
-            watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
-            
-            # Dodanie przezroczystości do znaku wodnego (np. 50%)
-            alpha = watermark.split()[3]
-            alpha = alpha.point(lambda p: p * 0.5)
-            watermark.putalpha(alpha)
-            
-            # Obliczanie pozycji (np. w prawym dolnym rogu z marginesem 20px)
-            margin = 20
-            position = (image.width - wm_width - margin, image.height - wm_height - margin)
-            
-            # Nałożenie na nowy obraz kompozytowy
-            transparent = Image.new('RGBA', image.size, (0,0,0,0))
-            transparent.paste(image, (0,0))
-            transparent.paste(watermark, position, mask=watermark)
-            image = transparent
-        
-        # --- ZAPIS JAKO WEBP ---
-        # Dla WebP trzeba zrzucić przezroczystość na czarne lub białe tło przed kompresją
-        final_image = Image.new("RGB", image.size, (255, 255, 255))
-        final_image.paste(image, mask=image.split()[3])
-        
-        final_image.save(filepath, format='WEBP', quality=80)
-        
-        # JEŚLI TO ZDJĘCIE AUTA/PRZEDMIOTU -> TWORZYMY DODATKOWO LEKKĄ MINIATURKĘ
-        if is_car_image:
-            thumb_filename = f"thumb_{filename}"
-            thumb_filepath = os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename)
-            
-            thumb_img = ImageOps.fit(final_image, (400, 300), method=Image.Resampling.LANCZOS)
-            thumb_img.save(thumb_filepath, format='WEBP', quality=75)
-            
-            return filename, thumb_filename
-            
-        return filename
-    except Exception as e:
-        print(f"Błąd zapisu i znaku wodnego: {e}")
+    # Ta sama ścieżka co zdjęcia ogłoszeń: magazyn po hashu (ponowny upload = ten sam plik)
+    saved = collect_images(submit_images([file]))
+    if not saved:
         return None
+    filename = saved[0]['image_path'].rsplit('/', 1)[-1]
+    if is_car_image:
+        return filename, saved[0]['thumb_path'].rsplit('/', 1)[-1]
+    return filename
+
+
+# --- RÓWNOLEGŁA OBRÓBKA ZDJĘĆ OGŁOSZEŃ ---
+# Do 18+ zdjęć z telefonu na jedno ogłoszenie - zamiast mielić je po kolei w wątku gunicorna,
+# rozrzucamy je na pulę procesów (PIL trzyma GIL przy LANCZOS/WebP, wątki by nie pomogły).
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+app.config['IMAGES_DEFERRED'] = False # True = ogłoszenie od razu, zdjęcia dochodzą w tle
+IMG_BRAK = 'https://placehold.co/600x400?text=Brak+Zdjecia'
+IMG_W_TOKU = 'https://placehold.co/600x400?text=Trwa+obrobka+zdjec'
+IMAGES_STALE_MINUTES = 30 # 'w_toku' dłużej = wątek dopinający zginął razem z workerem (restart, recykling)
+_image_pool = None
+_image_pool_lock = Lock()
+
+def get_image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            # fork: proces potomny nie importuje app.py ponownie (spawn odpaliłby drugi scheduler)
+            ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+            _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=ctx)
+        return _image_pool
+
+def _reset_image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is not None:
+            _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
+
+def submit_images(files, limit=None):
+    """Czyta pliki z żądania i zleca obróbkę w puli. Zwraca listę zadań w kolejności zdjęć.
+
+    Nazwa pliku = hash treści, więc zdjęcie, które już jest w magazynie, nie idzie do puli wcale.
+    """
+    jobs, in_batch = [], {}
+    for file in [f for f in files if f and f.filename and allowed_file(f.filename)][:limit]:
+        data = file.read() # strumień z żądania znika po odpowiedzi - do puli idą bajty
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in in_batch: # to samo zdjęcie dwa razy w jednym formularzu
+            in_batch[digest] = submit_image_data(data, digest)
+        jobs.append(in_batch[digest])
+    return jobs
+
+def submit_image_data(data, digest=None):
+    """Jedno zadanie jak w submit_images(), gdy bajty są już w pamięci (np. skan AI)."""
+    digest = digest or hashlib.sha256(data).hexdigest()
+    filename, thumb_filename = upload_names(digest)
+    known = touch_upload(digest)
+    if known:
+        future = Future()
+        future.set_result({'lqip': known.lqip, 'dominant_color': known.dominant_color})
+    else:
+        future = _submit_processing(data, filename, thumb_filename)
+    return future, digest, filename, thumb_filename
+
+def _submit_processing(data, filename, thumb_filename):
+    args = (data,
+            os.path.join(app.config['UPLOAD_FOLDER'], filename),
+            os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename),
+            watermark_path())
+    try:
+        return get_image_pool().submit(obrazy.przetworz_zdjecie, *args)
+    except Exception as e:
+        # Pula padła (np. OOM-killer zabił proces) - stawiamy nową przy następnym zleceniu
+        print(f"Pula zdjęć niedostępna, obrabiam w tym procesie: {e}")
+        _reset_image_pool()
+        future = Future()
+        try: future.set_result(obrazy.przetworz_zdjecie(*args))
+        except Exception as ex: future.set_exception(ex)
+        return future
+
+def collect_images(jobs):
+    """Czeka na wyniki submit_images() i rejestruje pliki w magazynie. Zwraca listę pól CarImage
+    (bez zdjęć, które się nie udały). Licznik referencji podbije dopiero zapis CarImage/Car/User."""
+    saved_paths = []
+    for future, digest, filename, thumb_filename in jobs:
+        try:
+            ph = future.result(timeout=120) or {}
+            zdj = {'image_path': upload_url(filename), 'thumb_path': upload_url(thumb_filename),
+                   'lqip': ph.get('lqip'), 'dominant_color': ph.get('dominant_color')}
+            register_upload(digest, zdj)
+            saved_paths.append(zdj)
+        except Exception as e:
+            print(f"Błąd zapisu i znaku wodnego: {e}")
+    return saved_paths
+
+def main_image(saved_paths, fallback=IMG_BRAK):
+    """Pola Car dla zdjęcia głównego (pierwsze z listy) razem z placeholderem."""
+    if not saved_paths:
+        return {'img': fallback, 'thumb': None, 'img_lqip': None, 'img_color': None}
+    first = saved_paths[0]
+    return {'img': first['image_path'], 'thumb': first['thumb_path'], 'img_lqip': first['lqip'], 'img_color': first['dominant_color']}
+
+def finish_images_async(car_id, jobs, set_main=True):
+    """Tryb odroczony: dopina zdjęcia do ogłoszenia po obróbce, status w car.zdjecia_status."""
+    def worker():
+        with app.app_context():
+            saved_paths = collect_images(jobs)
+            try:
+                car = db.session.get(Car, car_id)
+                if not car:
+                    return
+                for zdj in saved_paths:
+                    db.session.add(CarImage(car_id=car.id, **zdj))
+                if set_main:
+                    for key, value in main_image(saved_paths).items():
+                        setattr(car, key, value)
+                car.zdjecia_status = None if saved_paths or not jobs else 'blad'
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Błąd dopinania zdjęć (auto {car_id}): {e}")
+    Thread(target=worker, daemon=True).start()
+
+def sweep_stale_images(stale_minutes=IMAGES_STALE_MINUTES):
+    """Ogłoszenia, których zdjęcia utknęły w 'w_toku' (bajty żyły tylko w pamięci procesu), dostają 'blad'."""
+    with app.app_context():
+        swept = db.session.execute(db.text(
+            "UPDATE car SET zdjecia_status = 'blad', "
+            "img = CASE WHEN img = :w_toku THEN :brak ELSE img END, "
+            "thumb = CASE WHEN img = :w_toku THEN NULL ELSE thumb END "
+            "WHERE zdjecia_status = 'w_toku' AND (zdjecia_od IS NULL OR zdjecia_od <= :cutoff)"
+        ), {'w_toku': IMG_W_TOKU, 'brak': IMG_BRAK, 'cutoff': _utc_now_str(stale_minutes)}).rowcount
+        db.session.commit()
+        if swept:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ZDJĘCIA: {swept} ogłoszeń z nieukończoną obróbką oznaczono jako błąd.")
+        return swept
 
+@app.route('/api/zdjecia/<int:car_id>')
+def api_zdjecia(car_id):
+    # Tryb odroczony: formularz/garaż sprawdza, czy zdjęcia już się obrobiły
+    car = Car.query.get_or_404(car_id)
+    return jsonify({
+        'status': car.zdjecia_status or 'gotowe',
+        'zdjecia': [{'img': i.image_path, 'thumb': i.thumb_path} for i in car.images],
+    })
 
 
+# --- MAGAZYN ZDJĘĆ (ADRESOWANIE TREŚCIĄ + LICZNIK REFERENCJI) ---
+# Plik = sha256 wgranych bajtów, więc ten sam kadr z dodaj/edytuj/skanu AI leży na dysku raz.
+# Referencje (car_image.image_path, car.img, user.avatar_url) liczą triggery SQLite - działają też
+# przy kaskadach ORM i w skryptach serwisowych. Plik znika dopiero, gdy licznik spadnie do zera
+# i minie UPLOAD_GRACE_MINUTES (okno na równoległy upload, który właśnie chce go użyć ponownie).
+UPLOAD_GRACE_MINUTES = 10
+UPLOAD_REFS = [(CarImage.__tablename__, 'image_path'), ('car', 'img'), ('user', 'avatar_url'),
+               (ScanToken.__tablename__, 'image_path')]
 
+def upload_names(digest):
+    return f"{digest[:32]}.webp", f"thumb_{digest[:32]}.webp"
 
+def _utc_now_str(minutes_ago=0):
+    return (datetime.utcnow() - timedelta(minutes=minutes_ago)).strftime('%Y-%m-%d %H:%M:%S')
 
+def touch_upload(digest):
+    """Zwraca wpis magazynu dla hasha (jeśli plik jest na dysku) i odsuwa go od purge_uploads().
 
-def check_ai_limit():
-    if not current_user.is_authenticated: return False
-    today = datetime.utcnow().date()
-    if current_user.last_ai_request_date != today:
-        current_user.ai_requests_today = 0
-        current_user.last_ai_request_date = today
+    Wołane z submit_images(), zanim żądanie cokolwiek zapisze do bazy: touch idzie osobnym
+    połączeniem, a SQLite ma jednego pisarza - sesja z wysłanym (flush) zapisem zablokowałaby je.
+    """
+    # Osobne połączenie z własnym commitem - nie zatwierdzamy przy okazji zmian z żądania
+    with db.engine.begin() as conn:
+        touched = conn.execute(db.text("UPDATE upload_file SET updated_at = :teraz WHERE hash = :hash"),
+                               {'teraz': _utc_now_str(), 'hash': digest}).rowcount
+    if not touched:
+        return None
+    # Bez autoflush: zmiany formularza (edytuj, awatar) czekają w sesji do commitu, nie biorą blokady zapisu
+    with db.session.no_autoflush:
+        known = UploadFile.query.filter_by(hash=digest).first()
+    if known and os.path.exists(os.path.join(app.root_path, known.image_path.lstrip('/'))):
+        return known
+    return None
+
+def register_upload(digest, zdj):
+    db.session.execute(db.text(
+        "INSERT INTO upload_file (hash, image_path, thumb_path, lqip, dominant_color, refcount, updated_at) "
+        "VALUES (:hash, :image_path, :thumb_path, :lqip, :dominant_color, 0, :teraz) "
+        "ON CONFLICT(hash) DO UPDATE SET updated_at = excluded.updated_at, "
+        "lqip = COALESCE(upload_file.lqip, excluded.lqip), "
+        "dominant_color = COALESCE(upload_file.dominant_color, excluded.dominant_color)"
+    ), dict(zdj, hash=digest, teraz=_utc_now_str()))
+
+def init_uploads():
+    """Triggery licznika referencji + rejestracja starych (uuid) plików, które są gdzieś używane."""
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            c = conn.cursor()
+            for table, col in UPLOAD_REFS:
+                plus = f"UPDATE upload_file SET refcount = refcount + 1, updated_at = datetime('now') WHERE image_path = new.{col};"
+                minus = f"UPDATE upload_file SET refcount = refcount - 1, updated_at = datetime('now') WHERE image_path = old.{col};"
+                name = f"upload_ref_{table}"
+                c.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON "{table}" WHEN new.{col} IS NOT NULL BEGIN {plus} END')
+                c.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON "{table}" WHEN old.{col} IS NOT NULL BEGIN {minus} END')
+                c.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {col} ON "{table}" WHEN old.{col} IS NOT new.{col} BEGIN {minus} {plus} END')
+            # Migracja: awatary zapisane z ?v=<mtime> (url_for przez static_version) nie trafiały w triggery.
+            # Po obcięciu trigger _au dolicza referencję do właściwego pliku.
+            c.execute("UPDATE user SET avatar_url = substr(avatar_url, 1, instr(avatar_url, '?') - 1) "
+                      "WHERE avatar_url LIKE :prefix AND instr(avatar_url, '?') > 0", {'prefix': upload_url('%')})
+            conn.commit()
+        finally:
+            conn.close()
+        register_legacy_uploads()
+
+def _reference_counts(paths=None):
+    union = ' UNION ALL '.join(f'SELECT {col} AS path FROM "{table}"' for table, col in UPLOAD_REFS)
+    sql = f"SELECT path, COUNT(*) FROM ({union}) WHERE path LIKE :prefix"
+    params = {'prefix': upload_url('%')}
+    if paths is not None:
+        sql += " AND path IN :paths"
+        params['paths'] = list(paths)
+    stmt = db.text(sql + " GROUP BY path")
+    if paths is not None:
+        stmt = stmt.bindparams(db.bindparam('paths', expanding=True))
+    return dict(db.session.execute(stmt, params).fetchall())
+
+def register_legacy_uploads():
+    # Pliki sprzed magazynu (uuid.webp) dostają wpis z policzonymi referencjami - od teraz usuwa je
+    # ten sam mechanizm. Nieużywane sieroty zostawiamy w spokoju (to robota dla osobnego GC).
+    known = {r[0] for r in db.session.execute(db.text("SELECT image_path FROM upload_file"))}
+    added = 0
+    for path, refs in _reference_counts().items():
+        full_path = os.path.join(app.root_path, path.lstrip('/'))
+        if path in known or not os.path.isfile(full_path):
+            continue
+        name = path.rsplit('/', 1)[-1]
+        thumb = f"thumb_{name}"
+        thumb_exists = os.path.isfile(os.path.join(app.root_path, UPLOAD_FOLDER, thumb))
+        db.session.add(UploadFile(hash=f"plik:{name}", image_path=path, thumb_path=upload_url(thumb) if thumb_exists else None,
+                                  refcount=refs, updated_at=_utc_now_str()))
+        added += 1
+    db.session.commit()
+    if added:
+        print(f"✅ Magazyn zdjęć: zarejestrowano {added} starszych plików")
+    return added
+
+def _remove_upload_files(image_path, thumb_path):
+    stems = set()
+    for path in (image_path, thumb_path):
+        if not path:
+            continue
+        name = path.rsplit('/', 1)[-1]
+        stems.add(os.path.splitext(name)[0])
+        try: os.remove(os.path.join(app.root_path, UPLOAD_FOLDER, name))
+        except FileNotFoundError: pass
+    # Warianty srcset tego zdjęcia też idą do kosza
+    for width in VARIANT_WIDTHS:
+        for fmt in VARIANT_FORMATS:
+            for stem in stems:
+                try: os.remove(os.path.join(app.root_path, VARIANT_FOLDER, str(width), f"{stem}.{fmt}"))
+                except FileNotFoundError: pass
+
+def purge_uploads(grace_minutes=UPLOAD_GRACE_MINUTES):
+    """Usuwa pliki, do których nic już nie prowadzi (refcount <= 0 dłużej niż grace_minutes)."""
+    with app.app_context():
+        cutoff = _utc_now_str(grace_minutes)
+        candidates = db.session.query(UploadFile.id, UploadFile.image_path, UploadFile.thumb_path).filter(
+            UploadFile.refcount <= 0, UploadFile.updated_at <= cutoff).all()
+        if not candidates:
+            return 0
+        # Zanim cokolwiek skasujemy - liczymy referencje jeszcze raz (dryf licznika = zero szkody)
+        actual = _reference_counts([r.image_path for r in candidates])
+        removed = 0
+        for file_id, image_path, thumb_path in candidates:
+            if actual.get(image_path):
+                UploadFile.query.filter_by(id=file_id).update({'refcount': actual[image_path]})
+                db.session.commit()
+                continue
+            deleted = db.session.execute(db.text(
+                "DELETE FROM upload_file WHERE id = :id AND refcount <= 0 AND updated_at <= :cutoff"
+            ), {'id': file_id, 'cutoff': cutoff}).rowcount
+            db.session.commit() # najpierw wpis, potem pliki - nowy upload nie dostanie "martwego" wpisu
+            if deleted:
+                _remove_upload_files(image_path, thumb_path)
+                removed += 1
+        if removed:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] MAGAZYN ZDJĘĆ: usunięto {removed} nieużywanych plików.")
+        return removed
+
+
+# --- TOKENY SKANU AI (ZDJĘCIE WGRANE RAZ) ---
+# Skan z telefonu szedł dwa razy: do /api/analyze-* (Gemini) i jeszcze raz w formularzu /dodaj.
+# Teraz endpoint analizy od razu zleca obróbkę do puli (równolegle z Gemini) i oddaje scan_token,
+# nie czekając na wynik - ścieżka w magazynie wynika z hasha, więc jest znana od razu.
+# Formularz wysyła token, a plik skanu zostaje w telefonie. Token jest jednorazowy i ważny
+# SCAN_TOKEN_TTL_MINUTES; porzucone kasuje purge_scan_tokens(), a plik bez innych referencji
+# sprząta potem zwykły purge_uploads().
+SCAN_TOKEN_TTL_MINUTES = 60
+SCAN_TOKEN_WAIT = 10 # sekundy, ile /dodaj czeka na plik skanu, który jeszcze się obrabia
+# Formularz nie wysłał pliku skanu (poszedł token), a token już nic nie daje - użytkownik musi wiedzieć
+SCAN_TOKEN_LOST = 'Zdjęcie ze skanu AI nie zostało zapisane (minęło za dużo czasu albo obróbka się nie udała). Dodaj je ponownie w edycji ogłoszenia.'
+
+def submit_scan_image(file, data):
+    """Zleca obróbkę skanu jak zdjęcia ogłoszenia; None dla formatów, których /dodaj i tak nie przyjmie."""
+    if not file.filename or not allowed_file(file.filename):
+        return None
+    return submit_image_data(data)
+
+def _finish_scan_image(job):
+    # Wynik obróbki (lqip, kolor) dopisujemy do wpisu magazynu w tle - odpowiedź AI już poszła
+    def worker():
+        with app.app_context():
+            try:
+                collect_images([job])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Błąd obróbki skanu: {e}")
+    Thread(target=worker, daemon=True).start()
+
+def issue_scan_token(job, user_id):
+    """Wydaje token od razu (bez czekania na obróbkę) albo None - wtedy formularz wyśle plik jak dawniej."""
+    if job is None:
+        return None
+    future, digest, filename, thumb_filename = job
+    zdj = {'image_path': upload_url(filename), 'thumb_path': upload_url(thumb_filename)}
+    try:
+        # Wpis magazynu przed tokenem - trigger od razu liczy referencję, purge_uploads nie ruszy pliku
+        register_upload(digest, dict(zdj, lqip=None, dominant_color=None))
+        token = uuid.uuid4().hex
+        db.session.add(ScanToken(token=token, user_id=user_id, created_at=_utc_now_str(), **zdj))
         db.session.commit()
-    return current_user.ai_requests_today < 1000
+    except Exception as e:
+        db.session.rollback()
+        print(f"Błąd tokenu skanu: {e}")
+        return None
+    if future.done():
+        collect_images([job]) # plik był już w magazynie - nic nie czeka
+        db.session.commit()
+    else:
+        _finish_scan_image(job)
+    return token
+
+def scan_response(payload, job, status=200):
+    """Odpowiedź /api/analyze-* z tokenem skanu - także przy błędach AI, bo zdjęcie i tak trafi do /dodaj."""
+    return jsonify(dict(payload, scan_token=issue_scan_token(job, current_user.id))), status
+
+def _wait_for_upload(paths, timeout):
+    # Pliki zapisuje obrazy.py przez os.replace - jak już są, to w całości
+    full_paths = [os.path.join(app.root_path, p.lstrip('/')) for p in paths if p]
+    deadline = time.monotonic() + timeout
+    while not all(os.path.exists(p) for p in full_paths):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+def find_scan_token(token, user_id):
+    """(wpis, pola CarImage) dla zdjęcia spod tokenu albo (None, None). Tylko odczyt: wołać po
+    submit_images(), a przed collect_images() - czekanie na plik nie może trzymać blokady zapisu SQLite.
+    Wpis kasuje route (db.session.delete) razem z commitem ogłoszenia - referencja przechodzi
+    z scan_token na car/car_image w tej samej transakcji."""
+    if not token:
+        return None, None
+    row = ScanToken.query.filter(ScanToken.token == token, ScanToken.user_id == user_id,
+                                 ScanToken.created_at > _utc_now_str(SCAN_TOKEN_TTL_MINUTES)).first()
+    # Formularz wysłany tuż po skanie: obróbka (w dowolnym workerze) mogła jeszcze nie skończyć
+    if not row or not _wait_for_upload((row.image_path, row.thumb_path), SCAN_TOKEN_WAIT):
+        return None, None
+    known = UploadFile.query.filter_by(image_path=row.image_path).first()
+    zdj = {'image_path': row.image_path, 'thumb_path': row.thumb_path,
+           'lqip': known.lqip if known else None, 'dominant_color': known.dominant_color if known else None}
+    if not zdj['lqip']:
+        # Obróbka skończyła się przed chwilą i wynik nie zdążył do bazy - placeholder z miniatury (16 px, tanio)
+        try:
+            with Image.open(os.path.join(app.root_path, (row.thumb_path or row.image_path).lstrip('/'))) as image:
+                zdj.update(obrazy.placeholder(image))
+        except Exception as e:
+            print(f"Placeholder skanu: {e}")
+    return row, zdj
+
+def purge_scan_tokens(ttl_minutes=SCAN_TOKEN_TTL_MINUTES):
+    with app.app_context():
+        deleted = db.session.execute(db.text("DELETE FROM scan_token WHERE created_at <= :cutoff"),
+                                     {'cutoff': _utc_now_str(ttl_minutes)}).rowcount
+        db.session.commit()
+        if deleted:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] TOKENY SKANU: usunięto {deleted} porzuconych.")
+        return deleted
+
+
+# --- WARIANTY ZDJĘĆ (SRCSET) ---
+# Karty na liście mają ~230px wysokości, a dostawały pełne 1920px. /img/<szer>/<format>/<plik>
+# generuje mniejszą kopię przy pierwszym żądaniu i trzyma ją na dysku (limit VARIANT_CACHE_MAX_MB).
+# Kodowanie (AVIF/WebP) idzie do puli procesów zdjęć, jedno na (plik, szerokość, format) - zimna lista
+# z kilkudziesięcioma kartami nie zajmuje wszystkich workerów; do czasu zapisu leci oryginał.
+VARIANT_WIDTHS = (320, 480, 640, 960, 1280)
+VARIANT_FORMATS = ('avif', 'webp') if features.check('avif') else ('webp',)
+VARIANT_FOLDER = os.path.join(UPLOAD_FOLDER, '_warianty')
+VARIANT_CACHE_MAX_MB = 1024
+_variant_inflight = {}
+_variant_lock = Lock()
+
+def _upload_name(url):
+    # '/static/uploads/abc.webp' -> 'abc.webp'; zewnętrzne linki i placeholdery -> None
+    prefix = app.static_url_path + '/uploads/'
+    if url and url.startswith(prefix):
+        name = url[len(prefix):]
+        if name and '/' not in name:
+            return name
+    return None
+
+@app.template_global()
+def lqip_style(lqip=None, color=None):
+    # Tło <img> do czasu doładowania WebP: rozmyty podgląd 16px na kolorze dominującym
+    if not lqip and not color:
+        return ''
+    css = f"background-color: {color};" if color else ''
+    if lqip:
+        css += f" background-image: url('{lqip}'); background-size: cover; background-position: center;"
+    return css.strip()
+
+@app.template_global()
+def img_srcset(url, fmt='webp'):
+    """srcset dla zdjęcia z uploads; pusty string, gdy wariantów nie ma (wtedy zostaje samo src)."""
+    name = _upload_name(url)
+    if not name or fmt not in VARIANT_FORMATS:
+        return ''
+    return ', '.join(f"{url_for('img_variant', width=w, fmt=fmt, name=name)} {w}w" for w in VARIANT_WIDTHS)
+
+def submit_variant(src, out_path, width, fmt):
+    """Zleca wariant do puli, chyba że ten sam już się koduje (single-flight w obrębie procesu)."""
+    key = (out_path, width, fmt)
+    with _variant_lock:
+        if key in _variant_inflight:
+            return _variant_inflight[key]
+        try:
+            future = get_image_pool().submit(obrazy.wariant, src, out_path, width, fmt)
+        except Exception as e:
+            print(f"Pula zdjęć niedostępna (wariant): {e}")
+            _reset_image_pool()
+            return None
+        _variant_inflight[key] = future
+
+    def done(f):
+        with _variant_lock:
+            _variant_inflight.pop(key, None)
+        if f.exception():
+            print(f"Błąd wariantu {width}/{fmt}/{os.path.basename(src)}: {f.exception()}")
+    future.add_done_callback(done)
+    return future
+
+@app.route('/img/<int:width>/<fmt>/<name>')
+def img_variant(width, fmt, name):
+    if width not in VARIANT_WIDTHS or fmt not in VARIANT_FORMATS or name.startswith('.'):
+        abort(404)
+    folder = os.path.join(app.root_path, VARIANT_FOLDER, str(width))
+    out_name = f"{os.path.splitext(name)[0]}.{fmt}"
+    out_path = os.path.join(folder, out_name)
+    try:
+        st = os.stat(out_path)
+        # Przybliżone LRU dla prune_variants(): mtime odświeżamy najwyżej raz na dobę
+        if time.time() - st.st_mtime > 86400:
+            os.utime(out_path)
+    except FileNotFoundError:
+        src = os.path.join(app.root_path, UPLOAD_FOLDER, name)
+        if not os.path.isfile(src):
+            abort(404)
+        os.makedirs(folder, exist_ok=True)
+        submit_variant(src, out_path, width, fmt)
+        return redirect(upload_url(name)) # 302 nie trafia do cache - kolejne żądanie dostanie już wariant
+    # Wariant nazywa się jak oryginał (hash/uuid), więc też jest niezmienny
+    return serve_file(folder, out_name, immutable=True, etag=f"{os.path.splitext(name)[0]}-{width}-{fmt}")
+
+def prune_variants():
+    """Pilnuje limitu cache wariantów: usuwa najdawniej używane pliki (i porzucone .tmp)."""
+    root = os.path.join(app.root_path, VARIANT_FOLDER)
+    files, total = [], 0
+    for dirpath, _, names in os.walk(root):
+        for n in names:
+            path = os.path.join(dirpath, n)
+            try: st = os.stat(path)
+            except FileNotFoundError: continue
+            if n.endswith('.tmp') and time.time() - st.st_mtime > 3600:
+                os.remove(path)
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    limit = VARIANT_CACHE_MAX_MB * 1024 * 1024
+    if total <= limit:
+        return 0
+    removed = 0
+    for mtime, size, path in sorted(files):
+        if total <= limit * 0.9: # z zapasem, żeby nie sprzątać co godzinę
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except FileNotFoundError:
+            pass
+    print(f"🧹 Cache wariantów zdjęć: usunięto {removed} plików")
+    return removed
+
+
+# --- SERWOWANIE PLIKÓW (CACHE, ETAG, RANGE, X-ACCEL) ---
+# Nazwy w uploads się nie powtarzają (hash treści, starsze: uuid), więc przeglądarka trzyma je rok
+# bez rewalidacji. Pliki o stałych nazwach (360_videos/<id>.mp4, sprite'y 360_renders, style.css) dostają ?v=<mtime>
+# (static_version) - podmiana pliku = nowy URL. Bez ?v= jest tylko tania rewalidacja po ETagu (304).
+# UPLOAD_SENDFILE=x-accel -> Flask tylko sprawdza i ustawia nagłówki, bajty (i Range) wysyła nginx:
+#   location /_pliki/ { internal; alias /sciezka/do/aplikacji/static/; }
+STATIC_MAX_AGE = 365 * 24 * 3600
+UPLOAD_SENDFILE = os.environ.get('UPLOAD_SENDFILE', '').lower() # '', 'x-accel' albo 'x-sendfile' (Apache)
+UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/_pliki/')
+app.config['USE_X_SENDFILE'] = UPLOAD_SENDFILE == 'x-sendfile'
+IMMUTABLE_NAME = re.compile(r'^(thumb_)?[0-9a-f]{32}\.[a-z0-9]+$')
+
+def file_version(st):
+    return format(st.st_mtime_ns // 1000000, 'x')
+
+@app.url_defaults
+def static_version(endpoint, values):
+    # Pliki z magazynu (nazwa = hash, IMMUTABLE_NAME) pomijamy - i tak są niezmienne, a ich ścieżki
+    # trafiają do bazy i muszą zgadzać się z triggerami licznika referencji
+    filename = values.get('filename')
+    if endpoint == 'static' and filename and 'v' not in values and not IMMUTABLE_NAME.match(filename.rsplit('/', 1)[-1]):
+        try:
+            values['v'] = file_version(os.stat(os.path.join(app.static_folder, filename)))
+        except OSError:
+            pass
+
+def _cache_headers(response, immutable):
+    if immutable:
+        response.cache_control.no_cache = None # send_file domyślnie wymusza rewalidację
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    return response
+
+def serve_file(folder, name, immutable=False, etag=None):
+    """Plik z dysku z silnym ETagiem, Range (206) i nagłówkami cache; opcjonalnie wysyłany przez nginx.
+
+    immutable=False + zgodne ?v= w żądaniu -> też niezmienny (URL wskazuje konkretną wersję).
+    """
+    path = safe_join(folder, name)
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        abort(404)
+    immutable = immutable or request.args.get('v') == file_version(st)
+    etag = etag or f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+    if UPLOAD_SENDFILE == 'x-accel':
+        # nginx nie zna naszego ETaga - 304 rozstrzygamy tutaj, resztę (w tym Range) robi nginx
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            rel = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = UPLOAD_ACCEL_PREFIX + rel
+        response.set_etag(etag)
+        return _cache_headers(response, immutable)
+
+    # send_file: If-None-Match -> 304, Range -> 206 (przewijanie wideo 360), USE_X_SENDFILE -> Apache
+    response = send_file(path, etag=etag, conditional=True)
+    return _cache_headers(response, immutable)
+
+@app.route('/static/uploads/<path:filename>')
+def uploads(filename):
+    # Bardziej szczegółowa reguła niż /static/<path> - wszystkie pliki użytkowników idą tędy
+    name = filename.rsplit('/', 1)[-1]
+    if name.startswith('.') or name.endswith('.tmp'): # pliki w trakcie zapisu nie wychodzą na zewnątrz
+        abort(404)
+    folder = os.path.join(app.root_path, UPLOAD_FOLDER)
+    if IMMUTABLE_NAME.match(name):
+        return serve_file(folder, filename, immutable=True, etag=os.path.splitext(name)[0])
+    return serve_file(folder, filename)
+
+@app.after_request
+def static_cache(response):
+    # Zwykły /static/ (css, logo): URL z aktualnym ?v= można trzymać w cache bez rewalidacji
+    if request.endpoint == 'static' and response.status_code in (200, 206, 304):
+        try:
+            st = os.stat(os.path.join(app.static_folder, request.view_args['filename']))
+        except (OSError, KeyError, TypeError):
+            return response
+        _cache_headers(response, request.args.get('v') == file_version(st))
+    return response
+
+
+
+
+
+
+
+# --- DZIENNY LIMIT AI (JEDEN WARUNKOWY UPDATE) ---
+# Sprawdzenie i pobranie limitu to jedno UPDATE ... WHERE ai_requests_today < limit: równoległe
+# żądania nie przekroczą limitu, a reset o północy nie jest zapisywany osobno - licznik z innego dnia
+# traktujemy jak zero (i nadpisujemy przy pierwszym użyciu). Nieudane wywołanie AI oddaje jednostkę.
+# Limity siedzą w app.config: zmienna AI_LIMIT_<TYP> (np. AI_LIMIT_COMPANY=20) nadpisuje domyślne.
+# Klucze = account_type (+ 'admin'); nieznany typ konta dostaje limit 'private'.
+app.config['AI_LIMITS'] = {typ: int(os.environ.get(f'AI_LIMIT_{typ.upper()}', domyslny))
+                           for typ, domyslny in (('private', 6), ('company', 6), ('admin', 500))}
+# Opisy liczą się do tego samego licznika, ale blokują dopiero przy tym pułapie
+app.config['AI_LIMIT_OPIS'] = int(os.environ.get('AI_LIMIT_OPIS', 1000))
+
+@app.template_global()
+def ai_limit(user):
+    limity = app.config['AI_LIMITS']
+    if user.username == 'admin' or user.id == 1:
+        return limity['admin']
+    return limity.get(user.account_type or 'private', limity['private'])
+
+def _ai_dzis():
+    return datetime.utcnow().date()
+
+@app.template_global()
+def ai_used_today(user):
+    return (user.ai_requests_today or 0) if user.last_ai_request_date == _ai_dzis() else 0
+
+def ai_quota_take(user_id, limit):
+    """Pobiera jedno zapytanie z dziennego limitu. False = limit wyczerpany."""
+    today = _ai_dzis()
+    nowy_dzien = or_(User.last_ai_request_date.is_(None), User.last_ai_request_date != today)
+    taken = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, or_(nowy_dzien, db.func.coalesce(User.ai_requests_today, 0) < limit))
+        .values(ai_requests_today=db.case((nowy_dzien, 1), else_=db.func.coalesce(User.ai_requests_today, 0) + 1),
+                last_ai_request_date=today),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    db.session.commit()
+    return bool(taken)
+
+def ai_quota_refund(user_id):
+    # Tylko dzisiejszy licznik - po północy nie ma czego oddawać
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.last_ai_request_date == _ai_dzis(), User.ai_requests_today > 0)
+        .values(ai_requests_today=User.ai_requests_today - 1),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
 
 
 
 def update_market_valuation(car):
-    if not model_ai: return
+    if not model_ai:
+        return apply_local_valuation(car)
 
-    # 1. PRZYGOTOWANIE ZDJĘCIA DO ANALIZY LAKIERU
+    # 0. TANI PIERWSZY PRZEBIEG: świeża wycena Gemini, a podobne ogłoszenia potwierdzają werdykt -> bez zapytania
+    if local_valuation_confirms(car):
+        car.ai_valuation_data = datetime.now().strftime("%Y-%m-%d")
+        db.session.commit()
+        return True
+
+    # 1. CZĘŚĆ WSPÓLNA DLA SPECYFIKACJI (widełki, spalanie, klasa, silnik) - z cache albo jedno zapytanie
+    spec = get_spec_valuation(car)
+    if spec is None:
+        return apply_local_valuation(car) if not car.ai_label else False
+
+    # 2. PRZYGOTOWANIE ZDJĘCIA DO ANALIZY LAKIERU
     img_path = car.img
     if 'static/' in img_path:
-        img_path = img_path.replace(url_for('static', filename=''), 'static/')
+        # Bez url_for - funkcja działa też w wątku kolejki wycen (bez kontekstu żądania)
+        img_path = img_path.replace(app.static_url_path + '/', 'static/')
         if img_path.startswith('/'): img_path = img_path[1:] 
     
     image_file = None
@@ -502,22 +1213,21 @@ def update_market_valuation(car):
     except Exception as e:
         print(f"Błąd zdjęcia dla AI: {e}")
 
-        # 2. KOMPLEKSOWY I RESTRYKCYJNY PROMPT DLA GEMINI
+    # 3. PROMPT TYLKO DLA TEGO OGŁOSZENIA (zdjęcie + cena na tle gotowych widełek)
     prompt = f"""
-    Jesteś rzeczoznawcą samochodowym i ekspertem technicznym.
+    Jesteś rzeczoznawcą samochodowym.
     Analizujesz BEZWZGLĘDNIE auto o poniższych parametrach:
     Marka i model: {car.marka} {car.model}
     Rok produkcji: {car.rok}
     Przebieg: {car.przebieg} km
     Cena: {car.cena} {car.waluta}
-    DOKŁADNY SILNIK DO ANALIZY: Pojemność: {car.pojemnosc}, Paliwo: {car.paliwo}, Moc: {car.moc} KM.
+    Silnik: {car.pojemnosc} {car.paliwo} {car.moc} KM.
+    Rynkowe widełki w Polsce dla tej specyfikacji (już ustalone, NIE zmieniaj ich): Min {spec.get('pl_min')} PLN, Średnia {spec.get('pl_avg')} PLN, Max {spec.get('pl_max')} PLN.
     
-    ZADANIA DO WYKONANIA (MUSISZ OPISYWAĆ TYLKO SILNIK {car.pojemnosc} {car.paliwo} {car.moc} KM, zignoruj ewentualne znaczki na klapie ze zdjęcia):
+    ZADANIA DO WYKONANIA:
     1. Stan Wizualny: Oceń stan lakieru/blacharki ze zdjęcia (w skali 1-10) i krótko go opisz.
-    2. Wycena Rynkowa: Podaj widełki (Min-Max) i Średnią dla tego auta z tym silnikiem w Polsce.
-    3. Analiza Ceny: Napisz 1-2 zdania tłumaczące, dlaczego ta konkretna cena ({car.cena} {car.waluta}) jest adekwatna do rynku.
-    4. Efektywność Energetyczna: Podaj realne średnie spalanie (miasto, trasa, mieszany) DLA SILNIKA {car.pojemnosc} {car.paliwo} oraz przydziel klasę (od A do G).
-    5. Ekspertyza Silnika: Napisz 2-3 zdania opinii DOTYCZĄCEJ WYŁĄCZNIE JEDNOSTKI {car.pojemnosc} {car.paliwo} (typowe usterki tego silnika, na co uważać). Jeśli nie znasz tego silnika, napisz "Brak wystarczających danych o tej jednostce".
+    2. Analiza Ceny: Napisz 1-2 zdania tłumaczące, dlaczego ta konkretna cena ({car.cena} {car.waluta}) jest adekwatna do rynku (odnieś się do widełek).
+    3. Werdykt: oceń atrakcyjność ceny na tle widełek.
     
     Zwróć TYLKO czysty JSON bez formatowania markdown:
 
@@ -525,37 +1235,917 @@ def update_market_valuation(car):
         "score": (liczba 1-100),
         "label": (np. "SUPER OKAZJA", "DOBRA CENA", "DROGO"),
         "color": ("success", "warning", "info", "danger"),
+        "paint_score": (liczba 1-10),
+        "paint_status": (krótki opis np. "Lakier zadbany, drobne rysy"),
+        "price_comment": (twój komentarz z punktu 2)
+    }}
+    """
+
+    try:
+        content = [prompt]
+        if image_file: content.append(image_file)
+
+        data = valuation_generate(content)
+        # Ten sam kształt JSON-a co wcześniej (ai_label, apply_valuation, szablony) - część z cache specyfikacji
+        data = dict(spec, **{k: data.get(k) for k in SPEC_LISTING_KEYS})
+        data['data_gemini'] = datetime.now().strftime("%Y-%m-%d")
+        data['cena_gemini'] = [car.cena, car.waluta] # price_comment cytuje tę cenę - patrz local_valuation_confirms
+        
+        car.ai_label = json.dumps(data, ensure_ascii=False)
+        apply_valuation(car, data)
+        car.ai_valuation_data = datetime.now().strftime("%Y-%m-%d")
+        db.session.commit()
+        return True
+    except Exception as e:
+        print(f"AI Update Market Error: {e}")
+        # Gemini niedostępny/limit: auto bez żadnej wyceny dostaje chociaż szacunek lokalny
+        return apply_local_valuation(car) if not car.ai_label else False
+
+
+# --- WSPÓLNA WYCENA DLA SPECYFIKACJI ---
+# Widełki rynkowe, spalanie, klasa energetyczna i opinia o silniku zależą tylko od specyfikacji
+# (marka, model, rok, silnik, przedział przebiegu), a nie od konkretnego ogłoszenia. Liczymy je raz
+# na SPEC_VALUATION_MAX_AGE_DAYS i dzielimy między wszystkie pasujące auta - dziesięć podobnych
+# Passatów od jednego handlarza to jedno zapytanie o rynek + dziesięć krótkich (lakier ze zdjęcia, cena).
+SPEC_VALUATION_MAX_AGE_DAYS = 14
+SPEC_PRZEBIEG_BUCKET = 25000 # km
+SPEC_KEYS = ('pl_min', 'pl_avg', 'pl_max', 'klasa_energetyczna', 'spalanie', 'engine_comment')
+SPEC_LISTING_KEYS = ('score', 'label', 'color', 'paint_score', 'paint_status', 'price_comment')
+# Stała pula blokad (klucz -> blokada po crc32): słownik blokad na klucz rósłby bez końca w długo żyjącym workerze
+SPEC_LOCK_STRIPES = 64
+_spec_locks = [Lock() for _ in range(SPEC_LOCK_STRIPES)]
+
+def _spec_part(value):
+    return ' '.join(str(value or '').lower().replace(',', '.').split())
+
+def _przebieg_bucket(car):
+    return (car.przebieg or 0) // SPEC_PRZEBIEG_BUCKET * SPEC_PRZEBIEG_BUCKET
+
+def spec_key_for(car):
+    bucket = _przebieg_bucket(car)
+    return '|'.join([_spec_part(car.marka), _spec_part(car.model), str(car.rok or ''),
+                     _spec_part(car.pojemnosc).replace(' ', ''), _spec_part(car.paliwo), str(car.moc or ''), str(bucket)])
+
+def _spec_is_fresh(row):
+    try:
+        return (datetime.now() - datetime.strptime(row.data, "%Y-%m-%d")).days < SPEC_VALUATION_MAX_AGE_DAYS
+    except (TypeError, ValueError):
+        return False
+
+def get_spec_valuation(car):
+    """Część wyceny wspólna dla specyfikacji (dict z SPEC_KEYS) albo None, gdy Gemini zawiódł."""
+    key = spec_key_for(car)
+    # Dwa auta o tej samej specyfikacji w kolejce naraz -> drugie poczeka na wynik pierwszego
+    with _spec_locks[zlib.crc32(key.encode('utf-8')) % SPEC_LOCK_STRIPES]:
+        row = SpecValuation.query.filter_by(spec_key=key).first()
+        if row and _spec_is_fresh(row):
+            try:
+                spec = json.loads(row.dane)
+                row.uzycia = (row.uzycia or 0) + 1
+                db.session.commit()
+                return spec
+            except ValueError:
+                pass
+        spec = _ask_spec_valuation(car)
+        if spec is None:
+            return None
+        db.session.execute(db.text(
+            "INSERT INTO spec_valuation (spec_key, dane, data, uzycia) VALUES (:key, :dane, :data, 1) "
+            "ON CONFLICT(spec_key) DO UPDATE SET dane = excluded.dane, data = excluded.data, uzycia = uzycia + 1"
+        ), {'key': key, 'dane': json.dumps(spec, ensure_ascii=False), 'data': datetime.now().strftime("%Y-%m-%d")})
+        db.session.commit()
+        return spec
+
+def _ask_spec_valuation(car):
+    prompt = f"""
+    Jesteś rzeczoznawcą samochodowym i ekspertem technicznym.
+    Analizujesz BEZWZGLĘDNIE auto o poniższej specyfikacji:
+    Marka i model: {car.marka} {car.model}
+    Rok produkcji: {car.rok}
+    Przebieg: {_przebieg_bucket(car)}-{_przebieg_bucket(car) + SPEC_PRZEBIEG_BUCKET} km
+    DOKŁADNY SILNIK DO ANALIZY: Pojemność: {car.pojemnosc}, Paliwo: {car.paliwo}, Moc: {car.moc} KM.
+    
+    ZADANIA DO WYKONANIA (MUSISZ OPISYWAĆ TYLKO SILNIK {car.pojemnosc} {car.paliwo} {car.moc} KM):
+    1. Wycena Rynkowa: Podaj widełki (Min-Max) i Średnią dla tego auta z tym silnikiem i przebiegiem w Polsce.
+    2. Efektywność Energetyczna: Podaj realne średnie spalanie (miasto, trasa, mieszany) DLA SILNIKA {car.pojemnosc} {car.paliwo} oraz przydziel klasę (od A do G).
+    3. Ekspertyza Silnika: Napisz 2-3 zdania opinii DOTYCZĄCEJ WYŁĄCZNIE JEDNOSTKI {car.pojemnosc} {car.paliwo} (typowe usterki tego silnika, na co uważać). Jeśli nie znasz tego silnika, napisz "Brak wystarczających danych o tej jednostce".
+    
+    Zwróć TYLKO czysty JSON bez formatowania markdown:
+
+    {{
         "pl_min": (liczba),
         "pl_avg": (liczba),
         "pl_max": (liczba),
-        "paint_score": (liczba 1-10),
-        "paint_status": (krótki opis np. "Lakier zadbany, drobne rysy"),
         "klasa_energetyczna": (litera A-G),
         "spalanie": {{
             "miasto": "X.X",
             "trasa": "X.X",
             "mieszany": "X.X"
         }},
-        "price_comment": (twój komentarz z punktu 3),
-        "engine_comment": (twoja ekspertyza z punktu 5)
+        "engine_comment": (twoja ekspertyza z punktu 3)
     }}
     """
+    try:
+        data = valuation_generate([prompt])
+        return {k: data.get(k) for k in SPEC_KEYS}
+    except Exception as e:
+        print(f"AI Spec Valuation Error: {e}")
+        return None
+
+
+# --- WYCENA AI W KOLUMNACH ---
+# JSON z Gemini zostaje w ai_label (źródło), ale parsujemy go raz - przy zapisie - do kolumn ai_*.
+AI_OCENY = ['SUPER', 'DOBRA', 'UCZCIWA', 'DROGO'] # wartości filtra ai_ocena w szukaj.html
+AI_KOLORY = ['success', 'warning', 'info', 'danger']
+
+# Pierwsza liczba w tekście: z separatorem tysięcy (spacja albo kropka + trzy cyfry) albo zwykła
+_LICZBA = re.compile(r'(?P<tysiace>\d{1,3}(?:[ \u00a0.]\d{3})+(?!\d))(?:,(?P<ulamek>\d+))?|\d+(?:[.,]\d+)?')
+
+def _num(value, cast=float):
+    """Gemini zwraca liczby raz jako 7.5, raz jako "7,5", "ok. 45 000" albo widełki "7.5-8.0".
 
+    >>> [_num(v) for v in ("ok. 45 000", "45.000", "7.5-8.0", "7,5 l/100km", "1.234,5 zł", 42, "brak")]
+    [45000.0, 45000.0, 7.5, 7.5, 1234.5, 42.0, None]
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return cast(value)
+    m = _LICZBA.search(str(value))
+    if not m:
+        return None
+    if m.group('tysiace'):
+        liczba = re.sub(r'[ \u00a0.]', '', m.group('tysiace')) + ('.' + m.group('ulamek') if m.group('ulamek') else '')
+    else:
+        liczba = m.group(0).replace(',', '.')
+    return cast(float(liczba))
+
+def apply_valuation(car, data):
+    """Przepisuje sparsowany JSON wyceny na kolumny ai_* (bez commita)."""
+    if not isinstance(data, dict):
+        data = {}
+    werdykt = str(data.get('label') or '').strip().upper()
+    spalanie = data.get('spalanie') if isinstance(data.get('spalanie'), dict) else {}
+    klasa = str(data.get('klasa_energetyczna') or '').strip().upper()[:1]
+    kolor = data.get('color')
+
+    car.ai_werdykt = werdykt[:50]  # pusty string = "sparsowane, brak danych" (backfill nie wraca)
+    car.ai_ocena = next((o for o in AI_OCENY if o in werdykt), None)
+    car.ai_score = _num(data.get('score'), int)
+    car.ai_kolor = kolor if kolor in AI_KOLORY else 'info'
+    car.ai_pl_min = _num(data.get('pl_min'))
+    car.ai_pl_avg = _num(data.get('pl_avg'))
+    car.ai_pl_max = _num(data.get('pl_max'))
+    car.ai_paint_score = _num(data.get('paint_score'), int)
+    paint = data.get('paint_status')
+    car.ai_paint_status = str(paint)[:200] if paint else None
+    car.ai_klasa = klasa if klasa and klasa in 'ABCDEFG' else None
+    car.ai_spalanie_miasto = _num(spalanie.get('miasto'))
+    car.ai_spalanie_trasa = _num(spalanie.get('trasa'))
+    car.ai_spalanie_mieszany = _num(spalanie.get('mieszany'))
+    car.ai_price_comment = data.get('price_comment') or None
+    car.ai_engine_comment = data.get('engine_comment') or data.get('expert_comment') or None
+
+def backfill_valuations(batch=500):
+    """Jednorazowa migracja: rozpisuje istniejące ai_label na kolumny. Zwraca liczbę aut."""
+    done = 0
+    with app.app_context():
+        while True:
+            cars = Car.query.filter(Car.ai_label.isnot(None), Car.ai_werdykt.is_(None)).limit(batch).all()
+            if not cars:
+                break
+            for car in cars:
+                try: data = json.loads(car.ai_label)
+                except (ValueError, TypeError): data = None
+                apply_valuation(car, data)
+            db.session.commit()
+            done += len(cars)
+    if done:
+        print(f"✅ Wyceny AI przepisane na kolumny: {done}")
+    return done
+
+
+# --- KOLEJKA WYCEN AI (STALE-WHILE-REVALIDATE) ---
+# Strona ogłoszenia zawsze renderuje zapisaną wycenę od razu. Przeterminowana wycena trafia
+# do puli wątków w tle (max VALUATION_WORKERS naraz, jedno zadanie na auto), a details.html
+# odpytuje /api/wycena/<id> i podmienia panele, gdy przyjdzie świeży wynik.
+# "W toku" trzyma baza (car.wycena_od), nie pamięć procesu: odpytywanie może trafić do innego
+# workera gunicorna, a rezerwacja porzucona przez zabity proces wygasa po VALUATION_CLAIM_MINUTES.
+VALUATION_MAX_AGE_DAYS = 3
+VALUATION_LOCAL_MAX_AGE_DAYS = 1 # szacunek lokalny zamiast Gemini (brak klucza, limit, błąd)
+VALUATION_WORKERS = 2
+VALUATION_QUEUE_LIMIT = 50
+VALUATION_CLAIM_MINUTES = 15 # kolejka + zapytanie do Gemini z ponowieniami mieszczą się z zapasem
+_valuation_executor = ThreadPoolExecutor(max_workers=VALUATION_WORKERS, thread_name_prefix='wycena-ai')
+_valuation_inflight = set() # zadania w kolejce tego procesu (limit kolejki, bez dubli)
+_valuation_lock = Lock()
+
+def valuation_is_stale(car):
+    if car.typ in KATEGORIE_INNE:
+        return False # Wycena AI tylko dla samochodów
+    if not car.ai_valuation_data or not car.ai_label:
+        return True
+    # Szacunek lokalny (awaryjny) wymieniamy na wycenę Gemini szybciej
+    max_age = VALUATION_LOCAL_MAX_AGE_DAYS if model_ai and LOCAL_VALUATION_MARK in car.ai_label else VALUATION_MAX_AGE_DAYS
     try:
-        content = [prompt]
-        if image_file: content.append(image_file)
+        last_check = datetime.strptime(car.ai_valuation_data, "%Y-%m-%d")
+        return (datetime.now() - last_check).days >= max_age
+    except ValueError:
+        return True
+
+def valuation_pending(car):
+    return bool(car.wycena_od) and car.wycena_od > _utc_now_str(VALUATION_CLAIM_MINUTES)
+
+def _claim_valuation(car_id):
+    """Rezerwacja między workerami gunicorna: tylko jeden proces "wygra" ten UPDATE. Zwraca znacznik
+    rezerwacji (do zwolnienia) albo None. Data wyceny zostaje nietknięta aż do udanego zapisu."""
+    claim = _utc_now_str()
+    claimed = db.session.execute(
+        db.update(Car).where(Car.id == car_id, db.or_(Car.wycena_od.is_(None),
+                                                      Car.wycena_od <= _utc_now_str(VALUATION_CLAIM_MINUTES)))
+        .values(wycena_od=claim),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    db.session.commit()
+    return claim if claimed else None
 
-        response = model_ai.generate_content(content)
-        clean_json = response.text.replace('```json', '').replace('```', '').strip()
-        
-        json.loads(clean_json) # Weryfikacja
-        
-        car.ai_label = clean_json
-        car.ai_valuation_data = datetime.now().strftime("%Y-%m-%d")
+def _release_valuation(car_id, claim):
+    db.session.execute(db.update(Car).where(Car.id == car_id, Car.wycena_od == claim).values(wycena_od=None),
+                       execution_options={'synchronize_session': False})
+    db.session.commit()
+
+def enqueue_valuation(car_id):
+    """Zleca odświeżenie wyceny w tle. False = już w toku (też w innym workerze) lub kolejka pełna."""
+    # Bez model_ai też - wtedy update_market_valuation() policzy szacunek lokalny
+    with _valuation_lock:
+        if car_id in _valuation_inflight or len(_valuation_inflight) >= VALUATION_QUEUE_LIMIT:
+            return False
+        _valuation_inflight.add(car_id)
+    try:
+        claim = _claim_valuation(car_id)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Błąd rezerwacji wyceny (auto {car_id}): {e}")
+        claim = None
+    if not claim:
+        with _valuation_lock:
+            _valuation_inflight.discard(car_id)
+        return False
+    _valuation_executor.submit(_run_valuation, car_id, claim)
+    return True
+
+def _run_valuation(car_id, claim=None):
+    try:
+        with app.app_context():
+            if claim is None:
+                claim = _claim_valuation(car_id)
+                if not claim:
+                    return
+            try:
+                car = db.session.get(Car, car_id)
+                if not car or not valuation_is_stale(car):
+                    return
+                if not update_market_valuation(car):
+                    # Nieudana wycena - nic nie zapisujemy, spróbuje kolejny odwiedzający
+                    db.session.rollback()
+                    return False
+                return True
+            finally:
+                db.session.rollback()
+                _release_valuation(car_id, claim)
+    except Exception as e:
+        print(f"Błąd kolejki wycen (auto {car_id}): {e}")
+    finally:
+        with _valuation_lock:
+            _valuation_inflight.discard(car_id)
+
+def valuation_version(car):
+    # Krótki "odcisk" wyceny - szablon porównuje go przy odpytywaniu
+    return format(zlib.crc32((car.ai_label or '').encode('utf-8')), 'x')
+
+@app.route('/api/wycena/<int:car_id>')
+def api_wycena(car_id):
+    car = Car.query.get_or_404(car_id)
+    return jsonify({
+        'wersja': valuation_version(car),
+        'w_toku': valuation_pending(car),
+        'data': car.ai_valuation_data,
+    })
+
+
+
+# --- HURTOWE ODŚWIEŻANIE WYCEN (NOCĄ, Z LIMITEM ZAPYTAŃ GEMINI) ---
+# Kolejka wyżej odświeża tylko auta, które ktoś akurat ogląda. Ten job w oknie nocnym
+# (VALUATION_BATCH_HOURS) przechodzi po przeterminowanych wycenach - najpierw promowane, potem
+# najczęściej oglądane - małą pulą wątków. Każde zapytanie wyceny do Gemini (także z kolejki)
+# bierze token z kubełka, a dzienny pułap zapytań joba pilnuje kosztów. Stan dnia leży
+# w instance/wyceny_hurtowe.json, więc restart w nocy nie zeruje licznika; same auta wypadają
+# z wyboru, gdy tylko dostaną świeżą datę wyceny - kolejne uruchomienie rusza od następnych.
+GEMINI_VALUATION_RPM = 20        # zapytań na minutę w obrębie procesu
+GEMINI_VALUATION_BURST = 5
+GEMINI_VALUATION_WAIT = 60       # sekund czekania na token - dłużej nie, wycena spróbuje później
+VALUATION_BATCH_HOURS = '1-5'    # okno poza szczytem (cron, czas serwera)
+VALUATION_BATCH_EVERY_MINUTES = 10
+VALUATION_BATCH_WORKERS = 2
+VALUATION_BATCH_SIZE = 100       # aut na jedno uruchomienie
+VALUATION_BATCH_TIME_BUDGET = 9 * 60   # sekund - krócej niż odstęp między uruchomieniami
+VALUATION_BATCH_DAILY_CALLS = 400      # pułap kosztów: zapytań Gemini joba na dobę
+VALUATION_BATCH_STATE = os.path.join(app.instance_path, 'wyceny_hurtowe.json')
+
+class TokenBucket:
+    """Kubełek tokenów: średnio rate_per_minute zapytań, chwilowo do capacity naraz."""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic()
+        self.taken = 0
+        self.lock = Lock()
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.taken += 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+gemini_valuation_bucket = TokenBucket(GEMINI_VALUATION_RPM, GEMINI_VALUATION_BURST)
+
+def valuation_generate(content):
+    """JSON wyceny z Gemini - przez wspólny limiter zapytań."""
+    if not gemini_valuation_bucket.acquire(timeout=GEMINI_VALUATION_WAIT):
+        raise klient_ai.AINiedostepne("limit zapytań Gemini - wycena odłożona")
+    return model_ai.json(content, rodzaj='wycena', timeout=AI_TIMEOUT_WYCENA)
+
+def stale_valuation_query():
+    # To samo co valuation_is_stale(), tylko w SQL (data 'YYYY-MM-DD' porównuje się jak tekst)
+    today = datetime.now()
+    cutoff = (today - timedelta(days=VALUATION_MAX_AGE_DAYS)).strftime("%Y-%m-%d")
+    stale = [Car.ai_valuation_data.is_(None), Car.ai_label.is_(None), Car.ai_valuation_data <= cutoff]
+    if model_ai:
+        local_cutoff = (today - timedelta(days=VALUATION_LOCAL_MAX_AGE_DAYS)).strftime("%Y-%m-%d")
+        stale.append(and_(Car.ai_label.contains(LOCAL_VALUATION_MARK), Car.ai_valuation_data <= local_cutoff))
+    return db.session.query(Car.id).filter(or_(Car.typ.is_(None), ~Car.typ.in_(KATEGORIE_INNE)), or_(*stale))
+
+def valuation_batch_state():
+    today = datetime.now().strftime("%Y-%m-%d")
+    try:
+        with open(VALUATION_BATCH_STATE) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+    if state.get('dzien') != today:
+        # Nowa doba: nowy pułap zapytań i nowa szansa dla aut, które wczoraj się nie udały
+        state = {'dzien': today, 'zapytania': 0, 'odswiezone': 0, 'bledy': 0, 'pominiete': [],
+                 'pozostalo': state.get('pozostalo'), 'ostatnio': state.get('ostatnio')}
+    return state
+
+def _save_valuation_batch_state(state):
+    os.makedirs(os.path.dirname(VALUATION_BATCH_STATE), exist_ok=True)
+    tmp = VALUATION_BATCH_STATE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, VALUATION_BATCH_STATE)
+
+def _batch_valuation(car_id):
+    # Wspólny zbiór z kolejką: auto oglądane właśnie przez kogoś nie dostanie drugiego zadania
+    with _valuation_lock:
+        if car_id in _valuation_inflight:
+            return None
+        _valuation_inflight.add(car_id)
+    return _run_valuation(car_id) # zdejmuje car_id z _valuation_inflight
+
+def refresh_stale_valuations():
+    """Jedno uruchomienie joba: odświeża przeterminowane wyceny aż do limitu czasu albo pułapu zapytań."""
+    # Każdy worker gunicorna ma swój harmonogram - mieli tylko ten, który złapie blokadę pliku
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock = open(VALUATION_BATCH_STATE + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return 0
+    try:
+        return _refresh_stale_valuations()
+    finally:
+        lock.close()
+
+def _refresh_stale_valuations():
+    state = valuation_batch_state()
+    if state['zapytania'] >= VALUATION_BATCH_DAILY_CALLS:
+        return 0
+    deadline = time.monotonic() + VALUATION_BATCH_TIME_BUDGET
+    with app.app_context():
+        query = stale_valuation_query()
+        state['pozostalo'] = query.count()
+        ids = [r[0] for r in query.filter(~Car.id.in_(state['pominiete']))
+               .order_by(Car.is_promoted.desc(), Car.views.desc(), Car.id).limit(VALUATION_BATCH_SIZE)]
+        db.session.rollback()
+    if not ids:
+        _save_valuation_batch_state(state)
+        return 0
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=VALUATION_BATCH_WORKERS, thread_name_prefix='wycena-noc') as pool:
+        for start in range(0, len(ids), VALUATION_BATCH_WORKERS):
+            if time.monotonic() > deadline or state['zapytania'] >= VALUATION_BATCH_DAILY_CALLS:
+                break
+            chunk = ids[start:start + VALUATION_BATCH_WORKERS]
+            # Licznik kubełka obejmuje też zapytania kolejki z tego procesu - nocą to pomijalne
+            taken = gemini_valuation_bucket.taken
+            for car_id, ok in zip(chunk, pool.map(_batch_valuation, chunk)):
+                if ok:
+                    done += 1
+                    state['odswiezone'] += 1
+                elif ok is False:
+                    # Nieudane auto nie wraca do kolejnych paczek tej doby
+                    state['bledy'] += 1
+                    state['pominiete'].append(car_id)
+            state['zapytania'] += gemini_valuation_bucket.taken - taken
+            state['pozostalo'] = max(0, state['pozostalo'] - len(chunk))
+            state['ostatnio'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            _save_valuation_batch_state(state)
+
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] WYCENY NOCNE: odświeżono {done}, "
+          f"dziś {state['odswiezone']} (błędy {state['bledy']}), zapytania Gemini "
+          f"{state['zapytania']}/{VALUATION_BATCH_DAILY_CALLS}, zostało ~{state['pozostalo']}")
+    return done
+
+@app.route('/admin/wyceny')
+@login_required
+def admin_wyceny():
+    if current_user.username != 'admin' and current_user.id != 1:
+        abort(403)
+    state = valuation_batch_state()
+    state['pominiete'] = len(state['pominiete'])
+    state['limit_zapytan'] = VALUATION_BATCH_DAILY_CALLS
+    state['okno'] = VALUATION_BATCH_HOURS
+    with _valuation_lock:
+        state['w_kolejce'] = len(_valuation_inflight)
+    return jsonify(state)
+
+@app.route('/admin/ai')
+@login_required
+def admin_ai():
+    # Metryki klienta Gemini tego procesu (każdy worker gunicorna liczy osobno)
+    if current_user.username != 'admin' and current_user.id != 1:
+        abort(403)
+    if not model_ai:
+        return jsonify({'backend': None})
+    return jsonify({
+        'backend': type(model_ai.backend).__name__,
+        'bezpiecznik': model_ai.bezpiecznik.stan,
+        'rodzaje': model_ai.metryki.raport(),
+    })
+
+
+
+# --- LOKALNY SZACUNEK CENY (kNN NA PODOBNYCH OGŁOSZENIACH) ---
+# Kolumny wszystkich aut (rok, przebieg, moc, pojemność, paliwo, cena w PLN) trzymamy w pamięci
+# w tablicach NumPy (wycena_lokalna.KolumnyAut). Triggery dopisują id zmienionych aut do car_zmiana,
+# więc synchronizacja dociąga tylko te wiersze. Szacunek to ułamek milisekundy - służy jako
+# wycena awaryjna (brak model_ai / limit Gemini) i jako filtr: czy odświeżenie w Gemini coś zmieni.
+PRICE_STORE_SYNC_SECONDS = 30
+PRICE_CHANGES_KEEP_HOURS = 24
+PRICE_COLUMNS = ('marka', 'model', 'rok', 'przebieg', 'moc', 'pojemnosc', 'paliwo', 'cena', 'waluta', 'typ')
+LOCAL_CONFIRM_MIN_SAME_MODEL = 5 # tyle ogłoszeń tego samego modelu, by ufać szacunkowi bardziej niż zgadywaniu
+VALUATION_GEMINI_MAX_AGE_DAYS = 30 # i tak pytamy Gemini co najmniej tak często
+LOCAL_VALUATION_MARK = '"zrodlo": "lokalna"'
+_price_store = wycena_lokalna.KolumnyAut()
+_price_store_state = {'seq': None, 'synced': None}
+_price_store_lock = Lock()
+
+def init_price_estimator():
+    """Dziennik zmian aut (car_zmiana) utrzymywany triggerami - dla przyrostowej synchronizacji."""
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            c = conn.cursor()
+            c.execute("CREATE TABLE IF NOT EXISTS car_zmiana (seq INTEGER PRIMARY KEY AUTOINCREMENT, car_id INTEGER NOT NULL, "
+                      "kiedy TEXT NOT NULL DEFAULT (datetime('now')))")
+            c.execute("CREATE INDEX IF NOT EXISTS ix_car_zmiana_kiedy ON car_zmiana (kiedy)")
+            c.execute("CREATE TRIGGER IF NOT EXISTS car_zmiana_ai AFTER INSERT ON car BEGIN INSERT INTO car_zmiana (car_id) VALUES (new.id); END")
+            c.execute("CREATE TRIGGER IF NOT EXISTS car_zmiana_ad AFTER DELETE ON car BEGIN INSERT INTO car_zmiana (car_id) VALUES (old.id); END")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS car_zmiana_au AFTER UPDATE OF {', '.join(PRICE_COLUMNS)} ON car "
+                      "BEGIN INSERT INTO car_zmiana (car_id) VALUES (new.id); END")
+            conn.commit()
+        finally:
+            conn.close()
+
+def prune_price_changes():
+    with app.app_context():
+        db.session.execute(db.text("DELETE FROM car_zmiana WHERE kiedy < datetime('now', :wiek)"),
+                           {'wiek': f"-{PRICE_CHANGES_KEEP_HOURS} hours"})
         db.session.commit()
+
+def _load_price_rows(ids=None):
+    query = db.session.query(Car.id, *[getattr(Car, c) for c in PRICE_COLUMNS])
+    if ids is not None:
+        query = query.filter(Car.id.in_(ids))
+    for row in query:
+        _price_store.upsert(row.id, row.marka, row.model, row.rok, row.przebieg, row.moc, row.pojemnosc,
+                            row.paliwo, row.cena, row.waluta, aktywne=row.typ not in KATEGORIE_INNE)
+        if ids is not None:
+            ids.discard(row.id)
+
+def sync_price_store(force=False):
+    """Dociąga zmienione auta do KolumnyAut (najwyżej raz na PRICE_STORE_SYNC_SECONDS)."""
+    now = time.monotonic()
+    with _price_store_lock:
+        synced = _price_store_state['synced']
+        if not force and synced is not None and now - synced < PRICE_STORE_SYNC_SECONDS:
+            return
+        try:
+            max_seq = db.session.execute(db.text("SELECT COALESCE(MAX(seq), 0) FROM car_zmiana")).scalar()
+        except Exception:
+            db.session.rollback()
+            max_seq = None # brak dziennika (init_price_estimator nie był wołany) - zawsze pełne przeładowanie
+        last_seq = _price_store_state['seq']
+        # Pełne przeładowanie: pierwszy raz, brak dziennika albo długa przerwa (dziennik mógł być już przycięty)
+        if last_seq is None or max_seq is None or now - synced > PRICE_CHANGES_KEEP_HOURS * 3600 / 2:
+            _price_store.wyczysc()
+            _load_price_rows()
+        elif max_seq > last_seq:
+            changed = [r[0] for r in db.session.execute(
+                db.text("SELECT DISTINCT car_id FROM car_zmiana WHERE seq > :seq"), {'seq': last_seq})]
+            for i in range(0, len(changed), 500):
+                missing = set(changed[i:i + 500])
+                _load_price_rows(missing)
+                for car_id in missing: # nie ma już w bazie
+                    _price_store.usun(car_id)
+        _price_store_state.update(seq=max_seq, synced=now)
+
+def estimate_price(car):
+    """Szacunek z podobnych ogłoszeń: pl_min/pl_avg/pl_max, label/color/score, porownan; None = za mało danych."""
+    sync_price_store()
+    with _price_store_lock:
+        return _price_store.szacuj(car.marka, car.model, car.rok, car.przebieg, car.moc, car.pojemnosc,
+                                   car.paliwo, car.cena, car.waluta, pomin_id=car.id)
+
+def _valuation_dict(car):
+    try:
+        data = json.loads(car.ai_label) if car.ai_label else {}
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def local_valuation_confirms(car):
+    """True, gdy odświeżanie w Gemini nic nie wniesie: jego wycena jest świeża, a werdykt z podobnych ogłoszeń ten sam.
+
+    Nigdy po ręcznym odświeżeniu (admin zeruje ai_valuation_data) ani po zmianie ceny - komentarz Gemini ją cytuje.
+    """
+    if car.ai_valuation_data is None:
+        return False
+    previous = _valuation_dict(car)
+    if previous.get('cena_gemini') != [car.cena, car.waluta]:
+        return False
+    try:
+        age = (datetime.now() - datetime.strptime(previous.get('data_gemini', ''), "%Y-%m-%d")).days
+    except ValueError:
+        return False
+    if age >= VALUATION_GEMINI_MAX_AGE_DAYS or not car.ai_ocena:
+        return False
+    est = estimate_price(car)
+    if not est or 'label' not in est or est['ten_model'] < LOCAL_CONFIRM_MIN_SAME_MODEL:
+        return False
+    return car.ai_ocena in est['label']
+
+def apply_local_valuation(car):
+    """Wycena awaryjna bez Gemini: widełki i werdykt z podobnych ogłoszeń (reszta poprzedniej wyceny zostaje)."""
+    est = estimate_price(car)
+    if not est or 'label' not in est:
+        return False
+    data = _valuation_dict(car)
+    data.update({k: est[k] for k in ('pl_min', 'pl_avg', 'pl_max', 'label', 'color', 'score')})
+    data['price_comment'] = (f"Szacunek na podstawie {est['porownan']} podobnych ogłoszeń w serwisie "
+                             f"(średnio {est['pl_avg']:,.0f} PLN).".replace(',', ' '))
+    data['zrodlo'] = 'lokalna'
+    car.ai_label = json.dumps(data, ensure_ascii=False)
+    apply_valuation(car, data)
+    car.ai_valuation_data = datetime.now().strftime("%Y-%m-%d")
+    db.session.commit()
+    return True
+
+
+
+# --- WYSZUKIWARKA PEŁNOTEKSTOWA (SQLite FTS5) ---
+# Tabela car_fts to indeks "w cieniu" tabeli car (external content), więc nie dubluje danych.
+# Synchronizację przy INSERT/UPDATE/DELETE robią triggery SQLite, dzięki czemu działa też
+# dla skryptów serwisowych (maintenance.py, auto_cleanup.py) i kaskad ORM.
+FTS_COLUMNS = ['marka', 'model', 'opis', 'kolor', 'paliwo', 'nadwozie', 'skrzynia', 'typ', 'rok']
+_fts_mode = None # None = jeszcze nie sprawdzono, '' = brak FTS, 'trigram' / 'unicode61'
+
+def init_fts():
+    """Tworzy indeks car_fts + triggery (idempotentnie) i przebudowuje go, jeśli jest pusty."""
+    global _fts_mode
+    cols = ', '.join(FTS_COLUMNS)
+    new_vals = ', '.join(f'new.{c}' for c in FTS_COLUMNS)
+    old_vals = ', '.join(f'old.{c}' for c in FTS_COLUMNS)
+
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            c = conn.cursor()
+            exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'car_fts'").fetchone()
+            if not exists:
+                # Trigram = dopasowanie podciągów jak w dawnym icontains (SQLite >= 3.34)
+                try:
+                    c.execute(f"CREATE VIRTUAL TABLE car_fts USING fts5({cols}, content='car', content_rowid='id', tokenize='trigram')")
+                except sqlite3.OperationalError:
+                    c.execute(f"CREATE VIRTUAL TABLE car_fts USING fts5({cols}, content='car', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+
+            c.execute(f"""CREATE TRIGGER IF NOT EXISTS car_fts_ai AFTER INSERT ON car BEGIN
+                INSERT INTO car_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+            END""")
+            c.execute(f"""CREATE TRIGGER IF NOT EXISTS car_fts_ad AFTER DELETE ON car BEGIN
+                INSERT INTO car_fts(car_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+            END""")
+            # Tylko kolumny z indeksu - licznik wyświetleń czy promowanie nie ruszają FTS
+            c.execute(f"""CREATE TRIGGER IF NOT EXISTS car_fts_au AFTER UPDATE OF {cols} ON car BEGIN
+                INSERT INTO car_fts(car_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO car_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+            END""")
+
+            # Pierwsze uruchomienie na istniejącej bazie -> zasilenie indeksu
+            if not exists:
+                c.execute("INSERT INTO car_fts(car_fts) VALUES ('rebuild')")
+            conn.commit()
+        finally:
+            conn.close()
+    _fts_mode = None
+
+def get_fts_mode():
+    global _fts_mode
+    if _fts_mode is None:
+        try:
+            row = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'car_fts'")).fetchone()
+            _fts_mode = ('trigram' if 'trigram' in row[0] else 'unicode61') if row else ''
+        except Exception:
+            _fts_mode = ''
+    return _fts_mode
+
+def fts_search(terms=None, columns=None):
+    """
+    Zwraca podzapytanie (car_id, rank) z indeksu car_fts albo None, gdy FTS jest niedostępny.
+    terms   - lista słów szukanych we wszystkich kolumnach (każde musi wystąpić)
+    columns - słownik {kolumna: tekst} dla filtrów konkretnych pól (np. z /szukaj)
+    """
+    mode = get_fts_mode()
+    if not mode:
+        return None
+
+    match_parts, like_parts, params = [], [], {}
+    pairs = [(None, t) for t in (terms or [])] + [(col, t) for col, txt in (columns or {}).items() for t in txt.split()]
+
+    for i, (col, term) in enumerate(pairs):
+        # Trigram wymaga min. 3 znaków - krótsze frazy (np. "A4", "X5") idą przez LIKE
+        if mode == 'trigram' and len(term) < 3:
+            params[f's{i}'] = f'%{term}%'
+            targets = [col] if col else ['marka', 'model', 'paliwo', 'typ', 'rok']
+            like_parts.append('(' + ' OR '.join(f'car_fts.{t} LIKE :s{i}' for t in targets) + ')')
+            continue
+
+        phrase = '"' + term.replace('"', '""') + '"'
+        if mode != 'trigram':
+            phrase += '*' # unicode61: dopasowanie prefiksowe
+        match_parts.append(f'{{{col}}} : {phrase}' if col else phrase)
+
+    if not match_parts and not like_parts:
+        return None
+
+    where = []
+    if match_parts:
+        params['m'] = ' AND '.join(match_parts)
+        where.append('car_fts MATCH :m')
+    where.extend(like_parts)
+
+    rank = 'bm25(car_fts)' if match_parts else '0.0'
+    sql = f"SELECT rowid AS car_id, {rank} AS rank FROM car_fts WHERE {' AND '.join(where)}"
+    return db.text(sql).bindparams(**params).columns(car_id=db.Integer, rank=db.Float).subquery('fts_hits')
+
+
+# --- LICZNIK WYŚWIETLEŃ (BUFOR W PAMIĘCI) ---
+# Każde wejście na ogłoszenie to tylko +1 w słowniku. Co VIEWS_FLUSH_SECONDS harmonogram zapisuje
+# bufor jednym batchem UPDATE ... views = views + ?. Każdy worker gunicorna ma swój bufor,
+# a zapis przyrostowy sumuje się poprawnie między workerami. Po awarii tracimy max kilka sekund.
+VIEWS_FLUSH_SECONDS = 5
+_views_buffer = {}
+_views_lock = Lock()
+
+def count_view(car_id):
+    with _views_lock:
+        _views_buffer[car_id] = _views_buffer.get(car_id, 0) + 1
+
+def flush_views():
+    with _views_lock:
+        if not _views_buffer:
+            return 0
+        batch = list(_views_buffer.items())
+        _views_buffer.clear()
+
+    try:
+        with app.app_context():
+            db.session.execute(
+                db.text("UPDATE car SET views = COALESCE(views, 0) + :n WHERE id = :id"),
+                [{'n': n, 'id': car_id} for car_id, n in batch]
+            )
+            db.session.commit()
+        return len(batch)
     except Exception as e:
-        print(f"AI Update Market Error: {e}")
+        # Baza zablokowana itp. - oddajemy liczniki do bufora, pójdą w następnej paczce
+        with _views_lock:
+            for car_id, n in batch:
+                _views_buffer[car_id] = _views_buffer.get(car_id, 0) + n
+        print(f"Błąd zapisu licznika wyświetleń: {e}")
+        return 0
+
+
+# --- LICZNIKI FILTRÓW (FACETY) ---
+FACET_DIMS = ['typ', 'paliwo', 'skrzynia', 'nadwozie']
+KATEGORIE_INNE = ['Rozmaitosci', 'DomOgrad', 'Inne'] # Działy ukryte w wyszukiwarce aut
+
+def init_facets():
+    """Triggery utrzymujące facet_count przy każdej zmianie w car (dodanie, edycja, usunięcie, cleanup)."""
+    dims = ', '.join(FACET_DIMS)
+    new_vals = ', '.join(f"COALESCE(new.{d}, '')" for d in FACET_DIMS)
+    old_match = ' AND '.join(f"{d} = COALESCE(old.{d}, '')" for d in FACET_DIMS)
+    changed = ' OR '.join(f"old.{d} IS NOT new.{d}" for d in FACET_DIMS)
+    plus = f"""INSERT INTO facet_count({dims}, ilosc) VALUES ({new_vals}, 1)
+                ON CONFLICT({dims}) DO UPDATE SET ilosc = ilosc + 1;"""
+    minus = f"UPDATE facet_count SET ilosc = ilosc - 1 WHERE {old_match};"
 
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            c = conn.cursor()
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS facet_ai AFTER INSERT ON car BEGIN {plus} END")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS facet_ad AFTER DELETE ON car BEGIN {minus} END")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS facet_au AFTER UPDATE OF {dims} ON car WHEN {changed} BEGIN {minus} {plus} END")
+            conn.commit()
+        finally:
+            conn.close()
+        if not FacetCount.query.first():
+            reconcile_facets()
+
+def reconcile_facets():
+    """Przelicza facet_count od zera (GROUP BY) i zwraca liczbę poprawionych wierszy (dryf)."""
+    with app.app_context():
+        dims = ', '.join(FACET_DIMS)
+        coalesced = ', '.join(f"COALESCE({d}, '')" for d in FACET_DIMS)
+        before = {tuple(r[:4]): r[4] for r in db.session.execute(db.text(f"SELECT {dims}, ilosc FROM facet_count WHERE ilosc != 0"))}
+        fresh = {tuple(r[:4]): r[4] for r in db.session.execute(db.text(f"SELECT {coalesced}, COUNT(*) FROM car GROUP BY {coalesced}"))}
+        drift = sum(1 for k in before.keys() | fresh.keys() if before.get(k) != fresh.get(k))
+        if drift:
+            # Podmiana w jednej transakcji - czytelnicy nie zobaczą pustej tabeli
+            db.session.execute(db.text("DELETE FROM facet_count"))
+            db.session.execute(db.text(f"INSERT INTO facet_count({dims}, ilosc) SELECT {coalesced}, COUNT(*) FROM car GROUP BY {coalesced}"))
+            db.session.commit()
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] FACETY: skorygowano {drift} liczników.")
+        return drift
+
+def get_facets(filters, scope='auta'):
+    """
+    Liczniki dla każdej wartości filtra przy pozostałych aktywnych filtrach - jedno zapytanie
+    do małej tabeli facet_count, reszta w Pythonie. Filtry zakresowe (cena, rok) nie są liczone.
+    """
+    query = FacetCount.query.filter(FacetCount.ilosc > 0)
+    if scope == 'rozmaitosci':
+        query = query.filter(FacetCount.typ.in_(KATEGORIE_INNE))
+    else:
+        query = query.filter(FacetCount.typ.notin_(KATEGORIE_INNE))
+    rows = query.all()
+
+    active = {d: filters.get(d) for d in FACET_DIMS if filters.get(d)}
+    result = {d: {} for d in FACET_DIMS}
+    total = 0
+    for row in rows:
+        values = {d: getattr(row, d) for d in FACET_DIMS}
+        mismatched = [d for d, v in active.items() if values[d] != v]
+        if not mismatched:
+            total += row.ilosc
+        for d in FACET_DIMS:
+            # Licznik wymiaru d ignoruje własny filtr (żeby było widać alternatywy)
+            if values[d] and all(m == d for m in mismatched):
+                result[d][values[d]] = result[d].get(values[d], 0) + row.ilosc
+    result['total'] = total
+    return result
+
+@app.route('/api/facety')
+def api_facety():
+    scope = 'rozmaitosci' if request.args.get('scope') == 'rozmaitosci' else 'auta'
+    filters = {d: request.args.get(d, '') for d in FACET_DIMS}
+    if request.args.get('sub'): filters['nadwozie'] = request.args.get('sub') # /rozmaitosci?sub=...
+    return jsonify(get_facets(filters, scope))
+
+
+# --- PAGINACJA KURSOROWA (KEYSET / SEEK) ---
+# Zamiast OFFSET + COUNT(*) na każdej stronie: WHERE (kolumny sortowania) < (ostatni rekord)
+# i LIMIT. Koszt strony nie rośnie z jej numerem. Licznik wyników jest cache'owany w pamięci.
+COUNT_CACHE_TTL = 60 # sekundy
+_count_cache = {}
+
+class KeysetPage:
+    """Strona wyników z tokenami next/prev - interfejs zgodny z szablonami (has_next, total, pages...)."""
+    is_keyset = True
+
+    def __init__(self, items, total, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.total = total
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+        self.pages = max(1, -(-total // per_page))
+
+def _cursor_serializer():
+    return Serializer(app.secret_key, salt='listing-cursor')
+
+def encode_cursor(obj, columns):
+    values = []
+    for col in columns:
+        val = getattr(obj, col.key)
+        values.append(val.isoformat() if isinstance(val, datetime) else val)
+    return _cursor_serializer().dumps(values)
+
+def decode_cursor(token, columns):
+    try:
+        values = _cursor_serializer().loads(token)
+        if len(values) != len(columns): return None
+        return tuple(datetime.fromisoformat(v) if col.type.python_type is datetime and v else v
+                     for col, v in zip(columns, values))
+    except Exception:
+        return None # Zmanipulowany lub stary token -> pierwsza strona
+
+def cached_count(query, key):
+    now = time.monotonic()
+    hit = _count_cache.get(key)
+    if hit and now - hit[1] < COUNT_CACHE_TTL:
+        return hit[0]
+    total = query.order_by(None).count()
+    if len(_count_cache) > 1000:
+        _count_cache.clear()
+    _count_cache[key] = (total, now)
+    return total
+
+def keyset_paginate(query, columns, per_page=24, count_key=None):
+    """
+    Paginacja po (columns) malejąco. Ostatnia kolumna musi być unikalna (Car.id).
+    count_key=False wyłącza cache licznika (np. własny garaż użytkownika).
+    """
+    after = decode_cursor(request.args.get('after', ''), columns) if request.args.get('after') else None
+    before = decode_cursor(request.args.get('before', ''), columns) if request.args.get('before') else None
+    key_cols = tuple_(*columns)
+
+    if before is not None:
+        # Cofanie się: rosnąco od kursora, potem odwracamy kolejność
+        rows = query.filter(key_cols > before).order_by(*[c.asc() for c in columns]).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_prev, has_next = has_more, True
+    else:
+        q = query.filter(key_cols < after) if after is not None else query
+        rows = q.order_by(*[c.desc() for c in columns]).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after is not None
+
+    if count_key is False:
+        total = query.order_by(None).count()
+    else:
+        if count_key is None:
+            count_key = (request.endpoint, tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k not in ('page', 'after', 'before'))))
+        total = cached_count(query, count_key)
+
+    return KeysetPage(
+        items, total, per_page,
+        next_cursor=encode_cursor(items[-1], columns) if items and has_next else None,
+        prev_cursor=encode_cursor(items[0], columns) if items and has_prev else None,
+    )
+
+def paginate_listing(query, columns, per_page=24, count_key=None):
+    """Tryb kursorowy, a dla starych linków ?page=N (Google, zakładki) - klasyczny OFFSET."""
+    page = request.args.get('page', 1, type=int)
+    if page > 1 and not request.args.get('after') and not request.args.get('before'):
+        return query.order_by(*[c.desc() for c in columns]).paginate(page=page, per_page=per_page, error_out=False)
+    return keyset_paginate(query, columns, per_page=per_page, count_key=count_key)
+
+@app.template_global()
+def page_url(**kwargs):
+    """Aktualny URL z podmienionymi parametrami stronicowania (reszta filtrów zostaje)."""
+    args = {k: v for k, v in request.args.items() if k not in ('page', 'after', 'before') and v}
+    args.update({k: v for k, v in kwargs.items() if v is not None})
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
 
 
 @app.template_filter('from_json')
@@ -716,6 +2306,72 @@ def google_callback():
 # --- GŁÓWNE TRASY APLIKACJI ---
 
 
+# --- WIDOK 360° (SPRITE Z KLATEK) ---
+# Zestaw klatek wgrany do 360_renders/<id>/ zamieniamy na sprite'y (obrazy.sprite_360): mały arkusz
+# ze wszystkimi klatkami ładuje się od razu, kafle hi-res dociągają się w trakcie obracania.
+# Wynik leży w 360_renders/<id>/_sprite/ i jest przebudowywany tylko po zmianie klatek.
+SPIN_SPRITE_DIR = '_sprite'
+_spin_cache = {} # car_id -> (mtime manifestu, manifest, {plik: wersja})
+
+def spin_folder(car_id):
+    return os.path.join(app.root_path, RENDERS_360_FOLDER, str(car_id))
+
+def build_spin_async(car_id):
+    """Buduje sprite w puli zdjęć; po sukcesie włącza widok 360° w ogłoszeniu."""
+    folder = spin_folder(car_id)
+    future = get_image_pool().submit(obrazy.sprite_360, folder, os.path.join(folder, SPIN_SPRITE_DIR))
+
+    def done(f):
+        try:
+            manifest = f.result()
+        except Exception as e:
+            print(f"Błąd sprite 360 (auto {car_id}): {e}")
+            return
+        if not manifest:
+            return
+        with app.app_context():
+            car = db.session.get(Car, car_id)
+            if car and not car.is_360_premium:
+                car.is_360_premium = True
+                db.session.commit()
+        print(f"✅ Sprite 360 gotowy (auto {car_id}, {manifest['klatki']} klatek)")
+    future.add_done_callback(done)
+    return future
+
+@app.template_global()
+def spin_360(car_id):
+    """Dane sprite'a dla widoku 360° albo None - wtedy zostaje stare wideo MP4.
+
+    low/poster/high_N mają stałe nazwy i przebudowa je nadpisuje, więc każdy URL dostaje ?v=<mtime pliku>
+    (serve_file oddaje go jako niezmienny - kafle dociągane przy obracaniu nie rewalidują się).
+    Wersje liczymy raz na manifest: sprite_360() zapisuje go ostatni, po wszystkich plikach.
+    """
+    folder = os.path.join(spin_folder(car_id), SPIN_SPRITE_DIR)
+    path = os.path.join(folder, obrazy.SPIN_MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _spin_cache.get(car_id)
+    if not cached or cached[0] != mtime:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            names = [manifest['poster'], manifest['low']['plik']] + manifest['high']['pliki']
+            cached = (mtime, manifest, {n: file_version(os.stat(os.path.join(folder, n))) for n in names})
+        except (OSError, ValueError, KeyError):
+            return None
+        _spin_cache[car_id] = cached
+    m, wersje = cached[1], cached[2]
+    url = lambda name: url_for('static', filename=f"uploads/360_renders/{car_id}/{SPIN_SPRITE_DIR}/{name}", v=wersje[name])
+    return {
+        'klatki': m['klatki'],
+        'poster': url(m['poster']),
+        'low': dict(m['low'], url=url(m['low']['plik'])),
+        'high': dict(m['high'], urls=[url(n) for n in m['high']['pliki']]),
+    }
+
+
 @app.route('/generate_360/<int:car_id>')
 @login_required
 def generate_360_trigger(car_id):
@@ -724,8 +2380,15 @@ def generate_360_trigger(car_id):
         abort(403)
 
     car = Car.query.get_or_404(car_id)
-    
-    # Tworzymy ścieżkę do pliku MP4 z numerem ID auta
+
+    # 1. Klatki w 360_renders/<id>/ -> sprite (w tle, w puli zdjęć)
+    frames = obrazy.klatki_360(spin_folder(car.id))
+    if frames:
+        build_spin_async(car.id)
+        flash(f"Generuję widok 360° z {len(frames)} klatek dla {car.marka} - włączy się sam po zakończeniu.", "success")
+        return redirect(url_for('profil'))
+
+    # 2. Stary tryb: wideo MP4 wgrane przez FTP
     video_filename = f"{car.id}.mp4"
     video_path = os.path.join(app.root_path, 'static', 'uploads', '360_videos', video_filename)
     
@@ -735,7 +2398,7 @@ def generate_360_trigger(car_id):
         db.session.commit()
         flash(f"Aktywowano! Wideo 360° dla {car.marka} jest już podpięte pod ogłoszenie.", "success")
     else:
-        flash(f"Brak pliku! Wgraj najpierw plik o nazwie {video_filename} do folderu static/uploads/360_videos/", "danger")
+        flash(f"Brak plików! Wgraj klatki do static/uploads/360_renders/{car.id}/ albo plik {video_filename} do static/uploads/360_videos/", "danger")
 
     return redirect(url_for('profil'))
 
@@ -749,25 +2412,32 @@ def index():
     
     # 1. ZMIANA: Domyślnie bierzemy tylko auta (wykluczamy Marketplace)
     query = Car.query.filter(Car.typ.notin_(['Rozmaitosci', 'DomOgrad', 'Inne']))
-    
+    hits = None
+
     if q:
         terms = q.split()
-        conditions = []
-        for term in terms:
-            conditions.append(or_(
-                Car.marka.icontains(term), 
-                Car.model.icontains(term), 
-                Car.paliwo.icontains(term), 
-                Car.typ.icontains(term),
-                Car.rok.cast(db.String).icontains(term)
-            ))
-        query = query.filter(and_(*conditions))
-    
+        hits = fts_search(terms)
+        if hits is not None:
+            # Indeks FTS5 zamiast skanowania całej tabeli przez LIKE
+            query = query.join(hits, hits.c.car_id == Car.id)
+        else:
+            conditions = []
+            for term in terms:
+                conditions.append(or_(
+                    Car.marka.icontains(term),
+                    Car.model.icontains(term),
+                    Car.paliwo.icontains(term),
+                    Car.typ.icontains(term),
+                    Car.rok.cast(db.String).icontains(term)
+                ))
+            query = query.filter(and_(*conditions))
+
     # Jeśli użytkownik jednak wybierze coś z filtrów na indexie
     cat = request.args.get('typ', '')
-    if cat: 
+    if cat:
         # Nadpisujemy filtr, jeśli ktoś ręcznie kliknął kategorię
         query = Car.query.filter(Car.typ == cat)
+        hits = None
     
     paliwo = request.args.get('paliwo', '')
     if paliwo: query = query.filter(Car.paliwo == paliwo)
@@ -784,9 +2454,14 @@ def index():
     # 2. DODATEK: Pobieramy te 4 ostatnie przedmioty do nowej sekcji na dole
     recent_items = Car.query.filter(Car.typ.in_(['Rozmaitosci', 'DomOgrad', 'Inne'])).order_by(Car.data_dodania.desc()).limit(4).all()
 
-    page = request.args.get('page', 1, type=int)
-    pagination = query.order_by(Car.is_promoted.desc(), Car.data_dodania.desc()).paginate(page=page, per_page=24, error_out=False)
-    
+    if hits is not None:
+        # Wyniki wyszukiwania: promowane na górze, potem trafność (bm25), potem świeżość
+        page = request.args.get('page', 1, type=int)
+        query = query.order_by(Car.is_promoted.desc(), hits.c.rank, Car.data_dodania.desc())
+        pagination = query.paginate(page=page, per_page=24, error_out=False)
+    else:
+        pagination = paginate_listing(query, [Car.is_promoted, Car.data_dodania, Car.id])
+
     # 3. ZMIANA: Przekazujemy 'recent_items' do szablonu
     return render_template('index.html', 
                            cars=pagination.items, 
@@ -840,11 +2515,18 @@ def szukaj():
             # Jeśli wybrano "Wszystkie" - domyślnie ukrywamy graty i dom/ogród
             query = query.filter(Car.typ.notin_(['Rozmaitosci', 'DomOgrad', 'Inne']))
 
-        # Reszta filtrów pozostaje bez zmian
-        if marka: query = query.filter(Car.marka.ilike(f'%{marka}%'))
-        if model: query = query.filter(Car.model.ilike(f'%{model}%'))
-        if kolor: query = query.filter(Car.kolor.ilike(f'%{kolor}%'))
-        if ai_ocena: query = query.filter(Car.ai_label.contains(ai_ocena))
+        # Pola tekstowe przez indeks FTS5 (filtr per kolumna), w razie braku indeksu - stary LIKE
+        hits = None
+        text_filters = {k: v for k, v in (('marka', marka), ('model', model), ('kolor', kolor)) if v}
+        if text_filters:
+            hits = fts_search(columns=text_filters)
+        if hits is not None:
+            query = query.join(hits, hits.c.car_id == Car.id)
+        else:
+            if marka: query = query.filter(Car.marka.ilike(f'%{marka}%'))
+            if model: query = query.filter(Car.model.ilike(f'%{model}%'))
+            if kolor: query = query.filter(Car.kolor.ilike(f'%{kolor}%'))
+        if ai_ocena: query = query.filter(Car.ai_ocena == ai_ocena)
         
         if paliwo: query = query.filter(Car.paliwo == paliwo)
         if skrzynia: query = query.filter(Car.skrzynia == skrzynia)
@@ -861,9 +2543,13 @@ def szukaj():
         if moc_min is not None: 
             query = query.filter(and_(Car.moc.isnot(None), Car.moc >= moc_min))
         
-        page = request.args.get('page', 1, type=int)
-        pagination = query.order_by(Car.is_promoted.desc(), Car.data_dodania.desc()).paginate(page=page, per_page=24, error_out=False)
-        
+        if hits is not None:
+            page = request.args.get('page', 1, type=int)
+            query = query.order_by(Car.is_promoted.desc(), hits.c.rank, Car.data_dodania.desc())
+            pagination = query.paginate(page=page, per_page=24, error_out=False)
+        else:
+            pagination = paginate_listing(query, [Car.is_promoted, Car.data_dodania, Car.id])
+
         return render_template('szukaj.html', cars=pagination.items, pagination=pagination, now=datetime.utcnow(), args=request.args)
 
     except Exception as e:
@@ -874,7 +2560,6 @@ def szukaj():
 @app.route('/rozmaitosci')
 def rozmaitosci():
     sub = request.args.get('sub')
-    page = request.args.get('page', 1, type=int)
     
     # ZMIANA: Pokazujemy TYLKO te kategorie, które są ukryte w głównej wyszukiwarce
     query = Car.query.filter(Car.typ.in_(['Rozmaitosci', 'DomOgrad', 'Inne']))
@@ -882,8 +2567,8 @@ def rozmaitosci():
     if sub:
         query = query.filter(Car.nadwozie == sub)
  
-    pagination = query.order_by(Car.data_dodania.desc()).paginate(page=page, per_page=24, error_out=False)
-    
+    pagination = paginate_listing(query, [Car.data_dodania, Car.id])
+
     return render_template('rozmaitosci.html', items=pagination.items, pagination=pagination, now=datetime.utcnow())
 
 
@@ -908,7 +2593,7 @@ def zmien_avatar():
             # Zapisuje obraz używając Twojej funkcji optymalizującej (WebP + Znak wodny)
             filename = save_optimized_image(file, is_car_image=False)
             if filename:
-                current_user.avatar_url = url_for('static', filename='uploads/' + filename)
+                current_user.avatar_url = upload_url(filename)
                 db.session.commit()
                 flash('Miniaturka została zaktualizowana!', 'success')
             else:
@@ -921,36 +2606,23 @@ def zmien_avatar():
 @app.route('/ogloszenie/<int:car_id>')
 def car_details(car_id):
     car = Car.query.get_or_404(car_id)
-    
-    if car.views is None: car.views = 0
-    car.views += 1
-    
-    should_update = False
-    if not car.ai_valuation_data or not car.ai_label:
-        should_update = True
-    else:
-        try:
-            last_check = datetime.strptime(car.ai_valuation_data, "%Y-%m-%d")
-            if (datetime.now() - last_check).days >= 3:
-                should_update = True
-        except:
-            should_update = True
-            
-    if should_update and model_ai:
-        try:
-            # ZABEZPIECZENIE: Uruchamiamy wycenę AI TYLKO dla samochodów
-            if car.typ not in ['Rozmaitosci', 'DomOgrad', 'Inne']:
-                update_market_valuation(car)
-        except:
-            pass
-            
-    db.session.commit()
-    
+
+    # Bez zapisu do bazy w trakcie GET - licznik trafia do bufora, flush_views() zapisze go paczką
+    # (pomijamy doładowanie paneli wyceny przez JS - to nie jest nowe wyświetlenie)
+    if not request.headers.get('X-Odswiez-Wycene'):
+        count_view(car.id)
+
+    # Nigdy nie czekamy na Gemini - stara wycena idzie na stronę, nowa liczy się w tle
+    wycena_w_toku = valuation_pending(car)
+    if valuation_is_stale(car) and not wycena_w_toku:
+        wycena_w_toku = enqueue_valuation(car.id)
+
     # ROZDZIELENIE SZABLONÓW: Inny dla części, inny dla aut
     if car.typ in ['Rozmaitosci', 'DomOgrad', 'Inne']:
         return render_template('inne.html', car=car, now=datetime.utcnow())
     else:
-        return render_template('details.html', car=car, now=datetime.utcnow())
+        return render_template('details.html', car=car, now=datetime.utcnow(),
+                               wycena_w_toku=wycena_w_toku, wycena_wersja=valuation_version(car))
 
 
 # --- POPRAWIONY PROFIL ---
@@ -960,19 +2632,20 @@ def profil():
     user_count = 0
     online_count = 0
     total_views = 0
-    page = request.args.get('page', 1, type=int)
-    
+
     if current_user.username == 'admin' or current_user.id == 1:
-        pagination = Car.query.order_by(Car.data_dodania.desc()).paginate(page=page, per_page=24, error_out=False)
+        pagination = paginate_listing(Car.query, [Car.data_dodania, Car.id], count_key=('profil', 'admin'))
         user_count = User.query.count()
         try:
-            active_since = datetime.utcnow() - timedelta(minutes=5)
+            active_since = datetime.utcnow() - timedelta(minutes=ONLINE_WINDOW_MINUTES)
             online_count = User.query.filter(User.last_seen >= active_since).count()
         except:
             online_count = 1
         total_views = db.session.query(db.func.sum(Car.views)).scalar() or 0
     else:
-        pagination = Car.query.filter_by(user_id=current_user.id).order_by(Car.data_dodania.desc()).paginate(page=page, per_page=24, error_out=False)
+        # Właściciel widzi swoje liczniki bez opóźnienia cache'a - COUNT po user_id jest tani
+        pagination = paginate_listing(Car.query.filter_by(user_id=current_user.id), [Car.data_dodania, Car.id],
+                                      count_key=False)
         
     favorites = Favorite.query.filter_by(user_id=current_user.id).all()
     
@@ -1024,7 +2697,7 @@ def ustawienia_profilu():
             if file and file.filename != '' and allowed_file(file.filename):
                 fname = save_optimized_image(file, is_car_image=False)
                 if fname:
-                    current_user.avatar_url = url_for('static', filename='uploads/' + fname)
+                    current_user.avatar_url = upload_url(fname)
 
         db.session.commit()
         flash('Zapisano!', 'success')
@@ -1041,30 +2714,29 @@ def ustawienia_profilu():
 def dodaj_ogloszenie():
     try:
         files = request.files.getlist('zdjecia')
-        saved_paths = []
+        uploads = []
         
         # 1. BEZPIECZNE POBIERANIE SKANÓW (Ochrona przed błędem "NoneType")
         if 'scan_image_cam' in request.files and request.files['scan_image_cam'].filename != '':
-            res = save_optimized_image(request.files['scan_image_cam'], is_car_image=True)
-            if res: 
-                fname, tfname = res
-                saved_paths.append((url_for('static', filename='uploads/' + fname), url_for('static', filename='uploads/' + tfname)))
-            
+            uploads.append(request.files['scan_image_cam'])
         elif 'scan_image_file' in request.files and request.files['scan_image_file'].filename != '':
-            res = save_optimized_image(request.files['scan_image_file'], is_car_image=True)
-            if res: 
-                fname, tfname = res
-                saved_paths.append((url_for('static', filename='uploads/' + fname), url_for('static', filename='uploads/' + tfname)))
-            
-        for file in files[:18]:
-            if file and allowed_file(file.filename):
-                res = save_optimized_image(file, is_car_image=True)
-                if res: 
-                    fname, tfname = res
-                    saved_paths.append((url_for('static', filename='uploads/' + fname), url_for('static', filename='uploads/' + tfname)))
+            uploads.append(request.files['scan_image_file'])
+        uploads += [f for f in files if f and allowed_file(f.filename)][:18]
+
+        # Wszystkie zdjęcia naraz do puli procesów (skan zostaje pierwszy = zdjęcie główne)
+        jobs = submit_images(uploads)
+        # Skan już obrobiony przy analizie AI -> przychodzi sam token, bez pliku. Odczyt tokenu po
+        # submit_images() (touch_upload), ale przed collect_images() - ta już pisze do bazy.
+        skan_wpis, skan = find_scan_token(request.form.get('scan_token'), current_user.id)
+        if request.form.get('scan_token') and not skan:
+            flash(SCAN_TOKEN_LOST, 'warning')
+        deferred = app.config['IMAGES_DEFERRED'] and jobs
+        saved_paths = [] if deferred else collect_images(jobs)
+        if skan:
+            db.session.delete(skan_wpis)
+            saved_paths = [skan] + [z for z in saved_paths if z['image_path'] != skan['image_path']]
                 
-        main_img = saved_paths[0][0] if saved_paths else 'https://placehold.co/600x400?text=Brak+Zdjecia'
-        main_thumb = saved_paths[0][1] if saved_paths else None
+        glowne = main_image(saved_paths, IMG_W_TOKU if deferred else IMG_BRAK)
         
         # 2. BEZPIECZNE PARSOWANIE GPS
         try: lat = float(request.form.get('lat', ''))
@@ -1109,23 +2781,26 @@ def dodaj_ogloszenie():
             przebieg=przebieg_val,
             moc=moc_val, 
             kolor=request.form.get('kolor', ''),
-            img=main_img,
-            thumb=main_thumb,
+            **glowne,
             zrodlo=current_user.lokalizacja,
             user_id=current_user.id,
             latitude=lat,
             longitude=lon,
-            data_dodania=datetime.utcnow()
+            data_dodania=datetime.utcnow(),
+            zdjecia_status='w_toku' if deferred else None,
+            zdjecia_od=_utc_now_str() if deferred else None
         )
         
         # 5. ZAPIS DO BAZY
         db.session.add(new_car)
         db.session.flush() # Pobranie ID przed całkowitym zapisem
         
-        for p, tp in saved_paths:
-            db.session.add(CarImage(image_path=p, thumb_path=tp, car_id=new_car.id))
+        for zdj in saved_paths:
+            db.session.add(CarImage(car_id=new_car.id, **zdj))
             
         db.session.commit()
+        if deferred:
+            finish_images_async(new_car.id, jobs, set_main=not skan)
         
         # 6. WYSYŁKA MAILA (Działa w tle)
         wyslij_potwierdzenie_ogloszenia(current_user.email, current_user.username, new_car.marka, new_car.model)
@@ -1153,17 +2828,19 @@ def dodaj_przedmiot():
     
     try:
         files = request.files.getlist('zdjecia')
-        saved_paths = []
-        
-        for file in files[:18]:
-            if file and allowed_file(file.filename):
-                res = save_optimized_image(file, is_car_image=True)
-                if res: 
-                    fname, tfname = res
-                    saved_paths.append((url_for('static', filename='uploads/' + fname), url_for('static', filename='uploads/' + tfname)))
+        # Pierwsze zdjęcie galerii poszło już do analizy AI -> formularz przysyła za nie token
+        jobs = submit_images(files, limit=18 - bool(request.form.get('scan_token')))
+        # Token między submit_images() a collect_images() - jak w dodaj_ogloszenie
+        skan_wpis, skan = find_scan_token(request.form.get('scan_token'), current_user.id)
+        if request.form.get('scan_token') and not skan:
+            flash(SCAN_TOKEN_LOST, 'warning')
+        deferred = app.config['IMAGES_DEFERRED'] and jobs
+        saved_paths = [] if deferred else collect_images(jobs)
+        if skan:
+            db.session.delete(skan_wpis)
+            saved_paths = [skan] + [z for z in saved_paths if z['image_path'] != skan['image_path']]
                 
-        main_img = saved_paths[0][0] if saved_paths else 'https://placehold.co/600x400?text=Brak+Zdjecia'
-        main_thumb = saved_paths[0][1] if saved_paths else None
+        glowne = main_image(saved_paths, IMG_W_TOKU if deferred else IMG_BRAK)
         
         cena_str = str(request.form.get('cena', '0')).replace(',', '.').replace(' ', '').strip()
         try: cena_val = float(cena_str)
@@ -1181,19 +2858,22 @@ def dodaj_przedmiot():
             opis=request.form.get('opis', ''),
             telefon=request.form.get('telefon', ''),
             rok=0, przebieg=0, moc=0, paliwo='', pojemnosc='', kolor='',
-            img=main_img,
-            thumb=main_thumb,
+            **glowne,
             zrodlo=current_user.lokalizacja,
             user_id=current_user.id,
-            data_dodania=datetime.utcnow()
+            data_dodania=datetime.utcnow(),
+            zdjecia_status='w_toku' if deferred else None,
+            zdjecia_od=_utc_now_str() if deferred else None
         )
         
         db.session.add(new_item)
         db.session.flush() 
-        for p, tp in saved_paths:
-            db.session.add(CarImage(image_path=p, thumb_path=tp, car_id=new_item.id))
+        for zdj in saved_paths:
+            db.session.add(CarImage(car_id=new_item.id, **zdj))
             
         db.session.commit()
+        if deferred:
+            finish_images_async(new_item.id, jobs, set_main=not skan)
         flash('Ogłoszenie w dziale Rozmaitości zostało dodane!', 'success')
         return redirect(url_for('profil'))
 
@@ -1204,64 +2884,56 @@ def dodaj_przedmiot():
 
 
 
+# --- CACHE ANALIZ ZDJĘĆ (AI) ---
+# Ten sam skan bywa wysyłany kilka razy (nieudany submit formularza, ponowna próba). Wynik trzymamy
+# w pamięci pod kluczem (endpoint, wersja promptu, sha256 pliku); gdy plik jest inny bajtowo, ale to
+# to samo zdjęcie (ponowny zapis/kompresja w telefonie) - trafia po hashu percepcyjnym (dHash).
+# Trafienie nie woła Gemini i nie zużywa dziennego limitu. Zmiana treści promptu = nowa wersja klucza.
+AI_SCAN_CACHE_TTL = 6 * 3600     # sekundy
+AI_SCAN_CACHE_MAX = 2000         # wpisów (LRU)
+AI_SCAN_PHASH_MAX_DISTANCE = 12  # bitów na 256 - dalej to już inne zdjęcie
+_scan_cache = OrderedDict()      # (endpoint, wersja, sha256) -> (czas, dhash, wynik)
+_scan_cache_lock = Lock()
+
+def prompt_version(prompt):
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]
+
+def scan_cache_get(endpoint, version, digest, phash=None):
+    """Wynik z cache (kopia) albo None. Bez phash - tylko dokładne trafienie po sha256."""
+    now = time.monotonic()
+    with _scan_cache_lock:
+        # Najstarsze wpisy są z przodu - zdejmujemy przeterminowane
+        while _scan_cache:
+            oldest = next(iter(_scan_cache.values()))
+            if now - oldest[0] < AI_SCAN_CACHE_TTL:
+                break
+            _scan_cache.popitem(last=False)
+        key = (endpoint, version, digest)
+        if key not in _scan_cache and phash is not None:
+            # Najbliższy hash percepcyjny wśród wpisów tego endpointu i tej wersji promptu
+            best = None
+            for k, (_, h, _) in _scan_cache.items():
+                if k[0] == endpoint and k[1] == version and h is not None:
+                    distance = bin(h ^ phash).count('1')
+                    if distance <= AI_SCAN_PHASH_MAX_DISTANCE and (best is None or distance < best[0]):
+                        best = (distance, k)
+            key = best[1] if best else None
+        entry = _scan_cache.get(key) if key else None
+        if entry is None:
+            return None
+        _scan_cache.move_to_end(key)
+        return json.loads(json.dumps(entry[2])) # kopia - route może dopisać coś do wyniku
 
+def scan_cache_put(endpoint, version, digest, phash, result):
+    with _scan_cache_lock:
+        _scan_cache[(endpoint, version, digest)] = (time.monotonic(), phash, result)
+        _scan_cache.move_to_end((endpoint, version, digest))
+        while len(_scan_cache) > AI_SCAN_CACHE_MAX:
+            _scan_cache.popitem(last=False)
 
 
-
-
-@app.route('/api/analyze-car', methods=['POST'])
-@login_required
-def analyze_car():
-    dzisiaj = datetime.utcnow().date()
-        # Reset dziennego limitu zapytań
-    if current_user.last_ai_request_date != dzisiaj:
-        current_user.ai_requests_today = 0
-        current_user.last_ai_request_date = dzisiaj
-        db.session.commit()
-
-    # ZABEZPIECZENIE: Zmiana pustej wartości na twarde zero dla nowych userów
-    uzyte_dzis = current_user.ai_requests_today or 0
-
-    # Ustalanie limitów (Admin = 500, Użytkownik = 6)
-    if current_user.username == 'admin' or current_user.id == 1:
-        LIMIT = 500
-    else:
-        LIMIT = 6
-
-    if uzyte_dzis >= LIMIT:
-
-        return jsonify({"error": f"Osiągnięto dzienny limit AI ({LIMIT}). Wróć jutro!"}), 429
-
-    file = request.files.get('scan_image')
-    if not file:
-        return jsonify({"error": "Brak pliku"}), 400
-
-    try:       # <---- POPRAWNE! (Cofnięte o 4 spacje)
-        # 1. Pobieramy surowe dane (na wypadek, gdyby kompresja się nie udała, np. iPhone HEIC)
-        raw_image_data = file.read()
-        image_data = raw_image_data
-        mime_type = file.mimetype
-        # 2. Próbujemy bezpiecznie skompresować zdjęcie, by oszczędzić RAM
-        try:
-            file.seek(0) # Wymuszamy cofnięcie kursora czytania pliku
-            img_obj = Image.open(file)
-            img_obj = ImageOps.exif_transpose(img_obj)
-            img_obj.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-            
-            if img_obj.mode != 'RGB':
-                img_obj = img_obj.convert('RGB')
-                
-            img_byte_arr = io.BytesIO()
-            img_obj.save(img_byte_arr, format='JPEG', quality=85)
-            image_data = img_byte_arr.getvalue()
-            mime_type = 'image/jpeg'
-        except Exception as compression_error:
-            # Jeśli to dziwny format z telefonu (HEIC), ignorujemy błąd kompresji i idziemy dalej z oryginałem
-            print(f"Ostrzeżenie kompresji: {compression_error}. Wysyłam oryginał.")
-
-        
-        # Mózg operacji: Precyzyjny prompt dla Gemini 3.0 Flash
-        prompt = """
+# Mózg operacji: Precyzyjny prompt dla Gemini 3.0 Flash (treść = wersja klucza cache analiz)
+ANALIZA_AUTA_PROMPT = """
         Jesteś ekspertem motoryzacyjnym. Przeanalizuj to zdjęcie samochodu i zwróć TYLKO czysty obiekt JSON.
         
         Twoje zadania:
@@ -1294,13 +2966,65 @@ def analyze_car():
             "opis_wizualny": "Auto prezentuje się zjawiskowo, lakier w świetnym stanie..." 
         }
         """
-        
+
+@app.route('/api/analyze-car', methods=['POST'])
+@login_required
+def analyze_car():
+    LIMIT = ai_limit(current_user)
+    pobrano = False
+
+    file = request.files.get('scan_image')
+    if not file:
+        return jsonify({"error": "Brak pliku"}), 400
+    skan_job = None
+
+    try:       # <---- POPRAWNE! (Cofnięte o 4 spacje)
+        # 1. Pobieramy surowe dane (na wypadek, gdyby kompresja się nie udała, np. iPhone HEIC)
+        raw_image_data = file.read()
+        skan_job = submit_scan_image(file, raw_image_data) # obróbka do /dodaj rusza równolegle z Gemini
+        image_data = raw_image_data
+        mime_type = file.mimetype
+
+        # Ten sam plik co przed chwilą -> wynik z cache, bez dekodowania i bez limitu
+        wersja = prompt_version(ANALIZA_AUTA_PROMPT)
+        digest = hashlib.sha256(raw_image_data).hexdigest()
+        cached = scan_cache_get('analyze-car', wersja, digest)
+        if cached is not None:
+            return scan_response(cached, skan_job)
+        phash = None
+
+        # 2. Próbujemy bezpiecznie skompresować zdjęcie, by oszczędzić RAM
+        try:
+            file.seek(0) # Wymuszamy cofnięcie kursora czytania pliku
+            img_obj = obrazy.otworz_zmniejszone(file, (1024, 1024)) # JPEG dekodowany od razu w małej skali
+            img_obj.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+            
+            if img_obj.mode != 'RGB':
+                img_obj = img_obj.convert('RGB')
+                
+            img_byte_arr = io.BytesIO()
+            img_obj.save(img_byte_arr, format='JPEG', quality=85)
+            image_data = img_byte_arr.getvalue()
+            mime_type = 'image/jpeg'
+            phash = obrazy.dhash(img_obj)
+        except Exception as compression_error:
+            # Jeśli to dziwny format z telefonu (HEIC), ignorujemy błąd kompresji i idziemy dalej z oryginałem
+            print(f"Ostrzeżenie kompresji: {compression_error}. Wysyłam oryginał.")
+
+        # To samo zdjęcie, tylko inaczej zapisane -> trafienie po hashu percepcyjnym
+        if phash is not None:
+            cached = scan_cache_get('analyze-car', wersja, digest, phash)
+            if cached is not None:
+                return scan_response(cached, skan_job)
+
+        # Limit pobierany dopiero tutaj - trafienia z cache go nie zużywają
+        if not ai_quota_take(current_user.id, LIMIT):
+            return scan_response({"error": f"Osiągnięto dzienny limit AI ({LIMIT}). Wróć jutro!"}, skan_job, 429)
+        pobrano = True
+
         # Odpytanie modelu Gemini
-        resp = model_ai.generate_content([prompt, {"mime_type": mime_type, "data": image_data}])
-        
-        # Czyszczenie odpowiedzi do czystego JSONa
-        text_response = resp.text.replace('```json', '').replace('```', '').strip()
-        data = json.loads(text_response)
+        data = model_ai.json([ANALIZA_AUTA_PROMPT, {"mime_type": mime_type, "data": image_data}],
+                             rodzaj='skan-auta', timeout=AI_TIMEOUT_SKAN)
         
         # --- DORZUCANIE PODSTAW NA ŚLEPO (EFEKT BOGATEGO WYPOSAŻENIA) ---
         if "wyposazenie_wykryte" not in data or not isinstance(data["wyposazenie_wykryte"], list):
@@ -1312,61 +3036,21 @@ def analyze_car():
             if opcja not in data["wyposazenie_wykryte"]:
                 data["wyposazenie_wykryte"].append(opcja)
         # ---------------------------------------------------------------
-
-        # Zapisanie użycia limitu do bazy
-        current_user.ai_requests_today = uzyte_dzis + 1  # <--- UŻYWAMY BEZPIECZNEJ ZMIENNEJ
-        db.session.commit()
+        scan_cache_put('analyze-car', wersja, digest, phash, data)
         
-        return jsonify(data)
+        return scan_response(data, skan_job)
         
+    except klient_ai.AINiedostepne as e:
+        print(f"Błąd AI: {e}")
+        if pobrano: ai_quota_refund(current_user.id)
+        return scan_response({"error": "Serwery AI są chwilowo przeciążone. Spróbuj za chwilę."}, skan_job, 503)
     except Exception as e:
         print(f"Błąd AI: {e}")
-        return jsonify({"error": "Nie udało się przeanalizować zdjęcia."}), 500
+        if pobrano: ai_quota_refund(current_user.id)
+        return scan_response({"error": "Nie udało się przeanalizować zdjęcia."}, skan_job, 500)
 
-@app.route('/api/analyze-market', methods=['POST'])
-@login_required
-def analyze_market():
-    dzisiaj = datetime.utcnow().date()
-    # Reset dziennego limitu zapytań
-    if current_user.last_ai_request_date != dzisiaj:
-        current_user.ai_requests_today = 0
-        current_user.last_ai_request_date = dzisiaj
-        db.session.commit()
-
-    # ZABEZPIECZENIE: Zmiana pustej wartości na twarde zero dla nowych userów
-    uzyte_dzis = current_user.ai_requests_today or 0
-
-    # Ustalanie limitów (Admin = 500, Użytkownik = 6)
-    if current_user.username == 'admin' or current_user.id == 1:
-        LIMIT = 500
-    else:
-        LIMIT = 6
-
-    if uzyte_dzis >= LIMIT:
-        return jsonify({"error": f"Osiągnięto dzienny limit AI ({LIMIT}). Wróć jutro!"}), 429
-
-    file = request.files.get('scan_image')
-    if not file:
-        return jsonify({"error": "Brak pliku"}), 400
-
-    try:
-        # --- NOWE: OPTYMALIZACJA W LOCIE DLA TELEFONÓW ---
-        img_obj = Image.open(file)
-        img_obj = ImageOps.exif_transpose(img_obj) # Naprawia obrócone zdjęcia z telefonu
-        img_obj.thumbnail((1024, 1024), Image.Resampling.LANCZOS) # Zmniejsza rozdzielczość
-        
-        # Konwersja i zapis do pamięci RAM jako lekki JPEG
-        if img_obj.mode != 'RGB':
-            img_obj = img_obj.convert('RGB')
-            
-        img_byte_arr = io.BytesIO()
-        img_obj.save(img_byte_arr, format='JPEG', quality=85)
-        image_data = img_byte_arr.getvalue()
-        mime_type = 'image/jpeg'
-        # --------------------------------------------------
-        
-        # Nowy Mózg: Ekspert od przedmiotów codziennego użytku i części
-        prompt = """
+# Nowy Mózg: Ekspert od przedmiotów codziennego użytku i części
+ANALIZA_PRZEDMIOTU_PROMPT = """
         Jesteś wybitnym rzeczoznawcą i handlowcem. Specjalizujesz się w częściach samochodowych, narzędziach, sprzęcie RTV/AGD oraz wyposażeniu domu i ogrodu.
         Przeanalizuj to zdjęcie przedmiotu na sprzedaż i zwróć TYLKO czysty obiekt JSON.
         
@@ -1389,24 +3073,102 @@ def analyze_market():
             "opis_wizualny": "Na sprzedaż solidna wkrętarka Makita. Wizualnie nosi normalne ślady użytkowania, obudowa cała i niepopękana. Sprzęt idealny do domowych remontów." 
         }
         """
+
+@app.route('/api/analyze-market', methods=['POST'])
+@login_required
+def analyze_market():
+    LIMIT = ai_limit(current_user)
+    pobrano = False
+
+    file = request.files.get('scan_image')
+    if not file:
+        return jsonify({"error": "Brak pliku"}), 400
+    skan_job = None
+
+    try:
+        raw_image_data = file.read()
+        skan_job = submit_scan_image(file, raw_image_data) # obróbka do /dodaj rusza równolegle z Gemini
+
+        # Ten sam plik co przed chwilą -> wynik z cache, bez dekodowania i bez limitu
+        wersja = prompt_version(ANALIZA_PRZEDMIOTU_PROMPT)
+        digest = hashlib.sha256(raw_image_data).hexdigest()
+        cached = scan_cache_get('analyze-market', wersja, digest)
+        if cached is not None:
+            return scan_response(cached, skan_job)
+        file.seek(0)
+
+        # --- NOWE: OPTYMALIZACJA W LOCIE DLA TELEFONÓW ---
+        img_obj = obrazy.otworz_zmniejszone(file, (1024, 1024)) # Naprawia obrócone zdjęcia, JPEG od razu w małej skali
+        img_obj.thumbnail((1024, 1024), Image.Resampling.LANCZOS) # Zmniejsza rozdzielczość
         
-        # Odpytanie modelu Gemini
-        resp = model_ai.generate_content([prompt, {"mime_type": mime_type, "data": image_data}])
-        
-        # Czyszczenie odpowiedzi do czystego JSONa
-        text_response = resp.text.replace('```json', '').replace('```', '').strip()
-        data = json.loads(text_response)
+        # Konwersja i zapis do pamięci RAM jako lekki JPEG
+        if img_obj.mode != 'RGB':
+            img_obj = img_obj.convert('RGB')
+            
+        img_byte_arr = io.BytesIO()
+        img_obj.save(img_byte_arr, format='JPEG', quality=85)
+        image_data = img_byte_arr.getvalue()
+        mime_type = 'image/jpeg'
+        # --------------------------------------------------
+
+        # To samo zdjęcie, tylko inaczej zapisane -> trafienie po hashu percepcyjnym
+        phash = obrazy.dhash(img_obj)
+        cached = scan_cache_get('analyze-market', wersja, digest, phash)
+        if cached is not None:
+            return scan_response(cached, skan_job)
+
+        # Limit pobierany dopiero tutaj - trafienia z cache go nie zużywają
+        if not ai_quota_take(current_user.id, LIMIT):
+            return scan_response({"error": f"Osiągnięto dzienny limit AI ({LIMIT}). Wróć jutro!"}, skan_job, 429)
+        pobrano = True
         
-        # Zapisanie użycia limitu do bazy
-        current_user.ai_requests_today = uzyte_dzis + 1  # <--- UŻYWAMY BEZPIECZNEJ ZMIENNEJ
-        db.session.commit()
+        # Odpytanie modelu Gemini
+        data = model_ai.json([ANALIZA_PRZEDMIOTU_PROMPT, {"mime_type": mime_type, "data": image_data}],
+                             rodzaj='skan-przedmiotu', timeout=AI_TIMEOUT_SKAN)
+        scan_cache_put('analyze-market', wersja, digest, phash, data)
         
-        return jsonify(data)
+        return scan_response(data, skan_job)
         
+    except klient_ai.AINiedostepne as e:
+        print(f"Błąd AI Market: {e}")
+        if pobrano: ai_quota_refund(current_user.id)
+        return scan_response({"error": "Serwery AI są chwilowo przeciążone. Spróbuj za chwilę."}, skan_job, 503)
     except Exception as e:
         print(f"Błąd AI Market: {e}")
-        return jsonify({"error": "Nie udało się przeanalizować przedmiotu."}), 500
-
+        if pobrano: ai_quota_refund(current_user.id)
+        return scan_response({"error": "Nie udało się przeanalizować przedmiotu."}, skan_job, 500)
+
+
+def opis_prompt(data):
+    # 1. Wyciągamy pięknie wyselekcjonowane dane z frontendu
+    marka = data.get('marka', '')
+    model = data.get('model', '')
+    rok = data.get('rok', '')
+    przebieg = data.get('przebieg', '')
+    cena = data.get('cena', '')
+    paliwo = data.get('paliwo', '')
+    pojemnosc = data.get('pojemnosc', '')
+    wyposazenie = data.get('wyposazenie', '') # Tu są nasze Matrixy i Masaże!
+
+    # 2. Tworzymy dedykowany, precyzyjny prompt dla modelu Flash
+    return f"""
+    Jesteś profesjonalnym copywriterem i ekspertem sprzedaży aut Premium.
+    Napisz chwytliwy, rzetelny i zachęcający do zakupu opis dla tego pojazdu:
+    
+    Pojazd: {marka} {model}
+    Rok produkcji: {rok}
+    Przebieg: {przebieg} km
+    Silnik: {pojemnosc}, {paliwo}
+    Cena: {cena}
+    
+    WYPOSAŻENIE (Zwróć na to szczególną uwagę!): {wyposazenie}
+    
+    ZASADY:
+    1. Opis ma być w języku polskim, podzielony na czytelne, krótkie akapity.
+    2. Użyj estetycznych, nienachalnych emotikon (np. ✅, 💎, 🚀).
+    3. NIE WYMIENIAJ wyposażenia po przecinku! Zamiast tego zgrabnie wpleć opcje (np. z sekcji Wyposażenie) w tekst, opisując, jak podnoszą one prestiż, komfort i bezpieczeństwo. Niech klient poczuje, że kupuje luksus.
+    4. Zachowaj ton profesjonalnego salonu samochodowego – bez sztucznego lania wody, konkretnie i z klasą.
+    """
 
 @app.route('/api/generuj-opis', methods=['POST'])
 @login_required
@@ -1414,51 +3176,98 @@ def generuj_opis_ai():
     if not model_ai: 
         return jsonify({"error": "Błąd połączenia z serwerami Google AI"}), 500
         
-    if not check_ai_limit(): 
+    if not ai_quota_take(current_user.id, app.config['AI_LIMIT_OPIS']): 
         return jsonify({"error": "Osiągnięto dzienny limit zapytań do AI."}), 429
     
     data = request.json
     try:
-        # 1. Wyciągamy pięknie wyselekcjonowane dane z frontendu
-        marka = data.get('marka', '')
-        model = data.get('model', '')
-        rok = data.get('rok', '')
-        przebieg = data.get('przebieg', '')
-        cena = data.get('cena', '')
-        paliwo = data.get('paliwo', '')
-        pojemnosc = data.get('pojemnosc', '')
-        wyposazenie = data.get('wyposazenie', '') # Tu są nasze Matrixy i Masaże!
-
-        # 2. Tworzymy dedykowany, precyzyjny prompt dla modelu Flash
-        prompt = f"""
-        Jesteś profesjonalnym copywriterem i ekspertem sprzedaży aut Premium.
-        Napisz chwytliwy, rzetelny i zachęcający do zakupu opis dla tego pojazdu:
-        
-        Pojazd: {marka} {model}
-        Rok produkcji: {rok}
-        Przebieg: {przebieg} km
-        Silnik: {pojemnosc}, {paliwo}
-        Cena: {cena}
-        
-        WYPOSAŻENIE (Zwróć na to szczególną uwagę!): {wyposazenie}
-        
-        ZASADY:
-        1. Opis ma być w języku polskim, podzielony na czytelne, krótkie akapity.
-        2. Użyj estetycznych, nienachalnych emotikon (np. ✅, 💎, 🚀).
-        3. NIE WYMIENIAJ wyposażenia po przecinku! Zamiast tego zgrabnie wpleć opcje (np. z sekcji Wyposażenie) w tekst, opisując, jak podnoszą one prestiż, komfort i bezpieczeństwo. Niech klient poczuje, że kupuje luksus.
-        4. Zachowaj ton profesjonalnego salonu samochodowego – bez sztucznego lania wody, konkretnie i z klasą.
-        """
-        
-        resp = model_ai.generate_content(prompt)
-        
-        current_user.ai_requests_today += 1
-        db.session.commit()
-        
-        return jsonify({"opis": resp.text.strip()})
+        opis = model_ai.tekst(opis_prompt(data), rodzaj='opis', timeout=AI_TIMEOUT_OPIS)
+        return jsonify({"opis": opis})
+    except klient_ai.AINiedostepne as e:
+        print(f"Błąd generowania opisu: {e}")
+        ai_quota_refund(current_user.id)
+        return jsonify({"error": "Serwery AI są chwilowo przeciążone. Spróbuj za chwilę."}), 503
     except Exception as e:
         print(f"Błąd generowania opisu: {e}")
+        ai_quota_refund(current_user.id)
         return jsonify({"error": "Wystąpił błąd podczas generowania opisu."}), 500
 
+# --- OPIS AI STRUMIENIEM (SSE) ---
+# Tekst z Gemini (stream=True) idzie do formularza fragment po fragmencie, więc pierwsze słowa są
+# widoczne po ułamku sekundy zamiast po całym generowaniu. Gemini czyta osobny wątek i wrzuca
+# fragmenty do kolejki; odpowiedź co OPIS_SSE_PING s wysyła komentarz, więc rozłączenie klienta
+# wychodzi przy najbliższym zapisie - worker jest wtedy zwolniony, a wątek przerywa strumień Gemini.
+# Limit AI pobieramy przed startem (równoległe strumienie go nie przekroczą) i oddajemy, jeśli opis
+# nie dojdzie do końca - w efekcie liczy się raz, za kompletny opis.
+OPIS_SSE_PING = 1.0
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _opis_producent(prompt, kolejka, stop):
+    try:
+        for fragment in model_ai.strumien(prompt, rodzaj='opis-strumien', timeout=AI_TIMEOUT_OPIS):
+            if stop.is_set():
+                break # zamknięcie generatora przerywa strumień Gemini
+            kolejka.put(('fragment', fragment))
+        kolejka.put(('koniec', None))
+    except klient_ai.AINiedostepne as e:
+        print(f"Błąd generowania opisu (strumień): {e}")
+        kolejka.put(('blad', "Serwery AI są chwilowo przeciążone. Spróbuj za chwilę."))
+    except Exception as e:
+        print(f"Błąd generowania opisu (strumień): {e}")
+        kolejka.put(('blad', "Wystąpił błąd podczas generowania opisu."))
+
+@app.route('/api/generuj-opis/stream', methods=['POST'])
+@login_required
+def generuj_opis_stream():
+    if not model_ai:
+        return jsonify({"error": "Błąd połączenia z serwerami Google AI"}), 500
+
+    user_id = current_user.id
+    if not ai_quota_take(user_id, app.config['AI_LIMIT_OPIS']):
+        return jsonify({"error": "Osiągnięto dzienny limit zapytań do AI."}), 429
+
+    kolejka = queue.Queue()
+    stop = Event()
+    Thread(target=_opis_producent, args=(opis_prompt(request.json or {}), kolejka, stop), daemon=True).start()
+
+    def strumien():
+        deadline = time.monotonic() + AI_TIMEOUT_OPIS + 5
+        czesci = []
+        gotowe = False
+        try:
+            yield ": start\n\n" # nagłówki i pierwszy bajt od razu - proxy i przeglądarka otwierają strumień
+            while True:
+                try:
+                    rodzaj, value = kolejka.get(timeout=OPIS_SSE_PING)
+                except queue.Empty:
+                    if time.monotonic() > deadline:
+                        yield _sse('blad', {'error': "Wystąpił błąd podczas generowania opisu."})
+                        return
+                    yield ": ping\n\n"
+                    continue
+                if rodzaj == 'fragment':
+                    czesci.append(value)
+                    yield _sse('fragment', {'t': value})
+                elif rodzaj == 'blad':
+                    yield _sse('blad', {'error': value})
+                    return
+                else:
+                    gotowe = True
+                    yield _sse('koniec', {'opis': ''.join(czesci).strip()})
+                    return
+        finally:
+            # Koniec, błąd albo rozłączenie (GeneratorExit przy zapisie) - wątek nie generuje dalej
+            stop.set()
+            if not gotowe:
+                ai_quota_refund(user_id)
+
+    response = app.response_class(stream_with_context(strumien()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx: bez buforowania odpowiedzi
+    return response
+
 
 @app.route('/rezerwacja/<int:car_id>', methods=['POST'])
 @login_required
@@ -1489,28 +3298,8 @@ def delete_car(car_id):
             if os.path.exists(video_path):
                 os.remove(video_path)
 
-            # 3. Usuwanie zwykłych zdjęć i miniatur z serwera (żeby nie zapchać dysku)
-            for img in c.images:
-                # Oczyszczanie ścieżki 
-                img_relative_path = img.image_path.lstrip('/') 
-                img_full_path = os.path.join(app.root_path, img_relative_path)
-                
-                # Nie usuwamy systemowych placeholderów ani znaków wodnych
-                if os.path.exists(img_full_path) and 'placehold' not in img_full_path and 'watermark' not in img_full_path:
-                    try:
-                        os.remove(img_full_path)
-                    except Exception as e:
-                        pass
-                
-                # Usunięcie pliku miniatury (NOWOŚĆ)
-                if img.thumb_path:
-                    thumb_relative_path = img.thumb_path.lstrip('/')
-                    thumb_full_path = os.path.join(app.root_path, thumb_relative_path)
-                    if os.path.exists(thumb_full_path):
-                        try:
-                            os.remove(thumb_full_path)
-                        except Exception as e:
-                            pass
+            # 3. Zwykłe zdjęcia i miniatury: usunięcie rekordów zdejmuje referencje (triggery),
+            #    a pliki skasuje purge_uploads(), gdy nikt inny ich już nie używa
 
             # 4. Usunięcie rekordu z bazy
             db.session.delete(c)
@@ -1748,6 +3537,9 @@ def edytuj(id):
         
     if request.method == 'POST':
         try:
+            # Zdjęcia najpierw - touch_upload() musi zdążyć przed jakimkolwiek zapisem z tego żądania
+            jobs = submit_images(request.files.getlist('zdjecia'))
+
             car.marka = request.form.get('marka')
             car.model = request.form.get('model')
             car.vin = request.form.get('vin')
@@ -1780,19 +3572,17 @@ def edytuj(id):
             wyposazenie_list = request.form.getlist('wyposazenie')
             car.wyposazenie = ",".join(wyposazenie_list)
             
-            files = request.files.getlist('zdjecia')
-            for file in files:
-                if file and allowed_file(file.filename):
-                    res = save_optimized_image(file, is_car_image=True)
-                    if res:
-                        fname, tfname = res
-                        db.session.add(CarImage(
-                            image_path=url_for('static', filename='uploads/'+fname),
-                            thumb_path=url_for('static', filename='uploads/'+tfname),
-                            car_id=car.id
-                        ))
+            deferred = app.config['IMAGES_DEFERRED'] and jobs
+            if deferred:
+                car.zdjecia_status = 'w_toku'
+                car.zdjecia_od = _utc_now_str()
+            else:
+                for zdj in collect_images(jobs):
+                    db.session.add(CarImage(car_id=car.id, **zdj))
             
             db.session.commit()
+            if deferred:
+                finish_images_async(car.id, jobs, set_main=False)
             flash('Zapisano zmiany!', 'success')
             return redirect('/profil')
         except Exception as e:
@@ -1857,7 +3647,7 @@ def admin_edytuj_user(user_id):
             if file and file.filename != '' and allowed_file(file.filename):
                 filename = save_optimized_image(file, is_car_image=False)
                 if filename:
-                    user.avatar_url = url_for('static', filename='uploads/' + filename)
+                    user.avatar_url = upload_url(filename)
 
         # 3. Zapis w bazie i powrót
         db.session.commit()
@@ -1930,25 +3720,7 @@ def usun_zdjecie(image_id):
     if car.user_id != current_user.id and current_user.username != 'admin':
         return jsonify({'success': False, 'message': 'Brak uprawnień'}), 403
         
-    # 1. Usunięcie głównego pliku obrazu z dysku
-    img_relative_path = img.image_path.lstrip('/') 
-    img_full_path = os.path.join(app.root_path, img_relative_path)
-    if os.path.exists(img_full_path) and 'placehold' not in img_full_path and 'watermark' not in img_full_path:
-        try:
-            os.remove(img_full_path)
-        except Exception:
-            pass
-
-    # 2. Usunięcie miniatury z dysku (NOWOŚĆ)
-    if img.thumb_path:
-        thumb_relative_path = img.thumb_path.lstrip('/')
-        thumb_full_path = os.path.join(app.root_path, thumb_relative_path)
-        if os.path.exists(thumb_full_path):
-            try:
-                os.remove(thumb_full_path)
-            except Exception:
-                pass
-                
+    # Plik na dysku zostaje, dopóki używa go inne ogłoszenie/awatar - sprząta purge_uploads()
     db.session.delete(img)
     db.session.commit()
     return jsonify({'success': True})
@@ -2033,7 +3805,31 @@ def update_db():
             ("car", "is_reserved", "BOOLEAN DEFAULT 0"), # <--- TO DODAJ (pamiętaj o przecinku w linijce wyżej!)
             # --- NOWE KOLUMNY DLA MINIATUR ---
             ("car", "thumb", "TEXT"),
-            ("carimage", "thumb_path", "TEXT")
+            ("carimage", "thumb_path", "TEXT"),
+            # --- WYCENA AI W KOLUMNACH (zamiast parsowania ai_label w szablonach) ---
+            ("car", "ai_ocena", "TEXT"),
+            ("car", "ai_score", "INTEGER"),
+            ("car", "ai_werdykt", "TEXT"),
+            ("car", "ai_kolor", "TEXT"),
+            ("car", "ai_pl_min", "FLOAT"),
+            ("car", "ai_pl_avg", "FLOAT"),
+            ("car", "ai_pl_max", "FLOAT"),
+            ("car", "ai_paint_score", "INTEGER"),
+            ("car", "ai_paint_status", "TEXT"),
+            ("car", "ai_klasa", "TEXT"),
+            ("car", "ai_spalanie_miasto", "FLOAT"),
+            ("car", "ai_spalanie_trasa", "FLOAT"),
+            ("car", "ai_spalanie_mieszany", "FLOAT"),
+            ("car", "ai_price_comment", "TEXT"),
+            ("car", "ai_engine_comment", "TEXT"),
+            ("car", "wycena_od", "TEXT"),
+            ("car", "zdjecia_status", "TEXT"),
+            ("car", "zdjecia_od", "TEXT"),
+            # --- PLACEHOLDERY ZDJĘĆ (LQIP + kolor dominujący) ---
+            ("car", "img_lqip", "TEXT"),
+            ("car", "img_color", "TEXT"),
+            (CarImage.__tablename__, "lqip", "TEXT"),
+            (CarImage.__tablename__, "dominant_color", "TEXT")
         ]
         
         for table, col, dtype in columns_to_add:
@@ -2045,6 +3841,49 @@ def update_db():
         conn.commit()
         conn.close()
 
+# --- INDEKSY BAZY (pod realne zapytania z tras) ---
+# Jedno źródło prawdy: create_indexes() zakłada brakujące, indeksy.py sprawdza plany zapytań.
+DB_INDEXES = [
+    # Strona główna / szukaj: ORDER BY is_promoted, data_dodania, id (+ kursor keyset)
+    ("ix_car_listing", "car(is_promoted DESC, data_dodania DESC, id DESC)"),
+    # Kafelki kategorii i Rozmaitości: typ = / typ IN (...) + sortowanie po dacie
+    ("ix_car_typ_listing", "car(typ, is_promoted DESC, data_dodania DESC, id DESC)"),
+    ("ix_car_typ_data", "car(typ, data_dodania DESC, id DESC)"),
+    ("ix_car_nadwozie", "car(nadwozie, data_dodania DESC)"),
+    ("ix_car_paliwo", "car(paliwo, skrzynia)"),
+    ("ix_car_cena", "car(cena)"),
+    ("ix_car_rok", "car(rok)"),
+    ("ix_car_przebieg", "car(przebieg)"),
+    # Filtr "Ocena AI" w szukaj (dawniej LIKE po JSON-ie w ai_label)
+    ("ix_car_ai_ocena", "car(ai_ocena, is_promoted DESC, data_dodania DESC, id DESC)"),
+    # Garaż, profil sprzedawcy i kaskada przy usuwaniu konta
+    ("ix_car_user", "car(user_id, data_dodania DESC, id DESC)"),
+    # Wygasanie ogłoszeń (cleanup + przypomnienia mailowe)
+    ("ix_car_data", "car(data_dodania)"),
+    # Częściowy: tylko promowane (GOLD) - mały i zawsze gorący
+    ("ix_car_promoted", "car(data_dodania DESC) WHERE is_promoted = 1"),
+    ("ix_favorite_user_car", "favorite(user_id, car_id)"),
+    ("ix_favorite_car", "favorite(car_id)"),
+    ("ix_carimage_car", f"{CarImage.__tablename__}(car_id)"),
+    ("ix_user_last_seen", "user(last_seen)"),
+]
+
+def create_indexes(analyze=False):
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            c = conn.cursor()
+            for name, definition in DB_INDEXES:
+                try:
+                    c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+                except sqlite3.OperationalError as e:
+                    print(f"Indeks {name} pominięty: {e}") # np. brak tabeli w bardzo starej bazie
+            if analyze:
+                c.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+
 # --- WYSYŁKA PRZYPOMNIENIA O WYGAŚNIĘCIU (2 DNI DO KOŃCA) ---
 def wyslij_przypomnienie_async(app, email, username, marka, model):
     with app.app_context():
@@ -2104,14 +3943,42 @@ def automatyczne_sprawdzanie_wygasajacych():
 scheduler = BackgroundScheduler(daemon=True)
 # Ustawiamy, aby system sam wysyłał maile CODZIENNIE rano o 10:00
 scheduler.add_job(automatyczne_sprawdzanie_wygasajacych, 'cron', hour=10, minute=0)
+# Korekta ewentualnego dryfu liczników filtrów (np. po ręcznych zmianach w bazie)
+scheduler.add_job(reconcile_facets, 'interval', hours=6)
+# Zapis zbuforowanych wyświetleń ogłoszeń
+scheduler.add_job(flush_views, 'interval', seconds=VIEWS_FLUSH_SECONDS, max_instances=1, coalesce=True)
+# Zbiorczy zapis "ostatnio widziany" zalogowanych użytkowników
+scheduler.add_job(flush_last_seen, 'interval', seconds=LAST_SEEN_FLUSH_SECONDS, max_instances=1, coalesce=True)
+# Kasowanie plików zdjęć bez referencji (magazyn adresowany treścią)
+scheduler.add_job(purge_uploads, 'interval', minutes=UPLOAD_GRACE_MINUTES, max_instances=1, coalesce=True)
+# Ogłoszenia z obróbką zdjęć przerwaną restartem workera (tryb odroczony) -> 'blad' zamiast wiecznego 'w_toku'
+scheduler.add_job(sweep_stale_images, 'interval', minutes=10, max_instances=1, coalesce=True)
+# Porzucone tokeny skanu AI (zdjęcie bez ogłoszenia) - plik sprząta potem purge_uploads
+scheduler.add_job(purge_scan_tokens, 'interval', minutes=UPLOAD_GRACE_MINUTES, max_instances=1, coalesce=True)
+# Limit miejsca na warianty zdjęć (srcset)
+scheduler.add_job(prune_variants, 'interval', hours=1, max_instances=1, coalesce=True)
+# Przycinanie dziennika zmian dla lokalnego szacunku cen
+scheduler.add_job(prune_price_changes, 'interval', hours=1, max_instances=1, coalesce=True)
+# Nocne odświeżanie przeterminowanych wycen (najpierw promowane i najczęściej oglądane)
+scheduler.add_job(refresh_stale_valuations, 'cron', hour=VALUATION_BATCH_HOURS,
+                  minute=f'*/{VALUATION_BATCH_EVERY_MINUTES}', max_instances=1, coalesce=True)
 scheduler.start()
 
 # Zabezpieczenie: grzeczne zamykanie harmonogramu przy restarcie aplikacji
 atexit.register(lambda: scheduler.shutdown())
+# atexit działa od końca: najpierw zrzucamy bufor wyświetleń, potem gasimy harmonogram
+atexit.register(flush_views)
+atexit.register(flush_last_seen)
 # ==========================================
 
 if __name__ == '__main__':
     update_db()
     with app.app_context():
         db.create_all()
+    create_indexes()
+    init_fts()
+    init_facets()
+    init_uploads()
+    init_price_estimator()
+    backfill_valuations()
     app.run(host='0.0.0.0', port=5000)
@@ -1,6 +1,6 @@
 import os
 from datetime import datetime, timedelta
-from app import app, db, Car, CarImage
+from app import app, db, Car, CarImage, purge_uploads
 
 def run_maintenance():
     """Główna funkcja sprzątająca serwer."""
@@ -19,18 +19,8 @@ def run_maintenance():
         files_removed = 0
 
         for car in expired_cars:
-            # 1. Usuwanie plików zdjęć z dysku
-            for img_record in car.images:
-                # Wyciągamy nazwę pliku ze ścieżki (np. /static/uploads/foto.webp -> foto.webp)
-                filename = img_record.image_path.split('/')[-1]
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                
-                if os.path.exists(filepath):
-                    try:
-                        os.remove(filepath)
-                        files_removed += 1
-                    except Exception as e:
-                        print(f"Błąd usuwania pliku {filename}: {e}")
+            # 1. Pliki zdjęć NIE są kasowane tutaj - mogą być współdzielone (magazyn po hashu).
+            #    Usunięcie rekordów zdejmuje referencje, a purge_uploads() skasuje nieużywane pliki.
 
             # 2. Usuwanie rekordu z bazy danych
             try:
@@ -40,6 +30,9 @@ def run_maintenance():
                 print(f"Błąd usuwania rekordu ID {car.id}: {e}")
 
         db.session.commit()
+        # purge_uploads() kasuje pliki bez referencji dłużej niż UPLOAD_GRACE_MINUTES;
+        # te zwolnione przed chwilą zdejmie harmonogram aplikacji przy kolejnym przebiegu
+        files_removed = purge_uploads()
         print(f"[{datetime.now()}] SUKCES: Usunięto {deleted_count} ogłoszeń i {files_removed} plików zdjęć.")
 
 if __name__ == "__main__":
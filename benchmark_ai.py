@@ -0,0 +1,60 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import klient_ai
+
+# Obciążenie warstwy klient_ai na atrapie (bez sieci i bez kosztów): ile wywołań kończy się
+# w limicie czasu, ile odrzuca bezpiecznik i jak rosną czasy, gdy "Gemini" zwalnia albo się sypie.
+#   python benchmark_ai.py                   -> scenariusze domyślne
+#   python benchmark_ai.py 0.5 4 16 200      -> opóźnienie [s], co który błąd, wątki, wywołania
+
+PROMPT = 'Zwróć TYLKO czysty JSON: { "score": (liczba 1-100), "label": (np. "DOBRA CENA", "DROGO") }'
+SCENARIUSZE = [
+    # (opis, opóźnienie [s], co który błąd)
+    ("zdrowy", 0.05, 0),
+    ("wolny", 0.5, 0),
+    ("co 4. błąd", 0.05, 4),
+    ("awaria", 0.05, 1),
+]
+WATKI = 16
+WYWOLANIA = 200
+TIMEOUT = 2.0
+
+def jedno(klient):
+    try:
+        klient.json(PROMPT, rodzaj='bench', timeout=TIMEOUT)
+        return 'ok'
+    except klient_ai.AINiedostepne:
+        return 'niedostepne'
+    except klient_ai.BladAI:
+        return 'blad'
+
+def zmierz(opoznienie, co_ktory_blad, watki=WATKI, wywolania=WYWOLANIA):
+    klient = klient_ai.KlientAI(klient_ai.AtrapaAI(opoznienie, co_ktory_blad))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=watki) as pool:
+        wyniki = list(pool.map(lambda _: jedno(klient), range(wywolania)))
+    czas = time.perf_counter() - start
+    m = klient.metryki.raport().get('bench', {})
+    return {
+        'ok': wyniki.count('ok'), 'niedostepne': wyniki.count('niedostepne'), 'blad': wyniki.count('blad'),
+        'na_s': wywolania / czas, 'p50': m.get('czas_p50_ms', 0), 'p95': m.get('czas_p95_ms', 0),
+        'ponowienia': m.get('ponowienia', 0), 'odrzucone': m.get('odrzucone', 0),
+    }
+
+def run(args):
+    scenariusze = SCENARIUSZE
+    watki, wywolania = WATKI, WYWOLANIA
+    if args:
+        scenariusze = [("własny", float(args[0]), int(args[1]) if len(args) > 1 else 0)]
+        watki = int(args[2]) if len(args) > 2 else WATKI
+        wywolania = int(args[3]) if len(args) > 3 else WYWOLANIA
+
+    print(f"\n{'scenariusz':<13}{'ok':>6}{'odmowa':>8}{'błąd':>6}{'wyw/s':>8}{'p50 ms':>8}{'p95 ms':>8}{'ponow.':>8}{'bezp.':>7}")
+    for opis, opoznienie, co_ktory in scenariusze:
+        w = zmierz(opoznienie, co_ktory, watki, wywolania)
+        print(f"{opis:<13}{w['ok']:>6}{w['niedostepne']:>8}{w['blad']:>6}{w['na_s']:>8.0f}"
+              f"{w['p50']:>8}{w['p95']:>8}{w['ponowienia']:>8}{w['odrzucone']:>7}")
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,96 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import resource
+import multiprocessing
+from PIL import Image, ImageOps
+import obrazy
+
+# Pomiar dekodowania zdjęć z telefonu: stara ścieżka (pełne dekodowanie) vs otworz_zmniejszone() (draft).
+# Każdy pomiar w świeżym procesie, żeby szczyt RSS jednego zdjęcia nie zasłaniał następnego.
+#   python benchmark_zdjec.py                 -> syntetyczne 12 MP i 48 MP (EXIF: obrót o 90°)
+#   python benchmark_zdjec.py a.jpg b.jpg     -> własne zdjęcia
+
+ROZMIARY = [(1920, 1920), (1024, 1024)] # upload ogłoszenia / skan AI
+POWTORZENIA = 3
+
+def stara_sciezka(data, max_size):
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return image
+
+def nowa_sciezka(data, max_size):
+    image = obrazy.otworz_zmniejszone(io.BytesIO(data), max_size)
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return image
+
+def szczyt_rss_mb():
+    # VmHWM jest per przestrzeń adresowa (zerowany przy exec); ru_maxrss przechodzi przez exec
+    # i w procesie ze spawn pokazywałby szczyt rodzica, który generował 48 MP zdjęcie.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _pomiar(fn, sciezka, max_size, kolejka):
+    # Plik czytany dopiero tutaj - przekazanie bajtów przez pickle podbijałoby szczyt RSS przed pomiarem
+    with open(sciezka, 'rb') as f:
+        data = f.read()
+    rss_start = szczyt_rss_mb()
+    czasy = []
+    for _ in range(POWTORZENIA):
+        t = time.perf_counter()
+        image = fn(data, max_size)
+        czasy.append(time.perf_counter() - t)
+    kolejka.put((min(czasy), szczyt_rss_mb() - rss_start, image.size))
+
+def zmierz(fn, sciezka, max_size):
+    ctx = multiprocessing.get_context('spawn') # czysty proces - fork dziedziczyłby zwolnioną stertę rodzica
+    kolejka = ctx.Queue()
+    proc = ctx.Process(target=_pomiar, args=(fn, sciezka, max_size, kolejka))
+    proc.start()
+    wynik = kolejka.get()
+    proc.join()
+    return wynik
+
+def syntetyczne_zdjecie(width, height):
+    # Szum + gradient, żeby JPEG miał realistyczną ilość danych; orientacja 6 = telefon trzymany pionowo
+    image = Image.merge('RGB', [Image.effect_noise((width, height), 40).point(lambda p, k=k: (p + k) % 256) for k in (0, 60, 120)])
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=90, exif=exif)
+    return buf.getvalue()
+
+def run(sciezki):
+    if sciezki:
+        zdjecia = [(os.path.basename(p), p) for p in sciezki]
+    else:
+        print("🔧 Generuję syntetyczne zdjęcia (12 MP i 48 MP)...")
+        katalog = tempfile.mkdtemp(prefix='bench_zdjec_')
+        zdjecia = []
+        for nazwa, wymiary in (("12MP", (4000, 3000)), ("48MP", (8000, 6000))):
+            sciezka = os.path.join(katalog, f"{nazwa}.jpg")
+            with open(sciezka, 'wb') as f:
+                f.write(syntetyczne_zdjecie(*wymiary))
+            zdjecia.append((nazwa, sciezka))
+
+    print(f"\n{'zdjęcie':<14}{'cel':<11}{'stara [ms]':>11}{'nowa [ms]':>11}{'RSS stara':>11}{'RSS nowa':>10}{'wynik':>13}")
+    for nazwa, sciezka in zdjecia:
+        for max_size in ROZMIARY:
+            t_old, rss_old, size_old = zmierz(stara_sciezka, sciezka, max_size)
+            t_new, rss_new, size_new = zmierz(nowa_sciezka, sciezka, max_size)
+            if size_old != size_new:
+                print(f"⚠️ {nazwa}: różne wymiary wyniku {size_old} vs {size_new}")
+            print(f"{nazwa:<14}{max_size[0]:<11}{t_old * 1000:>11.0f}{t_new * 1000:>11.0f}"
+                  f"{rss_old:>9.0f}MB{rss_new:>8.0f}MB{t_old / t_new:>12.1f}x")
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,71 @@
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import tuple_
+from sqlalchemy.dialects import sqlite
+from app import app, db, Car, User, Favorite, CarImage, create_indexes, DB_INDEXES
+
+# Kategorie ukryte w głównej wyszukiwarce (tak jak w index() / szukaj())
+INNE = ['Rozmaitosci', 'DomOgrad', 'Inne']
+
+def route_queries():
+    """Zapytania o takim samym kształcie, jakie wysyłają trasy aplikacji."""
+    teraz = datetime.utcnow()
+    kursor = (True, teraz, 1000)
+    lista = [Car.is_promoted.desc(), Car.data_dodania.desc(), Car.id.desc()]
+    glowna = Car.query.filter(Car.typ.notin_(INNE))
+
+    return [
+        ("index: strona 1", glowna.order_by(*lista).limit(25)),
+        ("index: kolejna strona (kursor)", glowna.filter(tuple_(Car.is_promoted, Car.data_dodania, Car.id) < kursor).order_by(*lista).limit(25)),
+        ("index: licznik wyników", glowna.with_entities(db.func.count(Car.id))),
+        ("index: kafel kategorii", Car.query.filter(Car.typ == 'SUV').order_by(*lista).limit(25)),
+        ("index: ostatnie rozmaitości", Car.query.filter(Car.typ.in_(INNE)).order_by(Car.data_dodania.desc()).limit(4)),
+        ("szukaj: paliwo + skrzynia", glowna.filter(Car.paliwo == 'Diesel', Car.skrzynia == 'Automatyczna').order_by(*lista).limit(25)),
+        ("szukaj: widełki ceny", glowna.filter(Car.cena >= 20000, Car.cena <= 30000).order_by(*lista).limit(25)),
+        ("szukaj: ocena AI", glowna.filter(Car.ai_ocena == 'SUPER').order_by(*lista).limit(25)),
+        ("szukaj: rocznik", glowna.filter(Car.rok >= 2020).order_by(*lista).limit(25)),
+        ("rozmaitosci: lista", Car.query.filter(Car.typ.in_(INNE)).order_by(Car.data_dodania.desc(), Car.id.desc()).limit(25)),
+        ("rozmaitosci: podkategoria", Car.query.filter(Car.typ.in_(INNE), Car.nadwozie == 'Akcesoria').order_by(Car.data_dodania.desc(), Car.id.desc()).limit(25)),
+        ("profil: garaż użytkownika", Car.query.filter_by(user_id=1).order_by(Car.data_dodania.desc(), Car.id.desc()).limit(25)),
+        ("profil: online teraz", User.query.filter(User.last_seen >= teraz - timedelta(minutes=5)).with_entities(db.func.count(User.id))),
+        ("profil: obserwowane", Favorite.query.filter_by(user_id=1)),
+        ("sprzedawca: oferty", Car.query.filter_by(user_id=1).order_by(Car.is_promoted.desc(), Car.data_dodania.desc())),
+        ("toggle_favorite", Favorite.query.filter_by(user_id=1, car_id=1)),
+        ("car.images (lazy load)", CarImage.query.filter_by(car_id=1)),
+        ("kaskada: favorite po car_id", Favorite.query.filter_by(car_id=1)),
+        ("cleanup: wygasłe", Car.query.filter(Car.data_dodania < teraz - timedelta(days=30))),
+        ("cron: przypomnienia", Car.query.filter(Car.data_dodania >= teraz - timedelta(days=29), Car.data_dodania <= teraz - timedelta(days=28))),
+    ]
+
+def explain(query):
+    compiled = query.statement.compile(dialect=sqlite.dialect(paramstyle='named'), compile_kwargs={'render_postcompile': True})
+    params = {k: (str(v) if isinstance(v, datetime) else v) for k, v in compiled.params.items()}
+    conn = db.session.connection().connection # surowe połączenie sqlite3
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()]
+
+def is_full_scan(detail):
+    # "SCAN car" = pełny skan tabeli; "SCAN car USING INDEX" to przejście po indeksie (OK przy LIMIT)
+    return detail.startswith('SCAN') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail
+
+def run():
+    with app.app_context():
+        print(f"🔧 Zakładam brakujące indeksy ({len(DB_INDEXES)}) i odświeżam statystyki (ANALYZE)...")
+        create_indexes(analyze=True)
+
+        problemy = 0
+        for nazwa, query in route_queries():
+            plan = explain(query)
+            skany = [d for d in plan if is_full_scan(d)]
+            sort = [d for d in plan if 'TEMP B-TREE' in d]
+            status = "❌ SKAN" if skany else ("⚠️ SORT" if sort else "✅ OK")
+            print(f"\n{status}  {nazwa}")
+            for d in plan:
+                print(f"      {d}")
+            if skany:
+                problemy += 1
+
+        print(f"\n{'✅ Wszystkie zapytania korzystają z indeksów.' if not problemy else f'❌ Zapytań ze skanem tabeli: {problemy}'}")
+        return problemy
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
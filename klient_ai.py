@@ -0,0 +1,363 @@
+import re
+import json
+import time
+import random
+import hashlib
+from collections import deque
+from threading import Lock
+
+# Jedna warstwa nad Gemini dla całej aplikacji (bez Flaska): limit czasu na wywołanie, ponowienia
+# z losowym odstępem, bezpiecznik (po serii błędów od razu odmawiamy zamiast wieszać workera),
+# wyciąganie JSON-a z odpowiedzi i metryki (czas, tokeny). Backend to genai.GenerativeModel
+# albo AtrapaAI - deterministyczna atrapa do testów i benchmarków, bez sieci.
+
+TIMEOUT = 20.0        # sekund na całe wywołanie, razem z ponowieniami
+PROBY = 3
+BACKOFF_BAZA = 0.5
+BACKOFF_MAX = 4.0
+MIN_NA_PROBE = 1.0    # mniej czasu niż tyle - nie zaczynamy kolejnej próby
+BEZPIECZNIK_PROG = 5  # tyle przejściowych błędów z rzędu otwiera bezpiecznik
+BEZPIECZNIK_PRZERWA = 30.0
+PROBKI_CZASU = 200
+
+# Nazwy klas z google.api_core.exceptions (+ wbudowane) - błędy, które ma sens ponowić
+PRZEJSCIOWE = {'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+               'DeadlineExceeded', 'GatewayTimeout', 'Aborted', 'Unknown', 'RetryError',
+               'TimeoutError', 'ConnectionError', 'ConnectionResetError'}
+
+
+class BladAI(Exception):
+    """Gemini nie dał użytecznej odpowiedzi (błąd, pusta odpowiedź, zły JSON)."""
+
+
+class AINiedostepne(BladAI):
+    """Bezpiecznik otwarty albo skończył się czas - szybka odmowa zamiast czekania."""
+
+
+def przejsciowy(e):
+    return any(cls.__name__ in PRZEJSCIOWE for cls in type(e).__mro__)
+
+
+def wyciagnij_json(text):
+    """Pierwszy obiekt/lista JSON z odpowiedzi modelu - odporne na ```json, wstęp i przecinki na końcu."""
+    if not text:
+        raise BladAI("pusta odpowiedź")
+    text = re.sub(r'```(?:json)?', '', text)
+    start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+    if start < 0:
+        raise BladAI("brak JSON w odpowiedzi")
+    decoder = json.JSONDecoder()
+    try:
+        return decoder.raw_decode(text, start)[0]
+    except ValueError:
+        pass
+    try:
+        return decoder.raw_decode(re.sub(r',\s*([}\]])', r'\1', text), start)[0]
+    except ValueError as e:
+        raise BladAI(f"niepoprawny JSON: {e}") from None
+
+
+class Bezpiecznik:
+    """Zamknięty -> (prog błędów z rzędu) -> otwarty na przerwa s -> półotwarty: jedna próba."""
+
+    def __init__(self, prog=BEZPIECZNIK_PROG, przerwa=BEZPIECZNIK_PRZERWA):
+        self.prog = prog
+        self.przerwa = przerwa
+        self.bledy = 0
+        self.otwarty_do = 0.0
+        self.proba_w_toku = False
+        self.lock = Lock()
+
+    @property
+    def stan(self):
+        if self.bledy < self.prog:
+            return 'zamkniety'
+        return 'otwarty' if time.monotonic() < self.otwarty_do else 'polotwarty'
+
+    def przepusc(self):
+        with self.lock:
+            if self.bledy < self.prog:
+                return True
+            if time.monotonic() < self.otwarty_do or self.proba_w_toku:
+                return False
+            self.proba_w_toku = True # półotwarty: przechodzi jedno wywołanie próbne
+            return True
+
+    def sukces(self):
+        with self.lock:
+            self.bledy = 0
+            self.proba_w_toku = False
+
+    def porazka(self):
+        with self.lock:
+            self.bledy += 1
+            self.proba_w_toku = False
+            if self.bledy >= self.prog:
+                self.otwarty_do = time.monotonic() + self.przerwa
+
+
+class Metryki:
+    """Liczniki i czasy per rodzaj wywołania (wycena, skan-auta, opis...)."""
+
+    CZASY = ('czas', 'pierwszy_fragment') # próbki -> percentyle w raporcie
+
+    def __init__(self):
+        self.lock = Lock()
+        self.dane = {}
+
+    def _rodzaj(self, rodzaj):
+        return self.dane.setdefault(rodzaj, {
+            'wywolania': 0, 'bledy': 0, 'ponowienia': 0, 'odrzucone': 0,
+            'tokeny_wej': 0, 'tokeny_wyj': 0, **{name: deque(maxlen=PROBKI_CZASU) for name in self.CZASY},
+        })
+
+    def zapisz(self, rodzaj, **liczniki):
+        with self.lock:
+            m = self._rodzaj(rodzaj)
+            for name, value in liczniki.items():
+                if name in self.CZASY:
+                    m[name].append(value)
+                else:
+                    m[name] += value
+
+    def raport(self):
+        with self.lock:
+            wynik = {}
+            for rodzaj, m in self.dane.items():
+                wynik[rodzaj] = {k: v for k, v in m.items() if k not in self.CZASY}
+                for name in self.CZASY:
+                    czasy = sorted(m[name])
+                    if czasy:
+                        wynik[rodzaj][f'{name}_p50_ms'] = round(czasy[len(czasy) // 2] * 1000)
+                        wynik[rodzaj][f'{name}_p95_ms'] = round(czasy[min(len(czasy) - 1, int(len(czasy) * 0.95))] * 1000)
+            return wynik
+
+
+class KlientAI:
+    """Opakowanie backendu z generate_content(content, request_options=...)."""
+
+    def __init__(self, backend, timeout=TIMEOUT, proby=PROBY, bezpiecznik=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.proby = proby
+        self.bezpiecznik = bezpiecznik or Bezpiecznik()
+        self.metryki = Metryki()
+
+    def generate_content(self, content, rodzaj='inne', timeout=None, proby=None):
+        """Odpowiedź backendu; BladAI/AINiedostepne, gdy się nie udało w zadanym czasie."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        proby = proby or self.proby
+        for proba in range(proby):
+            if not self.bezpiecznik.przepusc():
+                self.metryki.zapisz(rodzaj, odrzucone=1)
+                raise AINiedostepne("Gemini chwilowo niedostępny (bezpiecznik otwarty)")
+            zostalo = deadline - time.monotonic()
+            start = time.monotonic()
+            try:
+                response = self.backend.generate_content(content, request_options={'timeout': zostalo})
+            except Exception as e:
+                self._po_bledzie(e, rodzaj, start, proba, proby, deadline)
+                continue
+            self._po_sukcesie(response, rodzaj, start)
+            return response
+
+    def strumien(self, content, rodzaj='inne', timeout=None, proby=None):
+        """Fragmenty tekstu w miarę generowania (stream=True). Ponawia tylko, zanim cokolwiek przyszło."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        proby = proby or self.proby
+        for proba in range(proby):
+            if not self.bezpiecznik.przepusc():
+                self.metryki.zapisz(rodzaj, odrzucone=1)
+                raise AINiedostepne("Gemini chwilowo niedostępny (bezpiecznik otwarty)")
+            zostalo = deadline - time.monotonic()
+            start = time.monotonic()
+            response, pierwszy = None, None
+            try:
+                response = self.backend.generate_content(content, stream=True, request_options={'timeout': zostalo})
+                for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError: # fragment bez tekstu (np. sam finish_reason)
+                        continue
+                    if not text:
+                        continue
+                    if pierwszy is None:
+                        pierwszy = time.monotonic() - start
+                        self.metryki.zapisz(rodzaj, pierwszy_fragment=pierwszy)
+                    yield text
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("przekroczony czas generowania")
+            except GeneratorExit:
+                # Odbiorca się rozłączył - przerywamy strumień, żeby Gemini nie generował dalej na próżno
+                _przerwij(response)
+                self.bezpiecznik.sukces()
+                self.metryki.zapisz(rodzaj, wywolania=1, czas=time.monotonic() - start)
+                raise
+            except Exception as e:
+                _przerwij(response)
+                if pierwszy is not None:
+                    # Część tekstu już poszła do klienta - ponowienie zdublowałoby początek
+                    self.metryki.zapisz(rodzaj, wywolania=1, bledy=1, czas=time.monotonic() - start)
+                    if przejsciowy(e):
+                        self.bezpiecznik.porazka()
+                    raise AINiedostepne(f"Gemini przerwał generowanie ({type(e).__name__}: {e})") from e
+                self._po_bledzie(e, rodzaj, start, proba, proby, deadline)
+                continue
+            if pierwszy is None:
+                self.metryki.zapisz(rodzaj, wywolania=1, bledy=1, czas=time.monotonic() - start)
+                raise BladAI("pusta odpowiedź")
+            self._po_sukcesie(response, rodzaj, start)
+            return
+
+    def _po_bledzie(self, e, rodzaj, start, proba, proby, deadline):
+        """Rzuca BladAI/AINiedostepne albo odczekuje przed kolejną próbą."""
+        self.metryki.zapisz(rodzaj, wywolania=1, bledy=1, czas=time.monotonic() - start)
+        if not przejsciowy(e):
+            self.bezpiecznik.sukces() # serwer odpowiedział - to nasz błąd, nie awaria Gemini
+            raise BladAI(f"{type(e).__name__}: {e}") from e
+        self.bezpiecznik.porazka()
+        # Pełny jitter: losowo z [0, baza * 2^proba], ale nie dłużej niż zostało czasu
+        pauza = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BAZA * 2 ** proba))
+        if proba + 1 >= proby or deadline - time.monotonic() - pauza < MIN_NA_PROBE:
+            raise AINiedostepne(f"Gemini nie odpowiedział ({type(e).__name__}: {e})") from e
+        self.metryki.zapisz(rodzaj, ponowienia=1)
+        time.sleep(pauza)
+
+    def _po_sukcesie(self, response, rodzaj, start):
+        self.bezpiecznik.sukces()
+        usage = getattr(response, 'usage_metadata', None)
+        self.metryki.zapisz(rodzaj, wywolania=1, czas=time.monotonic() - start,
+                            tokeny_wej=getattr(usage, 'prompt_token_count', 0) or 0,
+                            tokeny_wyj=getattr(usage, 'candidates_token_count', 0) or 0)
+
+    def tekst(self, content, **kwargs):
+        response = self.generate_content(content, **kwargs)
+        try:
+            text = response.text # genai rzuca ValueError, gdy odpowiedź zablokowały filtry
+        except ValueError as e:
+            raise BladAI(f"odpowiedź zablokowana: {e}") from e
+        if not text or not text.strip():
+            raise BladAI("pusta odpowiedź")
+        return text.strip()
+
+    def json(self, content, **kwargs):
+        return wyciagnij_json(self.tekst(content, **kwargs))
+
+
+def _przerwij(response):
+    # Strumień genai nie ma publicznego cancel() - próbujemy na odpowiedzi i na jej iteratorze gRPC
+    for obj in (response, getattr(response, '_iterator', None)):
+        for name in ('cancel', 'close'):
+            fn = getattr(obj, name, None)
+            if callable(fn):
+                try:
+                    fn()
+                except Exception:
+                    pass
+
+
+# --- ATRAPA (TESTY, BENCHMARKI) ---
+
+class _Odpowiedz:
+    def __init__(self, text, prompt_tokens):
+        self.text = text
+        self.usage_metadata = type('Usage', (), {
+            'prompt_token_count': prompt_tokens, 'candidates_token_count': len(text) // 4})()
+
+
+class _Strumien:
+    """Jak odpowiedź genai ze stream=True: iteracja po fragmentach, usage_metadata na końcu."""
+
+    def __init__(self, text, prompt_tokens, opoznienie):
+        self.text = text
+        self.usage_metadata = _Odpowiedz(text, prompt_tokens).usage_metadata
+        self.opoznienie = opoznienie
+        self.przerwany = False
+
+    def __iter__(self):
+        for fragment in re.findall(r'\S+\s*', self.text):
+            if self.przerwany:
+                return
+            if self.opoznienie:
+                time.sleep(self.opoznienie)
+            yield _Odpowiedz(fragment, 0)
+
+    def cancel(self):
+        self.przerwany = True
+
+
+class AtrapaAI:
+    """Deterministyczny backend: ta sama treść -> ta sama odpowiedź, bez sieci.
+
+    Jeśli prompt zawiera szablon JSON (jak wszystkie prompty aplikacji), wypełnia go: "(liczba 1-100)"
+    -> liczba z zakresu, "(np. "A", "B")" -> pierwsza opcja, przykładowe wartości zostają. Bez szablonu
+    zwraca krótki tekst. opoznienie symuluje czas odpowiedzi, co_ktory_blad - co n-te wywołanie
+    kończy się błędem przejściowym (do sprawdzania ponowień i bezpiecznika). Przy stream=True tekst
+    przychodzi po słowie, co opoznienie_fragmentu sekund.
+    """
+
+    def __init__(self, opoznienie=0.0, co_ktory_blad=0, opoznienie_fragmentu=0.02):
+        self.opoznienie = opoznienie
+        self.co_ktory_blad = co_ktory_blad
+        self.opoznienie_fragmentu = opoznienie_fragmentu
+        self.wywolania = 0
+        self.lock = Lock()
+
+    def generate_content(self, content, stream=False, request_options=None):
+        with self.lock:
+            self.wywolania += 1
+            numer = self.wywolania
+        timeout = (request_options or {}).get('timeout')
+        if self.opoznienie:
+            time.sleep(min(self.opoznienie, timeout) if timeout else self.opoznienie)
+            if timeout and self.opoznienie > timeout:
+                raise TimeoutError("atrapa: przekroczony czas")
+        if self.co_ktory_blad and numer % self.co_ktory_blad == 0:
+            raise ConnectionError("atrapa: symulowany błąd przejściowy")
+        parts = content if isinstance(content, list) else [content]
+        prompt = '\n'.join(p for p in parts if isinstance(p, str))
+        ziarno = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8], 16)
+        szablon = self._szablon(prompt)
+        text = json.dumps(self._wypelnij(szablon, ziarno), ensure_ascii=False) if szablon else \
+            f"Opis testowy #{ziarno % 10000}: zadbany egzemplarz, gotowy do jazdy. ✅"
+        if stream:
+            return _Strumien(text, len(prompt) // 4, self.opoznienie_fragmentu)
+        return _Odpowiedz(text, len(prompt) // 4)
+
+    @staticmethod
+    def _szablon(prompt):
+        # Ostatni zbalansowany blok {...} w prompcie
+        end = prompt.rfind('}')
+        depth = 0
+        for i in range(end, -1, -1):
+            depth += {'}': 1, '{': -1}.get(prompt[i], 0)
+            if depth == 0:
+                return prompt[i:end + 1]
+        return None
+
+    @staticmethod
+    def _wypelnij(szablon, ziarno):
+        rnd = random.Random(ziarno)
+        baza = rnd.randrange(20000, 80000, 100)
+        liczby = iter(range(100))
+
+        def zamien(m):
+            opis = m.group(1)
+            opcje = re.findall(r'"([^"]+)"', opis)
+            if opcje:
+                return json.dumps(opcje[0], ensure_ascii=False)
+            zakres = re.search(r'(\d+)\s*-\s*(\d+)', opis)
+            if 'liczba' in opis:
+                if zakres:
+                    return str(rnd.randint(int(zakres.group(1)), int(zakres.group(2))))
+                return str(int(baza * (0.8 + 0.2 * next(liczby)))) # rosnąco: min < średnia < max
+            litera = re.search(r'litera ([A-Z])', opis)
+            if litera:
+                return json.dumps(litera.group(1))
+            return json.dumps(f"atrapa: {opis.strip()}", ensure_ascii=False)
+
+        text = re.sub(r'\(([^()]*)\)(?=\s*[,}\n])', zamien, szablon)
+        try:
+            return wyciagnij_json(text)
+        except BladAI:
+            return {}
@@ -1,6 +1,6 @@
 import os
 from datetime import datetime, timedelta, timezone
-from app import app, db, Car
+from app import app, db, Car, purge_uploads
 
 def run_maintenance():
     """Główna funkcja sprzątająca serwer z wygasłych ogłoszeń i osieroconych plików."""
@@ -23,25 +23,9 @@ def run_maintenance():
 
         for car in expired_cars:
             try:
-                # 3. Usuwanie plików powiązanych z ogłoszeniem
-                # Zakładamy, że masz relację do zdjęć (car.images)
-                if hasattr(car, 'images'):
-                    for img_record in car.images:
-                        # Używamy os.path.basename dla bezpieczeństwa między systemami
-                        filename = os.path.basename(img_record.image_path)
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                            files_removed += 1
-                
-                # Jeśli Twoje zdjęcia są zapisane bezpośrednio w polu car.img:
-                elif car.img and not car.img.startswith('http'):
-                    filename = os.path.basename(car.img)
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        files_removed += 1
+                # 3. Pliki zdjęć nie są kasowane tutaj - mogą być współdzielone z innymi ogłoszeniami
+                #    (magazyn po hashu). Usunięcie rekordu zdejmuje referencje (triggery w bazie),
+                #    a purge_uploads() skasuje pliki, których nikt już nie używa.
 
                 # 4. Usuwanie rekordu z bazy
                 # Dzięki Twojej kaskadzie (cascade="all, delete-orphan"), 
@@ -56,6 +40,7 @@ def run_maintenance():
         # 5. Finalne zatwierdzenie zmian
         try:
             db.session.commit()
+            files_removed = purge_uploads()
             print(f"✅ SUKCES: Usunięto {deleted_count} ogłoszeń i {files_removed} plików.")
         except Exception as e:
             print(f"❌ Krytyczny błąd bazy danych: {e}")
@@ -0,0 +1,264 @@
+import io
+import os
+import json
+import math
+import base64
+import hashlib
+import tempfile
+from functools import lru_cache
+from PIL import Image, ImageOps, ExifTags
+
+# Czysta obróbka zdjęć (bez Flaska i bazy) - ten moduł ładują procesy puli zdjęć z app.py,
+# więc nie może importować app (inaczej każdy proces stawiałby całą aplikację i scheduler).
+
+MAX_SIZE = (1920, 1920)
+THUMB_SIZE = (400, 300)
+
+WATERMARK_SCALE = 0.20   # szerokość znaku = 20% szerokości zdjęcia
+WATERMARK_OPACITY = 0.5
+WATERMARK_MARGIN = 20
+
+# Znak wodny ładowany raz na proces. Klucz cache zawiera mtime pliku - podmiana watermark.png
+# na serwerze daje nowy klucz, więc stare warianty same wypadają z LRU (bez restartu).
+@lru_cache(maxsize=2)
+def _watermark_base(path, mtime):
+    watermark = Image.open(path).convert("RGBA")
+    # Przezroczystość liczona raz, a nie przy każdym zdjęciu
+    alpha = watermark.getchannel('A').point(lambda p: int(p * WATERMARK_OPACITY))
+    watermark.putalpha(alpha)
+    return watermark
+
+@lru_cache(maxsize=32)
+def _watermark_scaled(path, mtime, width):
+    base = _watermark_base(path, mtime)
+    height = max(1, int(base.height * width / float(base.width)))
+    return base.resize((width, height), Image.Resampling.LANCZOS)
+
+def znak_wodny(watermark_path, image_width):
+    """Gotowy (przeskalowany, półprzezroczysty) znak dla zdjęcia o danej szerokości albo None."""
+    try:
+        mtime = os.stat(watermark_path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+    width = int(image_width * WATERMARK_SCALE)
+    if width < 1:
+        return None
+    return _watermark_scaled(watermark_path, mtime, width)
+
+def nalozenie_znaku_wodnego(image, watermark_path):
+    # Wkleja znak w miejscu (prawy dolny róg) - bez dodatkowej pełnowymiarowej klatki
+    watermark = znak_wodny(watermark_path, image.width)
+    if watermark is not None:
+        position = (image.width - watermark.width - WATERMARK_MARGIN, image.height - watermark.height - WATERMARK_MARGIN)
+        image.paste(watermark, position, mask=watermark)
+    return image
+
+def otworz_zmniejszone(source, max_size):
+    """Image.open + exif_transpose, ale JPEG od razu dekodowany w skali 1/2, 1/4 albo 1/8 (draft).
+
+    Zdjęcie z telefonu 12-50 MP nie jest rozpakowywane w pełnej rozdzielczości, tylko w najmniejszej
+    skali DCT, która jest nadal >= docelowego rozmiaru. Dalsze thumbnail() robi już tylko dokładkę.
+    """
+    image = Image.open(source)
+    if image.format == 'JPEG':
+        # draft działa na surowych wymiarach (przed obrotem z EXIF) - dla obrotu o 90° zamieniamy ramkę
+        orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+        box = (max_size[1], max_size[0]) if orientation in (5, 6, 7, 8) else max_size
+        ratio = min(box[0] / image.width, box[1] / image.height)
+        if ratio < 1:
+            image.draft(None, (max(1, int(image.width * ratio)), max(1, int(image.height * ratio))))
+    return ImageOps.exif_transpose(image)
+
+def zapisz_atomowo(image, dst, **params):
+    """Zapis przez plik tymczasowy + os.replace - równoległy zapis tej samej nazwy nie zostawi połówki."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, **params)
+        os.replace(tmp, dst)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+LQIP_SIZE = 16
+
+def placeholder(image):
+    """Podgląd 16px (data URI, ~200 B) + dominujący kolor - karta maluje się, zanim dojdzie WebP."""
+    small = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+    small.thumbnail((LQIP_SIZE, LQIP_SIZE), Image.Resampling.BILINEAR)
+    buf = io.BytesIO()
+    small.save(buf, format='WEBP', quality=30)
+    lqip = 'data:image/webp;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+
+    # Kolor dominujący = najliczniejszy z 4 kolorów palety (średnia dawałaby szarość)
+    paleta = small.quantize(colors=4)
+    _, idx = max(paleta.getcolors())
+    r, g, b = paleta.getpalette()[idx * 3:idx * 3 + 3]
+    return {'lqip': lqip, 'dominant_color': f"#{r:02x}{g:02x}{b:02x}"}
+
+def przetworz_zdjecie(source, filepath, thumb_filepath=None, watermark_path=None):
+    """Skalowanie + znak wodny + WebP (i opcjonalnie miniatura). Zwraca placeholder() zdjęcia.
+
+    source = ścieżka, plik albo bytes.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    # Otwieranie obrazu przez PIL (JPEG w zmniejszonej skali) i poprawa rotacji
+    image = otworz_zmniejszone(source, MAX_SIZE)
+
+    # Przezroczystość tylko tam, gdzie naprawdę jest (PNG/GIF) - zdjęcia z aparatu zostają w RGB
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    target_mode = 'RGBA' if has_alpha else 'RGB'
+    if image.mode != target_mode:
+        image = image.convert(target_mode)
+
+    # Skalowanie głównego obrazu
+    image.thumbnail(MAX_SIZE, Image.Resampling.LANCZOS)
+
+    # Dla WebP zrzucamy przezroczystość na białe tło przed kompresją (jedna klatka, tylko dla RGBA)
+    if has_alpha:
+        final_image = Image.new("RGB", image.size, (255, 255, 255))
+        final_image.paste(image, mask=image.getchannel('A'))
+    else:
+        final_image = image
+
+    # --- NAKŁADANIE ZNAKU WODNEGO ---
+    final_image = nalozenie_znaku_wodnego(final_image, watermark_path)
+
+    # --- ZAPIS JAKO WEBP ---
+    zapisz_atomowo(final_image, filepath, format='WEBP', quality=80)
+
+    # JEŚLI TO ZDJĘCIE AUTA/PRZEDMIOTU -> TWORZYMY DODATKOWO LEKKĄ MINIATURKĘ
+    if thumb_filepath:
+        thumb_img = ImageOps.fit(final_image, THUMB_SIZE, method=Image.Resampling.LANCZOS)
+        zapisz_atomowo(thumb_img, thumb_filepath, format='WEBP', quality=75)
+    return placeholder(final_image)
+
+def dhash(image, size=16):
+    """Hash percepcyjny (dHash, size*size bitów): to samo zdjęcie po ponownym zapisie, kompresji
+    czy lekkim przeskalowaniu różni się o kilka bitów, inne zdjęcie - o kilkadziesiąt."""
+    small = image.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR)
+    px = small.tobytes()
+    bits = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (px[base + col] > px[base + col + 1])
+    return bits
+
+
+VARIANT_QUALITY = {'webp': 75, 'avif': 50}
+
+def wariant(src, dst, width, fmt):
+    """Mniejsza kopia gotowego zdjęcia (srcset). Zapis atomowy - równoległe żądania nie widzą połówek."""
+    with Image.open(src) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((width, width * 4), Image.Resampling.LANCZOS) # liczy się tylko szerokość
+        zapisz_atomowo(image, dst, format=fmt.upper(), quality=VARIANT_QUALITY.get(fmt, 75))
+
+
+# --- WIDOK 360°: KLATKI -> SPRITE ---
+# Zamiast całego MP4 przeglądarka dostaje jeden lekki sprite (wszystkie klatki w małej skali)
+# i dociąga kafle w pełnej rozdzielczości dopiero dla klatek, na które użytkownik obraca auto.
+SPIN_LOW_WIDTH = 320
+SPIN_HIGH_WIDTH = 1280
+SPIN_POSTER_WIDTH = 960
+SPIN_TILE_COLS = 2 # kafel hi-res = 2x2 klatki
+SPIN_TILE_FRAMES = SPIN_TILE_COLS * 2
+SPIN_MANIFEST = 'sprite.json'
+SPIN_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+WEBP_MAX_DIM = 16383
+
+def klatki_360(folder):
+    """Pliki klatek w kolejności obrotu (po nazwie); podkatalogi (np. wynik sprite) pomijamy."""
+    try:
+        names = sorted(n for n in os.listdir(folder) if n.lower().endswith(SPIN_EXTENSIONS))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(folder, n) for n in names if os.path.isfile(os.path.join(folder, n))]
+
+def _podpis_klatek(frames):
+    # Zmiana/dodanie/usunięcie klatki albo parametrów sprite = nowy podpis = przebudowa
+    h = hashlib.sha1(f"{SPIN_LOW_WIDTH}:{SPIN_HIGH_WIDTH}:{SPIN_TILE_FRAMES}".encode())
+    for path in frames:
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+def _siatka(n, frame_w, frame_h):
+    # Mniej więcej kwadratowy arkusz, ale w limicie wymiarów WebP
+    cols = max(1, min(n, math.ceil(math.sqrt(n * frame_h / frame_w)), WEBP_MAX_DIM // frame_w))
+    return cols, math.ceil(n / cols)
+
+def sprite_360(folder, out_folder):
+    """Buduje (albo zwraca z cache na dysku) sprite'y widoku 360° dla katalogu klatek.
+
+    Zwraca manifest (dict, zapisany też jako sprite.json) albo None, gdy w katalogu nie ma klatek.
+    """
+    frames = klatki_360(folder)
+    if not frames:
+        return None
+    podpis = _podpis_klatek(frames)
+    manifest_path = os.path.join(out_folder, SPIN_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('zrodlo') == podpis:
+            return manifest
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(out_folder, exist_ok=True)
+    n = len(frames)
+    with Image.open(frames[0]) as first:
+        width, height = ImageOps.exif_transpose(first).size
+    high_w = min(SPIN_HIGH_WIDTH, width)
+    high_h = max(1, round(height * high_w / width))
+    low_w = min(SPIN_LOW_WIDTH, high_w)
+    low_h = max(1, round(height * low_w / width))
+    low_cols, low_rows = _siatka(n, low_w, low_h)
+    tile_cols = SPIN_TILE_COLS if n > 1 else 1
+
+    low_sheet = Image.new('RGB', (low_cols * low_w, low_rows * low_h))
+    high_files, tile = [], None
+    for i, path in enumerate(frames):
+        # Klatki jedna po drugiej (draft dla JPEG) - w pamięci jest tylko bieżąca klatka i dwa arkusze
+        with otworz_zmniejszone(path, (high_w, high_h)) as image:
+            frame = image.convert('RGB').resize((high_w, high_h), Image.Resampling.LANCZOS)
+        if i == 0:
+            poster = frame.copy()
+            poster.thumbnail((SPIN_POSTER_WIDTH, SPIN_POSTER_WIDTH), Image.Resampling.LANCZOS)
+            zapisz_atomowo(poster, os.path.join(out_folder, 'poster.webp'), format='WEBP', quality=75)
+        low_sheet.paste(frame.resize((low_w, low_h), Image.Resampling.LANCZOS), ((i % low_cols) * low_w, (i // low_cols) * low_h))
+
+        j = i % SPIN_TILE_FRAMES
+        if j == 0:
+            in_tile = min(SPIN_TILE_FRAMES, n - i)
+            tile = Image.new('RGB', (min(tile_cols, in_tile) * high_w, math.ceil(in_tile / tile_cols) * high_h))
+        tile.paste(frame, ((j % tile_cols) * high_w, (j // tile_cols) * high_h))
+        if j == SPIN_TILE_FRAMES - 1 or i == n - 1:
+            name = f"high_{len(high_files)}.webp"
+            zapisz_atomowo(tile, os.path.join(out_folder, name), format='WEBP', quality=80)
+            high_files.append(name)
+    zapisz_atomowo(low_sheet, os.path.join(out_folder, 'low.webp'), format='WEBP', quality=70)
+
+    # Kafle z poprzedniej (dłuższej) sekwencji klatek
+    for name in os.listdir(out_folder):
+        if name.startswith('high_') and name not in high_files:
+            os.remove(os.path.join(out_folder, name))
+
+    manifest = {
+        'zrodlo': podpis,
+        'klatki': n,
+        'poster': 'poster.webp',
+        'low': {'plik': 'low.webp', 'w': low_w, 'h': low_h, 'kolumny': low_cols},
+        'high': {'pliki': high_files, 'w': high_w, 'h': high_h, 'kolumny': tile_cols, 'na_kafel': SPIN_TILE_FRAMES},
+    }
+    fd, tmp = tempfile.mkstemp(dir=out_folder, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path) # manifest na końcu - nikt nie zobaczy niepełnego zestawu
+    return manifest
@@ -0,0 +1,68 @@
+import os
+import sys
+from PIL import Image
+from app import app, db, Car, CarImage, UPLOAD_FOLDER
+import obrazy
+
+# Jednorazowe uzupełnienie placeholderów (LQIP + kolor dominujący) dla zdjęć wgranych przed ich
+# wprowadzeniem. Nowe zdjęcia dostają je od razu przy uploadzie (obrazy.przetworz_zdjecie).
+#   python placeholdery.py          -> uzupełnia brakujące
+#   python placeholdery.py --dry    -> tylko liczy
+
+PACZKA = 200
+
+def sciezka_pliku(url):
+    # '/static/uploads/abc.webp' -> 'static/uploads/abc.webp' (zewnętrzne linki i placeholdery pomijamy)
+    prefix = app.static_url_path + '/uploads/'
+    if not url or not url.startswith(prefix):
+        return None
+    path = os.path.join(app.root_path, UPLOAD_FOLDER, url[len(prefix):])
+    return path if os.path.isfile(path) else None
+
+def policz(url, cache):
+    # To samo zdjęcie bywa i w car.img, i w car_image - liczymy je raz
+    if url not in cache:
+        path = sciezka_pliku(url)
+        ph = None
+        if path:
+            try:
+                with Image.open(path) as image:
+                    ph = obrazy.placeholder(image)
+            except Exception as e:
+                print(f"⚠️ {path}: {e}")
+        cache[url] = ph
+    return cache[url]
+
+def uzupelnij(model, url_attr, lqip_attr, color_attr, dry, cache):
+    url_col = getattr(model, url_attr)
+    query = model.query.filter(getattr(model, lqip_attr).is_(None), url_col.like(app.static_url_path + '/uploads/%'))
+    total = query.count()
+    print(f"🔧 {model.__tablename__}: bez placeholdera {total}")
+    if dry or not total:
+        return 0
+    done, last_id = 0, 0
+    while True:
+        rows = query.filter(model.id > last_id).order_by(model.id).limit(PACZKA).all()
+        if not rows:
+            break
+        for row in rows:
+            ph = policz(getattr(row, url_attr), cache)
+            if ph:
+                setattr(row, lqip_attr, ph['lqip'])
+                setattr(row, color_attr, ph['dominant_color'])
+                done += 1
+        last_id = rows[-1].id
+        db.session.commit()
+        print(f"   ... {done}/{total}")
+    return done
+
+def run(dry=False):
+    cache = {}
+    with app.app_context():
+        zdjecia = uzupelnij(CarImage, 'image_path', 'lqip', 'dominant_color', dry, cache)
+        glowne = uzupelnij(Car, 'img', 'img_lqip', 'img_color', dry, cache)
+    if not dry:
+        print(f"✅ Uzupełniono: zdjęcia galerii {zdjecia}, zdjęcia główne {glowne}")
+
+if __name__ == "__main__":
+    run(dry='--dry' in sys.argv)
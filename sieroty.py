@@ -0,0 +1,249 @@
+import os
+import time
+import shutil
+import argparse
+from itertools import islice
+from app import app, db, Car, CarImage, User, UploadFile, ScanToken, UPLOAD_FOLDER, RENDERS_360_FOLDER, VIDEOS_360_FOLDER, VARIANT_FOLDER
+
+# Mark & sweep dla static/uploads: kasuje pliki, do których nie prowadzi już żaden rekord
+# (np. po usun_konto / admin_delete_user / usun_usera albo starych skryptach sprzątających).
+# Chodzi paczkami z pauzą i zapamiętuje kursor, więc z crona przechodzi drzewo po kawałku.
+#   python sieroty.py --dry                  -> raport dla całego drzewa, nic nie kasuje
+#   python sieroty.py                        -> kasuje, max --limit pozycji na uruchomienie
+#   python sieroty.py --paczka 200 --pauza 1 --limit 2000
+
+PACZKA = 500
+PAUZA = 0.5          # sekundy między paczkami - żeby nie zajeżdżać dysku na produkcji
+LIMIT = 5000         # pozycji na jedno uruchomienie (potem kolejne uruchomienie rusza od kursora)
+GRACE_MINUTES = 60   # świeże pliki mogą jeszcze czekać na commit ogłoszenia - nie ruszamy
+KURSOR = os.path.join(app.instance_path, 'sieroty.kursor')
+
+# Kolumny, które wskazują na pliki w static/uploads (+ magazyn: te wpisy sprząta purge_uploads)
+REFERENCJE = [
+    (Car.__tablename__, 'img'), (Car.__tablename__, 'thumb'),
+    (CarImage.__tablename__, 'image_path'), (CarImage.__tablename__, 'thumb_path'),
+    (User.__tablename__, 'avatar_url'),
+    (UploadFile.__tablename__, 'image_path'), (UploadFile.__tablename__, 'thumb_path'),
+    (ScanToken.__tablename__, 'image_path'), (ScanToken.__tablename__, 'thumb_path'),
+]
+
+RENDERS = os.path.relpath(RENDERS_360_FOLDER, UPLOAD_FOLDER)
+VIDEOS = os.path.relpath(VIDEOS_360_FOLDER, UPLOAD_FOLDER)
+WARIANTY = os.path.relpath(VARIANT_FOLDER, UPLOAD_FOLDER)
+
+def url(name):
+    return f"{app.static_url_path}/uploads/{name}"
+
+def uzywane_sciezki(paths=None):
+    """Zbiór ścieżek URL wskazywanych przez bazę (wszystkie albo tylko spośród paths)."""
+    union = ' UNION ALL '.join(f'SELECT {col} AS path FROM "{table}"' for table, col in REFERENCJE)
+    sql = f"SELECT DISTINCT path FROM ({union}) WHERE path LIKE :prefix"
+    params = {'prefix': url('%')}
+    stmt = db.text(sql)
+    if paths is not None:
+        stmt = db.text(sql + " AND path IN :paths").bindparams(db.bindparam('paths', expanding=True))
+        params['paths'] = list(paths)
+    return {r[0] for r in db.session.execute(stmt, params)}
+
+def istniejace_auta(ids=None):
+    query = db.session.query(Car.id)
+    if ids is not None:
+        query = query.filter(Car.id.in_(ids))
+    return {r[0] for r in query}
+
+def nazwy_uzywane(paths):
+    # '/static/uploads/abc.webp' -> 'abc.webp' (+ jego miniatura, nawet jeśli nie jest zapisana w bazie)
+    prefix = url('')
+    names = set()
+    for p in paths:
+        name = p[len(prefix):]
+        names.add(name)
+        names.add(f"thumb_{name}")
+    return names
+
+def rodzaj(klucz):
+    if len(klucz) == 1:
+        return 'miniatury' if klucz[0].startswith('thumb_') else 'zdjęcia'
+    return {RENDERS: '360_renders', VIDEOS: '360_videos', WARIANTY: 'warianty'}[klucz[0]]
+
+def pozycje(root, kursor):
+    """Pozycje drzewa (klucz = krotka składowych ścieżki) w stałej kolejności, od miejsca po kursorze.
+
+    Sortowanie na każdym poziomie = porządek leksykograficzny krotek, więc wznowienie to zwykłe
+    porównanie z kursorem, a całe katalogi przed kursorem są pomijane bez listowania.
+    """
+    def po_kursorze(klucz, katalog=False):
+        if not kursor:
+            return True
+        if katalog:
+            return klucz >= kursor[:len(klucz)]
+        return klucz > kursor
+
+    def listuj(sciezka):
+        try:
+            return sorted(os.scandir(sciezka), key=lambda e: e.name)
+        except FileNotFoundError:
+            return []
+
+    for e in listuj(root):
+        if e.is_file():
+            if po_kursorze((e.name,)):
+                yield (e.name,), e
+        elif e.name in (RENDERS, VIDEOS) and po_kursorze((e.name,), katalog=True):
+            # 360_renders/<id>/ jest jedną pozycją (cały katalog), 360_videos/<id>.mp4 - plikiem
+            for sub in listuj(e.path):
+                if po_kursorze((e.name, sub.name)):
+                    yield (e.name, sub.name), sub
+        elif e.name == WARIANTY and po_kursorze((e.name,), katalog=True):
+            for width in listuj(e.path):
+                if not width.is_dir() or not po_kursorze((e.name, width.name), katalog=True):
+                    continue
+                for sub in listuj(width.path):
+                    if sub.is_file() and po_kursorze((e.name, width.name, sub.name)):
+                        yield (e.name, width.name, sub.name), sub
+        # inne katalogi (nieznane) zostawiamy w spokoju
+
+def rozmiar(entry):
+    if entry.is_file():
+        return entry.stat().st_size
+    total = 0
+    for dirpath, _, names in os.walk(entry.path):
+        for n in names:
+            try: total += os.path.getsize(os.path.join(dirpath, n))
+            except OSError: pass
+    return total
+
+def id_auta(klucz):
+    name = os.path.splitext(klucz[1])[0] if klucz[0] == VIDEOS else klucz[1]
+    return int(name) if name.isdigit() else None
+
+def czy_sierota(klucz, nazwy, stems, auta):
+    """Ocena na podstawie znacznika (stan bazy z początku przebiegu)."""
+    if len(klucz) == 1:
+        return klucz[0] not in nazwy
+    if klucz[0] in (RENDERS, VIDEOS):
+        return id_auta(klucz) not in auta
+    return os.path.splitext(klucz[2])[0] not in stems
+
+def potwierdz(kandydaci):
+    """Druga kontrola tuż przed kasowaniem - baza mogła się zmienić od znakowania."""
+    pliki = [k for k, _ in kandydaci if len(k) == 1]
+    sciezki = set()
+    for k in pliki:
+        sciezki.add(url(k[0]))
+        if k[0].startswith('thumb_'):
+            sciezki.add(url(k[0][len('thumb_'):]))
+    nazwy = nazwy_uzywane(uzywane_sciezki(sciezki)) if sciezki else set()
+    ids = {id_auta(k) for k, _ in kandydaci if k[0] in (RENDERS, VIDEOS)} - {None}
+    auta = istniejace_auta(ids) if ids else set()
+    # Warianty nie wymagają drugiej kontroli - /img/ i tak odtworzy je z oryginału na żądanie
+    return [(k, e) for k, e in kandydaci
+            if not (len(k) == 1 and k[0] in nazwy) and not (k[0] in (RENDERS, VIDEOS) and id_auta(k) in auta)]
+
+def usun(entry):
+    try:
+        if entry.is_dir():
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def wczytaj_kursor():
+    try:
+        with open(KURSOR) as f:
+            value = f.read().strip()
+        return tuple(value.split('/')) if value else None
+    except FileNotFoundError:
+        return None
+
+def zapisz_kursor(klucz):
+    os.makedirs(os.path.dirname(KURSOR), exist_ok=True)
+    with open(KURSOR, 'w') as f:
+        f.write('/'.join(klucz) if klucz else '')
+
+def run(dry=False, paczka=PACZKA, pauza=PAUZA, limit=LIMIT, grace_minutes=GRACE_MINUTES):
+    root = os.path.join(app.root_path, UPLOAD_FOLDER)
+    # Dry-run zawsze raportuje całe drzewo i nie przesuwa kursora
+    kursor = None if dry else wczytaj_kursor()
+    if dry:
+        limit = None
+    cutoff = time.time() - grace_minutes * 60
+    raport = {}
+    przejrzane, usuniete, ostatni = 0, 0, kursor
+
+    with app.app_context():
+        # MARK: stan bazy raz na przebieg (zbiory nazw, nie obiekty ORM)
+        sciezki = uzywane_sciezki()
+        nazwy = nazwy_uzywane(sciezki)
+        stems = {os.path.splitext(n)[0] for n in nazwy}
+        auta = istniejace_auta()
+        print(f"🔧 Znakowanie: {len(sciezki)} plików w użyciu, {len(auta)} ogłoszeń"
+              + (f" (wznowienie od {'/'.join(kursor)})" if kursor else ""))
+
+        # SWEEP: paczkami, z pauzą między nimi
+        it = pozycje(root, kursor)
+        koniec_drzewa = False
+        while limit is None or przejrzane < limit:
+            rozmiar_paczki = paczka if limit is None else min(paczka, limit - przejrzane)
+            paczka_pozycji = list(islice(it, rozmiar_paczki))
+            if len(paczka_pozycji) < rozmiar_paczki:
+                koniec_drzewa = True
+            kandydaci = []
+            for klucz, entry in paczka_pozycji:
+                try:
+                    if entry.stat().st_mtime > cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if czy_sierota(klucz, nazwy, stems, auta):
+                    kandydaci.append((klucz, entry))
+            przejrzane += len(paczka_pozycji)
+            if paczka_pozycji:
+                ostatni = paczka_pozycji[-1][0]
+
+            if kandydaci:
+                kandydaci = potwierdz(kandydaci)
+            for klucz, entry in kandydaci:
+                size = rozmiar(entry)
+                if not dry and not usun(entry):
+                    continue
+                stat = raport.setdefault(rodzaj(klucz), [0, 0, []])
+                stat[0] += 1
+                stat[1] += size
+                if len(stat[2]) < 10:
+                    stat[2].append('/'.join(klucz))
+                usuniete += 1
+            db.session.rollback() # kończymy transakcję odczytu - nie trzymamy snapshotu między paczkami
+            if koniec_drzewa or (limit is not None and przejrzane >= limit):
+                break
+            if pauza:
+                time.sleep(pauza)
+
+    # Kursor: po końcu drzewa następne uruchomienie zaczyna od początku
+    if not dry:
+        zapisz_kursor(None if koniec_drzewa else ostatni)
+
+    tryb = "DRY-RUN (nic nie usunięto)" if dry else "usunięto"
+    print(f"\n{'rodzaj':<14}{'plików':>8}{'MB':>10}")
+    for nazwa, (count, size, _) in sorted(raport.items()):
+        print(f"{nazwa:<14}{count:>8}{size / 1024 / 1024:>10.1f}")
+    if dry:
+        for nazwa, (_, _, przyklady) in sorted(raport.items()):
+            print(f"\n{nazwa} - przykłady:")
+            for p in przyklady:
+                print(f"   {p}")
+    print(f"\n✅ Przejrzano {przejrzane} pozycji, sieroty ({tryb}): {usuniete}, "
+          f"{sum(s for _, s, _ in raport.values()) / 1024 / 1024:.1f} MB")
+    return usuniete
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sprzątanie osieroconych plików w static/uploads")
+    parser.add_argument('--dry', action='store_true', help="tylko raport, bez kasowania")
+    parser.add_argument('--paczka', type=int, default=PACZKA, help="pozycji na paczkę")
+    parser.add_argument('--pauza', type=float, default=PAUZA, help="sekund przerwy między paczkami")
+    parser.add_argument('--limit', type=int, default=LIMIT, help="max pozycji na uruchomienie")
+    parser.add_argument('--grace', type=int, default=GRACE_MINUTES, help="pomijaj pliki młodsze niż N minut")
+    args = parser.parse_args()
+    run(args.dry, args.paczka, args.pauza, args.limit, args.grace)
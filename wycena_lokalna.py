@@ -0,0 +1,151 @@
+import re
+import numpy as np
+
+# Lokalny szacunek ceny z podobnych ogłoszeń (kNN) - bez Flaska i bez bazy, tylko NumPy.
+# app.py trzyma jedną instancję KolumnyAut i dosyła do niej zmienione wiersze (dziennik car_zmiana).
+
+KURSY_PLN = {'PLN': 1.0, 'EUR': 4.3, 'USD': 4.0}
+
+# Skale cech: różnica o tyle "kosztuje" tyle samo co inna wartość paliwa
+SKALA = {'rok': 2.0, 'przebieg': 40000.0, 'moc': 30.0, 'pojemnosc': 0.3}
+KARA_PALIWO = 1.0
+KARA_BRAK = 1.0        # brak danych (np. moc) po jednej ze stron
+KARA_INNY_MODEL = 4.0  # gdy podobnych modeli jest za mało, dobieramy inne modele tej marki
+K = 15
+MIN_POROWNAN = 5
+
+# Werdykty zgodne z AI_OCENY / AI_KOLORY w app.py (apply_valuation mapuje je na ai_ocena)
+PROGI = [(0.85, 'SUPER OKAZJA', 'success'), (0.97, 'DOBRA CENA', 'success'),
+         (1.08, 'UCZCIWA CENA', 'info'), (float('inf'), 'DROGO', 'danger')]
+
+def tekst(value):
+    return ' '.join(str(value or '').lower().split())
+
+def litry(pojemnosc):
+    """'2.0', '2,0 TDI', '1998 cm3' -> 2.0 / 1.998; nieczytelne -> NaN."""
+    m = re.search(r'\d+(?:[.,]\d+)?', str(pojemnosc or ''))
+    if not m:
+        return np.nan
+    value = float(m.group(0).replace(',', '.'))
+    return value / 1000.0 if value > 100 else value
+
+def cena_pln(cena, waluta):
+    kurs = KURSY_PLN.get((waluta or 'PLN').upper())
+    if not kurs or not cena or cena <= 0:
+        return np.nan
+    return float(cena) * kurs
+
+def werdykt(cena, srednia):
+    ratio = cena / srednia
+    for prog, label, color in PROGI:
+        if ratio < prog:
+            return label, color, int(np.clip(round(50 + (1 - ratio) * 200), 1, 100))
+
+
+class KolumnyAut:
+    """Kolumny ogłoszeń w tablicach NumPy (jeden wiersz = jedno auto), aktualizowane punktowo."""
+
+    def __init__(self, capacity=1024):
+        self._slowniki = {'marka': {}, 'model': {}, 'paliwo': {}}
+        self._wiersz = {}  # car_id -> indeks w tablicach
+        self.n = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        old = getattr(self, 'kol', None)
+        kol = {
+            'id': np.zeros(capacity, np.int64),
+            'marka': np.full(capacity, -1, np.int32), 'model': np.full(capacity, -1, np.int32),
+            'paliwo': np.full(capacity, -1, np.int32),
+            'rok': np.full(capacity, np.nan), 'przebieg': np.full(capacity, np.nan),
+            'moc': np.full(capacity, np.nan), 'pojemnosc': np.full(capacity, np.nan),
+            'cena': np.full(capacity, np.nan),
+            'aktywne': np.zeros(capacity, bool),
+        }
+        if old is not None:
+            for name, arr in old.items():
+                kol[name][:self.n] = arr[:self.n]
+        self.kol = kol
+
+    def _kod(self, slownik, value):
+        d = self._slowniki[slownik]
+        return d.setdefault(tekst(value), len(d))
+
+    def __len__(self):
+        return int(self.kol['aktywne'][:self.n].sum())
+
+    def wyczysc(self):
+        self.__init__(len(self.kol['id']))
+
+    def upsert(self, car_id, marka, model, rok, przebieg, moc, pojemnosc, paliwo, cena, waluta, aktywne=True):
+        i = self._wiersz.get(car_id)
+        if i is None:
+            if self.n == len(self.kol['id']):
+                self._alloc(self.n * 2)
+            i = self._wiersz[car_id] = self.n
+            self.n += 1
+        k = self.kol
+        k['id'][i] = car_id
+        k['marka'][i] = self._kod('marka', marka)
+        k['model'][i] = self._kod('model', model)
+        k['paliwo'][i] = self._kod('paliwo', paliwo)
+        k['rok'][i] = rok if rok else np.nan
+        k['przebieg'][i] = przebieg if przebieg is not None else np.nan
+        k['moc'][i] = moc if moc else np.nan
+        k['pojemnosc'][i] = litry(pojemnosc)
+        k['cena'][i] = cena_pln(cena, waluta)
+        k['aktywne'][i] = bool(aktywne) and not np.isnan(k['cena'][i])
+
+    def usun(self, car_id):
+        i = self._wiersz.get(car_id)
+        if i is not None:
+            self.kol['aktywne'][i] = False
+
+    def szacuj(self, marka, model, rok, przebieg, moc, pojemnosc, paliwo, cena=None, waluta='PLN', pomin_id=None, k=K):
+        """Widełki i werdykt z k najbliższych porównywalnych ogłoszeń albo None (za mało danych)."""
+        kol, n = self.kol, self.n
+        marka_kod = self._slowniki['marka'].get(tekst(marka))
+        if marka_kod is None or n == 0:
+            return None
+        maska = kol['aktywne'][:n] & (kol['marka'][:n] == marka_kod)
+        if pomin_id is not None and pomin_id in self._wiersz:
+            maska[self._wiersz[pomin_id]] = False
+        idx = np.flatnonzero(maska)
+        if len(idx) < MIN_POROWNAN:
+            return None
+
+        def skladnik(name, value):
+            col = kol[name][idx]
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                return np.full(len(idx), KARA_BRAK)
+            diff = (col - value) / SKALA[name]
+            return np.where(np.isnan(diff), KARA_BRAK, diff * diff)
+
+        d = (skladnik('rok', float(rok) if rok else None)
+             + skladnik('przebieg', float(przebieg) if przebieg is not None else None)
+             + skladnik('moc', float(moc) if moc else None)
+             + skladnik('pojemnosc', litry(pojemnosc)))
+        paliwo_kod = self._slowniki['paliwo'].get(tekst(paliwo), -2)
+        d += np.where(kol['paliwo'][idx] == paliwo_kod, 0.0, KARA_PALIWO)
+        model_kod = self._slowniki['model'].get(tekst(model), -2)
+        ten_model = kol['model'][idx] == model_kod
+        d += np.where(ten_model, 0.0, KARA_INNY_MODEL)
+
+        k = min(k, len(idx))
+        best = np.argpartition(d, k - 1)[:k]
+        ceny = kol['cena'][idx[best]]
+        wagi = 1.0 / (1.0 + d[best])
+        order = np.argsort(ceny)
+        ceny, wagi = ceny[order], wagi[order]
+        cum = np.cumsum(wagi) / wagi.sum()
+        wynik = {
+            'pl_min': float(round(ceny[np.searchsorted(cum, 0.15)], -2)),
+            'pl_avg': float(round(np.average(ceny, weights=wagi), -2)),
+            'pl_max': float(round(ceny[min(np.searchsorted(cum, 0.85), len(ceny) - 1)], -2)),
+            'porownan': int(k),
+            'ten_model': int(ten_model[best].sum()),
+        }
+        moja = cena_pln(cena, waluta) if cena else np.nan
+        if not np.isnan(moja) and wynik['pl_avg'] > 0:
+            wynik['label'], wynik['color'], wynik['score'] = werdykt(moja, wynik['pl_avg'])
+        return wynik